@@ -1,46 +1,24 @@
-import os
-import cdsapi
-from tqdm import tqdm
+from era5_download import year_tasks, download_all, MONTHS
 
 folder = "/mnt/d/Datasets/ERA5 Reanalysis/monthly-single-levels"
-downloaded = os.listdir(folder)
-try:
-    downloaded = [int(x.split("_")[1].split(".")[0]) for x in downloaded]
-    last_year = max(downloaded) if downloaded else (2020 - 51)
-except:
-    last_year = 2020 - 51
+# Progress is kept in a JSON state file next to the data folder (not inside it, 01 reads every file there)
+state_path = f"{folder}_download_state.json"
 
-c = cdsapi.Client()
-for year in tqdm(range(last_year + 1, 2021)):
-    print("Descargando año: ", year)
-    c.retrieve(
-        "reanalysis-era5-single-levels-monthly-means",
-        {
-            "format": "netcdf",
-            "product_type": "monthly_averaged_reanalysis",
-            "variable": [
-                "2m_dewpoint_temperature",
-                "2m_temperature",
-                "surface_pressure",
-                "total_precipitation",
-            ],
-            "year": [f"{year}"],
-            "month": [
-                "01",
-                "02",
-                "03",
-                "04",
-                "05",
-                "06",
-                "07",
-                "08",
-                "09",
-                "10",
-                "11",
-                "12",
-            ],
-            "time": "00:00",
-        },
-        f"{folder}/data_{year}.zip",
-    )
-    print(f"Se descargó data_{year}.zip")
+tasks = year_tasks(
+    "reanalysis-era5-single-levels-monthly-means",
+    {
+        "format": "netcdf",
+        "product_type": "monthly_averaged_reanalysis",
+        "variable": [
+            "2m_dewpoint_temperature",
+            "2m_temperature",
+            "surface_pressure",
+            "total_precipitation",
+        ],
+        "month": MONTHS,
+        "time": "00:00",
+    },
+    range(2020 - 50, 2021),
+    folder,
+)
+download_all(tasks, state_path)
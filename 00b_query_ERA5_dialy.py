@@ -1,48 +1,32 @@
 import os
-import cdsapi
-from tqdm import tqdm
 
-folder = "/mnt/d/Datasets/ERA5 Reanalysis/dialy-single-levels"
-downloaded = os.listdir(folder)
-try:
-    downloaded = [int(x.split("_")[1].split(".")[0]) for x in downloaded]
-    last_year = max(downloaded) if downloaded else (2020 - 51)
-except:
-    last_year = 2020 - 51
+from era5_download import year_tasks, download_all, MONTHS, DAYS
 
-c = cdsapi.Client()
-for year in tqdm(range(last_year + 1, 2021)):
+folder = "/mnt/d/Datasets/ERA5 Reanalysis/dialy-single-levels"
 
-    dataset = "derived-era5-single-levels-daily-statistics"
-    request = {
-        "product_type": "reanalysis",
-        # "format": "netcdf",
-        "variable": ["2m_temperature"],
-        "year": f"{year}",
-        "month": [
-            "01", "02", "03",
-            "04", "05", "06",
-            "07", "08", "09",
-            "10", "11", "12"
-        ],
-        "day": [
-            "01", "02", "03",
-            "04", "05", "06",
-            "07", "08", "09",
-            "10", "11", "12",
-            "13", "14", "15",
-            "16", "17", "18",
-            "19", "20", "21",
-            "22", "23", "24",
-            "25", "26", "27",
-            "28", "29", "30",
-            "31"
-        ],
-        "daily_statistic": "daily_mean",
-        "time_zone": "utc+00:00",
-        "frequency": "1_hourly"
-    }
+dataset = "derived-era5-single-levels-daily-statistics"
+request = {
+    "product_type": "reanalysis",
+    # "format": "netcdf",
+    "variable": ["2m_temperature"],
+    "month": MONTHS,
+    "day": DAYS,
+    "daily_statistic": "daily_mean",
+    "time_zone": "utc+00:00",
+    "frequency": "1_hourly"
+}
 
-    client = cdsapi.Client()
-    client.retrieve(dataset, request, f"{folder}/data_{year}.zip")
-# "/mnt/d/World Bank/Paper - Child Mortality and Climate Shocks/00b_query_ERA5_dialy.py"
\ No newline at end of file
+# Daily mean in folder, daily maximum and minimum (for the extreme-temperature indices of
+#   daily_tools.py) in folders of their own, as each file holds a single statistic
+folders = {
+    "daily_mean": folder,
+    "daily_maximum": f"{folder}_daily_maximum",
+    "daily_minimum": f"{folder}_daily_minimum",
+}
+for statistic, statistic_folder in folders.items():
+    # Progress is kept in a JSON state file next to the data folder (not inside it)
+    state_path = f"{statistic_folder}_download_state.json"
+    os.makedirs(statistic_folder, exist_ok=True)
+    tasks = year_tasks(dataset, {**request, "daily_statistic": statistic}, range(2020 - 50, 2021), statistic_folder)
+    download_all(tasks, state_path)
+# "/mnt/d/World Bank/Paper - Child Mortality and Climate Shocks/00b_query_ERA5_dialy.py"
@@ -8,6 +8,12 @@ if __name__ == "__main__":
     from dask.diagnostics import ProgressBar
     from dask.distributed import Client
 
+    from spi_tools import spi_multiscale, spi_params, spi_tail
+    from climate_store import export_climate_store, open_climate_store, append_to_store, output_encoding, clip_to_packing
+    from era5_ingest import ingest_archives, INGEST_TIME_CHUNK
+    from temperature_tools import load_climatology, temperature_anomalies
+    from daily_tools import DAILY_STATISTICS, DAILY_TIME_CHUNK, open_daily_stores, load_spell_thresholds, daily_indices
+
     # Set global variables
     PROJECT = r"C:\Working Papers\Paper - Child mortality and Climate Shocks"
     OUTPUTS = rf"{PROJECT}\Outputs"
@@ -17,6 +23,11 @@ if __name__ == "__main__":
     DATA_OUT = rf"{DATA}\Data_out"
     ERA5_DATA = r"C:\Datasets\ERA5 Reanalysis\monthly-single-levels"
 
+    # Compression of the outputs (see climate_store.CODECS, compare them with climate_store.benchmark_codecs)
+    #   and int16 scale-offset packing of the SPI and anomaly variables (precision in climate_store.PACKING_RANGES)
+    OUTPUT_CODEC = "zlib"
+    PACK_OUTPUTS = False
+
     #######################
     #### Filter warnings (disable if debugging)
     logging.disable(logging.CRITICAL)
@@ -34,57 +45,24 @@ if __name__ == "__main__":
     ####  Process data ####
     ########################
     print("Warning: Running this scripts takes about a few days and requires ~600GB to store all the required data. Ensure you have such space available...")
-    era5_path = os.path.join(DATA_PROC, "ERA5_monthly_1970-2021.nc")
+    # Processed ERA5 cube: a Zarr store chunked for point-timeseries access (see climate_store.py).
+    #   The yearly archives downloaded by 00_query_ERA5_data.py are ingested one year at a time in
+    #   year order (see era5_ingest.py), each member is normalized and appended to the store.
+    era5_path = os.path.join(DATA_PROC, "ERA5_monthly.zarr")
+    legacy_era5_path = os.path.join(DATA_PROC, "ERA5_monthly_1970-2021.nc")
     if os.path.exists(era5_path):
         print("ERA5 already processed. Loading...")
+    elif os.path.exists(legacy_era5_path):
+        print("Exporting processed ERA5 NetCDF to Zarr store...")
+        with ProgressBar():
+            export_climate_store(xr.open_dataset(legacy_era5_path, chunks={}), era5_path, time_chunk=INGEST_TIME_CHUNK)
     else:
         ########################
         ####  Load Data    ####
-        print("Loading ERA5 raw data...")
-        files = os.listdir(ERA5_DATA)
-        datasets = []
-        for file in files:
-            ds = xr.open_dataset(
-                os.path.join(ERA5_DATA, file),
-                chunks="auto",
-            )
-            datasets += [ds]
-        precipitation = xr.concat(datasets, dim="time")
-        # precipitation = precipitation.chunk({"time": 15})
-
-        print("Raw Data Loaded! Processing...")
-
-        ########################
-        ####  Process Data  ####
-        ## Longitude is in range 0-360, with 0 at Greenwich.
-        #   We need to transform it to -180 to 180
-        def transform_longitude(longitude):
-            if longitude > 180:
-                return longitude - 360
-            else:
-                return longitude
-
-        precipitation["longitude"] = (
-            precipitation["longitude"].to_series().apply(transform_longitude).values
-        )
-        precipitation = precipitation.sortby("longitude").sortby("latitude")  # Reorder
-        precipitation = precipitation.rename({"longitude": "lon", "latitude": "lat"})
-
-        ## Temperature is in Kelvin, we need it in Celsius
-        precipitation["t2m"] = precipitation["t2m"] - 273.15
-
-        with ProgressBar():
-            encoding = {
-                var: {"zlib": True, "complevel": 5} for var in precipitation.data_vars
-            }
-            precipitation.to_netcdf(
-                era5_path,
-                encoding=encoding,
-            )
+        print("Ingesting ERA5 raw data...")
+        ingest_archives(ERA5_DATA, era5_path)
 
-    precipitation = xr.open_dataset(
-        era5_path#, chunks={"latitude": 10, "longitude": 10, "time": -1}
-    )
+    precipitation = open_climate_store(era5_path)
 
     # # Select south america: -71.894531,-29.228890,-43.593750,-3.337954
     # precipitation = precipitation.sel(
@@ -97,6 +75,12 @@ if __name__ == "__main__":
     ########################
 
     ### Running this takes... A lot. Aprox. 90m for each SPI, so ~7.5h for all SPIs.
+    #   SPI_MULTISCALE computes all the scales in a single pass over the precipitation cube instead.
+    #   SPI_ENGINE = "native" fits the gamma distributions over whole blocks of points at once
+    #   (checked against climate_indices in test_spi_tools.py).
+    SPI_MULTISCALE = True
+    SPI_ENGINE = "native"
+    SPI_SCALES = [1, 3, 6, 9, 12, 24, 48]
 
     ## Script based on: https://github.com/monocongo/climate_indices/issues/326
     ## Original paper: https://www.droughtmanagement.info/literature/AMS_Relationship_Drought_Frequency_Duration_Time_Scales_1993.pdf
@@ -109,6 +93,14 @@ if __name__ == "__main__":
 
     print("Data Ready!")
     spi_out = rf"{DATA_PROC}\ERA5_monthly_1991-2021_spi.nc"
+
+    # Parameters
+    distribution = indices.Distribution.gamma
+    data_start_year = 1986
+    calibration_year_initial = 1991
+    calibration_year_final = 2020
+    periodicity = compute.Periodicity.monthly
+
     if os.path.exists(spi_out):
         print("SPI already computed!")
     else:
@@ -132,173 +124,199 @@ if __name__ == "__main__":
         da_precip = precipitation['tp'].stack(point=('lat', 'lon'))
         da_precip = da_precip.chunk({'time': -1, 'point': 100000})
         print(da_precip.chunks)
-        # Parameters
-        distribution = indices.Distribution.gamma
-        data_start_year = 1986
-        calibration_year_initial = 1991
-        calibration_year_final = 2020
-        periodicity = compute.Periodicity.monthly
-
-        # apply SPI to each `point`
-        spis = []
-        for i in [1, 3, 6, 9, 12, 24, 48]:
-            print(f"Computing SPI-{i}")
-            spi_path = os.path.join(DATA_PROC, f"ERA5_monthly_1991-2021_SPI{i}.nc")
-            if os.path.exists(spi_path):
-                da_spi = xr.open_dataset(
-                    spi_path, chunks={"time": 12, "latitude": 500, "longitude": 500}
-                )
-                print(f"SPI-{i} already computed. Skipping...")
-            else:
-                da_spi_stacked = xr.apply_ufunc(
-                    compute_spi_series,
-                    da_precip,
-                    i,
-                    distribution,
-                    data_start_year,
-                    calibration_year_initial,
-                    calibration_year_final,
-                    periodicity,
-                    input_core_dims=[["time"], [], [], [], [], [], []],
-                    output_core_dims=[["time"]],
-                    output_dtypes=[np.float32],
-                    vectorize=True,
-                    dask="parallelized",
-                )                
-                da_spi = da_spi_stacked.unstack('point').rename(f'spi{i}')
-                # da_spi = da_spi.sel(time=slice("1991", "2021") ) # Only last 30 years
-                encoding = {da_spi.name: {"zlib": True, "complevel": 6}}
-                with ProgressBar():
-                    da_spi.to_netcdf(spi_path, encoding=encoding)
+
+        if SPI_MULTISCALE:
+            # Single pass: each point's series is loaded once, the rolling sums of all the scales
+            #   come from one cumulative sum and all the gamma fits are done in the same call.
+            print(f"Computing SPI-{SPI_SCALES} in a single pass...")
+            spis = spi_multiscale(
+                da_precip,
+                SPI_SCALES,
+                data_start_year,
+                calibration_year_initial,
+                calibration_year_final,
+                periodicity,
+                engine=SPI_ENGINE,
+            ).unstack("point")
+            if PACK_OUTPUTS:
+                spis = clip_to_packing(spis)
+            encoding = output_encoding(spis, spi_out, codec=OUTPUT_CODEC, pack=PACK_OUTPUTS)
+            with ProgressBar():
+                spis.to_netcdf(spi_out, encoding=encoding)
+        else:
+            # apply SPI to each `point`
+            spis = []
+            for i in SPI_SCALES:
+                print(f"Computing SPI-{i}")
+                spi_path = os.path.join(DATA_PROC, f"ERA5_monthly_1991-2021_SPI{i}.nc")
+                if os.path.exists(spi_path):
+                    da_spi = xr.open_dataset(
+                        spi_path, chunks={"time": 12, "latitude": 500, "longitude": 500}
+                    )
+                    print(f"SPI-{i} already computed. Skipping...")
+                else:
+                    da_spi_stacked = xr.apply_ufunc(
+                        compute_spi_series,
+                        da_precip,
+                        i,
+                        distribution,
+                        data_start_year,
+                        calibration_year_initial,
+                        calibration_year_final,
+                        periodicity,
+                        input_core_dims=[["time"], [], [], [], [], [], []],
+                        output_core_dims=[["time"]],
+                        output_dtypes=[np.float32],
+                        vectorize=True,
+                        dask="parallelized",
+                    )                
+                    da_spi = da_spi_stacked.unstack('point').rename(f'spi{i}')
+                    # da_spi = da_spi.sel(time=slice("1991", "2021") ) # Only last 30 years
+                    encoding = {da_spi.name: {"zlib": True, "complevel": 6}}
+                    with ProgressBar():
+                        da_spi.to_netcdf(spi_path, encoding=encoding)
                     
-            spis += [da_spi]
+                spis += [da_spi]
 
-        spis = xr.combine_by_coords(spis)
-        encoding = {name: {"zlib": True, "complevel": 5} for name in spis.data_vars}
-        with ProgressBar():
-            spis.to_netcdf(spi_out)
+            spis = xr.combine_by_coords(spis)
+            encoding = {name: {"zlib": True, "complevel": 5} for name in spis.data_vars}
+            with ProgressBar():
+                spis.to_netcdf(spi_out)
 
     #########################
     ####   Compute Temp  ####
     #########################
 
-    # Standardize temperature over 30-year average
-
-    stdtemp_path = os.path.join(DATA_PROC, "ERA5_monthly_1991-2021_stdtemp.nc")
-    if os.path.exists(stdtemp_path):
-        print("Standardized temperature already computed. Skipping...")
-
-    else:
-        print("Computing standardized temperature...")
-        temperature = xr.open_dataset(era5_path, chunks={"time": 12})
-        temperature = temperature.sel(time=slice("1991", "2021")) # Only last 30 years
-        climatology_mean = temperature["t2m"].mean(dim="time")
-        climatology_std = temperature["t2m"].std(dim="time")
-        stand_temp = xr.apply_ufunc(
-            lambda x, m, s: (x - m) / s,
-            temperature["t2m"],
-            climatology_mean,
-            climatology_std,
-            dask="parallelized",
-        )
-
-        encoding = {stand_temp.name: {"zlib": True, "complevel": 5}}
-        with ProgressBar():
-            stand_temp.to_netcdf(
-                stdtemp_path,
-                encoding=encoding,
-            )
-            
-
-    absdiff_path = os.path.join(DATA_PROC, "ERA5_monthly_1991-2021_absdifftemp.nc")
-    if os.path.exists(absdiff_path):
-        print("Abs diff temperature already computed. Skipping...")
-
+    # Standardize temperature over 30-year average (std_t, absdif_t) and over 30-year monthly
+    #   average (stdm_t, absdifm_t). The climatology (annual and monthly mean/std) is computed once
+    #   and cached, then all the anomalies are written in a single pass over the temperature.
+    climatology_path = os.path.join(DATA_PROC, "ERA5_monthly_1991-2021_climatology.nc")
+    tempanom_path = os.path.join(DATA_PROC, "ERA5_monthly_1991-2021_tempanomalies.nc")
+    if os.path.exists(tempanom_path):
+        print("Temperature anomalies already computed. Skipping...")
     else:
-        print("Computing Abs diff temperature...")
-        temperature = xr.open_dataset(era5_path, chunks={"time": 12})
-        temperature = temperature.sel(time=slice("1991", "2021")) # Only last 30 years
-        climatology_mean = temperature["t2m"].mean(dim="time")
-        climatology_std = temperature["t2m"].std(dim="time")
-        absdiff_temp = xr.apply_ufunc(
-            lambda x, m: (x - m),
-            temperature["t2m"],
-            climatology_mean,
-            dask="parallelized",
-        )
-
-        encoding = {absdiff_temp.name: {"zlib": True, "complevel": 5}}
-        with ProgressBar():
-            absdiff_temp.to_netcdf(
-                absdiff_path,
-                encoding=encoding,
-            )
+        print("Computing temperature climatology...")
+        temperature = open_climate_store(era5_path, chunks=None)
+        temperature = temperature["t2m"].sel(time=slice("1991", "2021")) # Only last 30 years
+        climatology = load_climatology(temperature, climatology_path)
 
-    # Standardize temperature over 30-year monthly average
-    stdmtemp_path = os.path.join(DATA_PROC, "ERA5_monthly_1991-2021_stdmtemp.nc")
-    if os.path.exists(stdmtemp_path):
-        print("Standardized temperature monthly already computed. Skipping...")
-    else:
         print("Computing temperature anomalies...")
-        temperature = xr.open_dataset(era5_path, chunks={"time": -1, "lat": 500, "lon": 500})
-        temperature = temperature.sel(time=slice("1991", "2021")) # Only last 30 years
-        climatology_mean_m = temperature["t2m"].groupby("time.month").mean("time")
-        climatology_std_m = temperature["t2m"].groupby("time.month").std("time")
-        stand_anomalies = xr.apply_ufunc(
-            lambda x, m, s: (x - m) / s,
-            temperature["t2m"].groupby("time.month"),
-            climatology_mean_m,
-            climatology_std_m,
-            dask="parallelized",
-        )
-        encoding = {stand_anomalies.name: {"zlib": True, "complevel": 5}}
+        temperature = open_climate_store(era5_path, chunks={"time": -1, "lat": 500, "lon": 500})
+        temperature = temperature["t2m"].sel(time=slice("1991", "2021"))
+        anomalies = temperature_anomalies(temperature, climatology)
+        if PACK_OUTPUTS:
+            anomalies = clip_to_packing(anomalies)
+        encoding = output_encoding(anomalies, tempanom_path, codec=OUTPUT_CODEC, pack=PACK_OUTPUTS)
         with ProgressBar():
-            stand_anomalies.to_netcdf(
-                stdmtemp_path,
+            anomalies.to_netcdf(
+                tempanom_path,
                 encoding=encoding,
             )
 
-    absdiffm_path = os.path.join(DATA_PROC, "ERA5_monthly_1991-2021_absdiffmtemp.nc")
-    if os.path.exists(absdiffm_path):
-        print("Abs diff monthly temperature already computed. Skipping...")
-
-    else:
-        print("Computing monthly temperature anomalies...")
-        temperature = xr.open_dataset(era5_path, chunks={"time": -1, "lat": 500, "lon": 500})
-        temperature = temperature.sel(time=slice("1991", "2021")) # Only last 30 years
-        climatology_mean_m = temperature["t2m"].groupby("time.month").mean("time")
-        climatology_std_m = temperature["t2m"].groupby("time.month").std("time")
-        stand_anomalies = xr.apply_ufunc(
-            lambda x, m: (x - m),
-            temperature["t2m"].groupby("time.month"),
-            climatology_mean_m,
-            dask="parallelized",
-        )
-        encoding = {stand_anomalies.name: {"zlib": True, "complevel": 5}}
-        with ProgressBar():
-            stand_anomalies.to_netcdf(
-                absdiffm_path,
-                encoding=encoding,
+    ###########################
+    ####   Daily indices   ####
+    ###########################
+
+    # DAILY_INDICES computes the extreme-temperature counts (hd35, hd40, fd, id) and the warm/cold
+    #   spell days (wsdi, csdi) from the daily maximum/minimum temperature downloaded by
+    #   00b_query_ERA5_dialy.py, directly on the ERA5 grid (see daily_tools.py). The yearly archives
+    #   are ingested to daily Zarr stores and reduced to months one year at a time; reruns only
+    #   ingest and reduce the new years.
+    #   DAILY_MEMORY_BUDGET_GB caps the RAM used by the ingestion (the size of the blocks of days read)
+    #   and by the reduction (the size of the latitude bands read).
+    DAILY_INDICES = False
+    DAILY_MEMORY_BUDGET_GB = 4
+    ERA5_DAILY_DATA = r"C:\Datasets\ERA5 Reanalysis\dialy-single-levels"
+    daily_indices_path = os.path.join(DATA_PROC, "ERA5_daily_indices.zarr")
+    if DAILY_INDICES:
+        for statistic in DAILY_STATISTICS.values():
+            print(f"Ingesting ERA5 {statistic} data...")
+            ingest_archives(
+                f"{ERA5_DAILY_DATA}_{statistic}",
+                os.path.join(DATA_PROC, f"ERA5_{statistic}.zarr"),
+                time_chunk=DAILY_TIME_CHUNK,
+                memory_budget=DAILY_MEMORY_BUDGET_GB * 1e9,
             )
+        daily = open_daily_stores(DATA_PROC)
 
-    stand_temp = xr.open_dataset(stdtemp_path, chunks={"lat": 700, "lon": 700, "time": 120})
-    stand_temp = stand_temp.rename({"t2m": "std_t"})
+        print("Computing percentiles of the spell indices...")
+        thresholds_path = os.path.join(DATA_PROC, "ERA5_daily_1991-2020_percentiles.nc")
+        thresholds = load_spell_thresholds(daily, thresholds_path, (str(calibration_year_initial), str(calibration_year_final)))
 
-    absdiff_temp = xr.open_dataset(absdiff_path, chunks={"lat": 700, "lon": 700, "time": 120})
-    absdiff_temp = absdiff_temp.rename({"t2m": "absdif_t"})
+        print("Computing monthly indices from daily data...")
+        n_months = daily_indices(daily, thresholds, daily_indices_path, memory_budget=DAILY_MEMORY_BUDGET_GB * 1e9)
+        print(f"{n_months} months of daily indices saved at {daily_indices_path}")
 
-    absdiffm_temp = xr.open_dataset(absdiffm_path, chunks={"lat": 700, "lon": 700, "time": 120})
-    absdiffm_temp = absdiffm_temp.rename({"t2m": "absdifm_t"})
-
-    stand_mtemp = xr.open_dataset(stdmtemp_path, chunks={"lat": 700, "lon": 700, "time": 120})
-    stand_mtemp = stand_mtemp.rename({"t2m": "stdm_t"})
+    ########################
+    ####  Append years  ####
+    ########################
 
-    temperature = xr.open_dataset(era5_path, chunks={"lat": 700, "lon": 700, "time": 120}).sel(time=slice("1991", "2021"))
+    # INCREMENTAL appends the months downloaded since the last run (00_query_ERA5_data.py) to Zarr
+    #   copies of the processed ERA5 cube, the SPIs and the temperature anomalies, instead of rebuilding
+    #   the whole history. Only the new months are computed: the SPI gamma parameters and the
+    #   temperature climatology are fitted once over the calibration period and kept fixed, and each
+    #   SPI scale only needs the (scale - 1) months before the new ones.
+    #   Needs a full run first (the calibration period must already be in the data).
+    INCREMENTAL = False
+    if INCREMENTAL:
+        spi_store = os.path.join(DATA_PROC, "ERA5_monthly_spi.zarr")
+        tempanom_store = os.path.join(DATA_PROC, "ERA5_monthly_tempanomalies.zarr")
+        spi_params_path = os.path.join(DATA_PROC, "ERA5_monthly_spi_params.nc")
+
+        # Zarr copies of the full products (only the first time)
+        for path, store in [(spi_out, spi_store), (tempanom_path, tempanom_store)]:
+            if not os.path.exists(store):
+                print(f"Exporting {path} to Zarr store...")
+                with ProgressBar():
+                    export_climate_store(
+                        xr.open_dataset(path, chunks={}), store, time_chunk=INGEST_TIME_CHUNK, pack=PACK_OUTPUTS
+                    )
+
+        if not os.path.exists(spi_params_path):
+            print("Fitting SPI parameters...")
+            da_precip = open_climate_store(era5_path)["tp"].stack(point=("lat", "lon"))
+            da_precip = da_precip.chunk({"time": -1, "point": 100000})
+            params = spi_params(da_precip, SPI_SCALES, data_start_year, calibration_year_initial, calibration_year_final)
+            with ProgressBar():
+                params.unstack("point").to_netcdf(spi_params_path)
+
+        # Archives with months after the last one processed
+        n_new = ingest_archives(ERA5_DATA, era5_path)
+
+        if n_new == 0:
+            print("No new months to append.")
+        else:
+            print(f"Computing SPI and temperature anomalies of {n_new} new months...")
+            era5 = open_climate_store(era5_path)
+
+            # SPI of the new months, from their precipitation and the (max scale - 1) months before
+            params = xr.open_dataset(spi_params_path, chunks={}).stack(point=("lat", "lon"))
+            da_precip = era5["tp"].isel(time=slice(-(n_new + max(SPI_SCALES) - 1), None))
+            da_precip = da_precip.stack(point=("lat", "lon")).chunk({"time": -1, "point": 100000})
+            spis = spi_tail(da_precip, params, n_new).unstack("point")
+            with ProgressBar():
+                append_to_store(spis, spi_store)
+
+            # Temperature anomalies of the new months, against the same climatology (computed and
+            #   cached here if the anomalies store was built by a run that didn't write it)
+            climatology = load_climatology(era5["t2m"].sel(time=slice("1991", "2021")), climatology_path)
+            temperature = era5["t2m"].isel(time=slice(-n_new, None)).chunk({"time": -1, "lat": 500, "lon": 500})
+            anomalies = temperature_anomalies(temperature, climatology)
+            with ProgressBar():
+                append_to_store(anomalies, tempanom_store)
+            print(f"{n_new} new months appended!")
+
+        spi_out, tempanom_path = spi_store, tempanom_store
+
+    # From 1991 to the last month available (2021, or later if years were appended)
+    anomalies = open_climate_store(tempanom_path, chunks={"lat": 700, "lon": 700, "time": 120})
+
+    temperature = open_climate_store(era5_path, chunks={"lat": 700, "lon": 700, "time": 120}).sel(time=slice("1991", None))
     temperature = temperature.rename({"t2m": "t"})
 
-    spis = xr.open_dataset(spi_out, chunks={"lat": 700, "lon": 700, "time": 120}).sel(time=slice("1991", "2021"))
+    spis = open_climate_store(spi_out, chunks={"lat": 700, "lon": 700, "time": 120}).sel(time=slice("1991", None))
 
-    data_arrays = [spis, temperature["t"], stand_temp["std_t"], stand_mtemp["stdm_t"], absdiff_temp["absdif_t"], absdiffm_temp["absdifm_t"]]
+    data_arrays = [spis, temperature["t"], anomalies["std_t"], anomalies["stdm_t"], anomalies["absdif_t"], anomalies["absdifm_t"]]
 
 
     ########################
@@ -308,12 +326,21 @@ if __name__ == "__main__":
     climate_data = xr.combine_by_coords(data_arrays)
 
     out = rf"{DATA_PROC}/Climate_shocks_v9.nc"
-    encoding = {
-        var: {"zlib": True, "complevel": 6} for var in climate_data.data_vars
-    }
+    if PACK_OUTPUTS:
+        climate_data = clip_to_packing(climate_data)
+    encoding = output_encoding(climate_data, out, codec=OUTPUT_CODEC, pack=PACK_OUTPUTS)
     with ProgressBar():
         climate_data.to_netcdf(
             out,
             encoding=encoding,
         )
-    print(f"Data ready! file saved at {out}")
\ No newline at end of file
+    print(f"Data ready! file saved at {out}")
+
+    # Canonical store for the point assignment (02): full time axis and small lat/lon tiles,
+    #   so reading the series of a band of latitudes only decompresses the tiles it needs
+    EXPORT_ZARR = True
+    if EXPORT_ZARR:
+        store_out = rf"{DATA_PROC}/Climate_shocks_v9.zarr"
+        with ProgressBar():
+            export_climate_store(xr.open_dataset(out, chunks={}), store_out, pack=PACK_OUTPUTS)
+        print(f"Zarr store saved at {store_out}")
\ No newline at end of file
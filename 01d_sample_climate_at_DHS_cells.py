@@ -0,0 +1,62 @@
+if __name__ == "__main__":
+    import os
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
+    from dask.diagnostics import ProgressBar
+
+    from climate_store import open_climate_store
+    from cell_tools import dhs_cells, sample_cells, interpolate_cells, cells_table, write_cells_table
+
+    # Set global variables
+    PROJECT = r"C:\Working Papers\Paper - Child mortality and Climate Shocks"
+    OUTPUTS = rf"{PROJECT}\Outputs"
+    DATA = rf"{PROJECT}\Data"
+    DATA_IN = rf"{DATA}\Data_in"
+    DATA_PROC = rf"{DATA}\Data_proc"
+    DATA_OUT = rf"{DATA}\Data_out"
+
+    ########################
+    ####  Sparse cells  ####
+    ########################
+    # Stage 02 only reads the ERA5 cells with DHS clusters, so instead of interpolating the CCKP
+    #   indices to the whole ERA5 grid and combining global cubes (01b), the climate series are
+    #   computed only at those cells and stored in a compact (time, cell) table. 02 reads it with
+    #   USE_CELLS_TABLE = True.
+    ERA5_VARIABLES = ["spi1", "stdm_t", "absdifm_t"]
+    CCKP_VARIABLES = ["hd35", "hd40", "fd", "id"]
+
+    print("Loading data...")
+    era5 = open_climate_store(rf"{DATA_PROC}/Climate_shocks_v9.zarr")
+    dhs = pd.read_stata(rf"{DATA_IN}/DHS/DHSBirthsGlobalAnalysis_07272025.dta", columns=["LATNUM", "LONGNUM"])
+    cells = dhs_cells(era5, dhs["LATNUM"], dhs["LONGNUM"])
+    print(f"{len(cells)} cells with DHS clusters, of {era5.sizes['lat'] * era5.sizes['lon']} in the ERA5 grid")
+
+    # ERA5 variables: series of the cells, read from the store
+    datasets = [sample_cells(era5[ERA5_VARIABLES], cells)]
+
+    # Extreme-temperature counts: computed from the daily ERA5 data on the same grid if available
+    #   (DAILY_INDICES in 01_compute_climate_indices.py), otherwise the CCKP variables (0.5°)
+    #   are interpolated at the cell centers
+    daily_indices_path = rf"{DATA_PROC}/ERA5_daily_indices.zarr"
+    if os.path.exists(daily_indices_path):
+        print("Using the extreme-temperature indices computed from daily ERA5...")
+        daily_indices = open_climate_store(daily_indices_path)[CCKP_VARIABLES].sel(time=slice("1990-01-01", "2020-12-01"))
+        CCKP_VARIABLES = []
+        datasets += [sample_cells(daily_indices, cells)]
+    for var in CCKP_VARIABLES:
+        ds_var = xr.open_dataset(
+            rf"{DATA_IN}\Climate Data\timeseries-{var}-monthly-mean_era_monthly_era5-0.5x0.5-timeseries_mean_1950-2020.nc",
+            chunks={"time": 12})\
+            .sel(bnds=0, time=slice("1990-01-01", "2020-12-01"))\
+            .drop_vars("bnds")\
+            [f"timeseries-{var}-monthly-mean"].rename(var)
+        ds_var = (ds_var / np.timedelta64(1, 'D')).astype(int)
+        datasets += [interpolate_cells(ds_var, cells)]
+
+    table = cells_table(datasets, era5)
+
+    out = rf"{DATA_OUT}/Climate_shocks_v11_cells.zarr"
+    with ProgressBar():
+        write_cells_table(table, out)
+    print(f"Data ready! file saved at {out}")
@@ -1,12 +1,22 @@
 import os
 import gc
+import shutil
 import logging
 import xarray as xr
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from tqdm import tqdm  # for notebooks
-from numba import njit
+
+from grid_tools import climate_grid_index, grid_axis, grid_coords, cell_index, month_counter, month_dates, point_key
+from climate_store import export_climate_store, open_climate_store
+from cell_store import is_cell_store, write_cell_store
+from mmap_cube import is_mmap_cube, open_mmap_cube, export_mmap_cube
+from chunk_tools import (
+    MANIFEST_FILENAME, lat_row_costs, plan_lat_chunks, run_lat_chunks, consolidate_chunks, merge_chunks_with_dhs,
+    climate_file_version, config_hash, chunk_record, load_manifest, save_manifest, valid_manifest_chunks,
+)
+from shock_tools import load_timeframes, compile_timeframes, fuse_timeframes, death_month_index
 
 if __name__ == "__main__":
     tqdm.pandas()
@@ -26,7 +36,34 @@ if __name__ == "__main__":
     print("Loading data...")
 
     ### CLIMATE DATA
-    climate_data = xr.open_dataset(rf"{DATA_OUT}/Climate_shocks_v11.nc")
+    #   Every chunk reads the full series of a band of latitudes, so the NetCDF is exported once to
+    #   a Zarr store chunked as (full time, small lat/lon tiles). Set USE_ZARR_STORE = False to
+    #   read the NetCDF directly.
+    #   USE_CELLS_TABLE reads the (time, cell) table of the cells with DHS clusters built by
+    #   01d_sample_climate_at_DHS_cells.py instead of the global cube. With USE_CELL_STORE the table
+    #   is exported once to raw float32 rows per cell, and the series are read by offset through
+    #   memory maps (see cell_store.py).
+    USE_ZARR_STORE = True
+    USE_CELLS_TABLE = False
+    USE_CELL_STORE = False
+    CLIMATE_NC = rf"{DATA_OUT}/Climate_shocks_v11.nc"
+    CLIMATE_PATH = CLIMATE_NC
+    if USE_CELLS_TABLE:
+        CLIMATE_PATH = rf"{DATA_OUT}/Climate_shocks_v11_cells.zarr"
+        if USE_CELL_STORE:
+            CELLS_TABLE = CLIMATE_PATH
+            CLIMATE_PATH = rf"{DATA_OUT}/Climate_shocks_v11_cells.f32"
+            if not is_cell_store(CLIMATE_PATH) or os.path.getmtime(CELLS_TABLE) > os.path.getmtime(CLIMATE_PATH):
+                print("Exporting cells table to cell store...")
+                with open_climate_store(CELLS_TABLE) as cells_table:
+                    write_cell_store(cells_table, CLIMATE_PATH)
+    elif USE_ZARR_STORE:
+        CLIMATE_PATH = rf"{DATA_OUT}/Climate_shocks_v11.zarr"
+        if not os.path.exists(CLIMATE_PATH) or os.path.getmtime(CLIMATE_NC) > os.path.getmtime(CLIMATE_PATH):
+            print("Exporting climate data to Zarr store...")
+            with xr.open_dataset(CLIMATE_NC, chunks={}) as climate_nc:
+                export_climate_store(climate_nc, CLIMATE_PATH)
+    climate_data = open_climate_store(CLIMATE_PATH)
         
     ### DHS DATA
     full_dhs = pd.read_stata(rf"{DATA_IN}/DHS/DHSBirthsGlobalAnalysis_07272025.dta")
@@ -49,226 +86,85 @@ if __name__ == "__main__":
     climate_data = climate_data[climate_variables]
     ORDERED_CLIMATE_VARS = list(climate_data.data_vars)
 
-
-    def round_to_nearest_quarter(number):
-        """Rounds a number to the nearest 0.25 increment.
-
-        >>> round_to_nearest_quarter(1.3)
-        1.25
-        >>> round_to_nearest_quarter(1.62)
-        1.5
-        >>> round_to_nearest_quarter(3.9)
-        4.0
-        >>> round_to_nearest_quarter(2.05)
-        2.0
-        >>> round_to_nearest_quarter(5.78)
-        5.75
-        >>> round_to_nearest_quarter(3)
-        3.0
-        """
-        return round(number * 4) / 4
-            
-    # 1. Define timeframes as quarters. The value is the 0-based index of the *last month* of the quarter.
-    TIMEFRAMES_QUARTERLY = {
-        "inutero_1m3m": 2,
-        "inutero_3m6m": 5,
-        "inutero_6m9m": 8,
-        "born_1m3m": 11,
-        "born_3m6m": 14,
-        "born_6m9m": 17,
-        "born_9m12m": 20,
-    }
-    TIMEFRAMES_BIANNUALY = {
-        "inutero": 8,
-        "born_1m": 9,
-        "born_1m6m": 14,
-        "born_6m12m": 20,
-        "born_12m18m": 26,
-        "born_18m24m": 32,
-        "born_24m30m": 38,
-        "born_30m36m": 44,
-    }
-    TIMEFRAMES_IUFOCUS = {
-        "inutero_1m3m": 2,
-        "inutero_3m6m": 5,
-        "inutero_6m9m": 8,
-        "born_1m": 9,
-        "born_2m3m": 11,
-        "born_3m6m": 14,
-    }
-    TIMEFRAMES_MONTHS = {
-        "inutero_1m": 0,
-        "inutero_2m": 1,
-        "inutero_3m": 2,
-        "inutero_4m": 3,
-        "inutero_5m": 4,
-        "inutero_6m": 5,
-        "inutero_7m": 6,
-        "inutero_8m": 7,
-        "inutero_9m": 8,
-        "born_1m": 9,
-        "born_2m": 10,
-        "born_3m": 11,
-        "born_4m": 12,
-        "born_5m": 13,
-        "born_6m": 14,
-    }
-    ALL_TIMEFRAMES = {
-        "q": TIMEFRAMES_QUARTERLY,
-        "b": TIMEFRAMES_BIANNUALY,
-        "m": TIMEFRAMES_MONTHS,
-        "iu": TIMEFRAMES_IUFOCUS,
-    }
-
-    AVG_WINDOWS = {
-        "q": np.array([0], dtype=np.int32), # 0 means no window, -1 means max of the period, -2 means min of the period
-        "b": np.array([0, 1, 2, 3, 4, 5, 6, 7, 8, 9], dtype=np.int32),
-        "m": np.array([0], dtype=np.int32),
-        "iu": np.array([0], dtype=np.int32),
-    }    
-    
-    COLUMN_NAMES = {} # Dinamically populate this dict 
-    for timeframe_name, timeframe in ALL_TIMEFRAMES.items():
-        result_column_names = []
-        avg_windows = AVG_WINDOWS[timeframe_name] 
-        for timename in timeframe.keys():
-            for var in ORDERED_CLIMATE_VARS:
-                for window in avg_windows:
-                    if window==-1:
-                        stat="max"
-                    elif window==-2:
-                        stat="min"
-                    elif window==0:
-                        stat="avg"
-                    else:
-                        stat=f"w{window}"
-                    col_name = f"{var}_{timename}_{timeframe_name}_{stat}"
-                    result_column_names.append(col_name)
-        COLUMN_NAMES[timeframe_name] = result_column_names
-
-    @njit(parallel=True)
-    def _compute_stats(data_array, time_indices, window_sizes, death_month_index):
-        n_vars = data_array.shape[0]
-        n_indices = len(time_indices)
-        n_windows = len(window_sizes)
-        n_timesteps = data_array.shape[1]
-        results = np.empty((n_vars, n_indices, n_windows), dtype=np.float32)
-
-        for time_pos in range(n_indices):
-            end_idx = time_indices[time_pos]
-            if death_month_index != -1:
-                # Case 1: Death happened BEFORE this period even started.
-                # The entire period has irrelevant data, assign nan.
-                period_start = time_indices[time_pos-1] + 1 if time_pos > 0 else 0
-                if death_month_index < period_start:
-                    results[:, time_pos, :] = np.nan
-                    continue
-                
-                # Case 2: Death happened during or after this period.
-                # We must truncate the period's end to the death month.
-                # The min() function handles both situations:
-                # - If death is during the period (death_month_index < end_idx), end_idx becomes death_month_index.
-                # - If death is after the period (death_month_index >= end_idx), end_idx remains unchanged.
-                end_idx = min(end_idx, death_month_index)
-            
-            start_idx = time_indices[time_pos-1] + 1 if time_pos > 0 else 0
-
-            for var_pos in range(n_vars):
-                for window_pos in range(n_windows):
-                    window = window_sizes[window_pos]
-                    
-                    if (window == 0) | (window == -1) | (window == -2):
-                        # Window 0 is unbounded, -1 is max, -2 is min
-                        avg_start_idx = start_idx
-                    elif window > 0:
-                        # Average the previous {windows} months
-                        avg_start_idx = end_idx - window + 1
-                    else:
-                        raise ValueError(f"windows has to be 0 or positive!! window value: {window}")        
-                
-                    if avg_start_idx > end_idx or end_idx >= n_timesteps or avg_start_idx < 0:
-                        #   avg_start_idx > end_idx: This should never happen but is a safety check
-                        #   end_idx >= n_timesteps: This could happen if the data ingested is shorter that what is expected!
-                        #   avg_start_idx < 0 is an error: requiring a window larger than loaded data
-                        raise ValueError(f"There is some issue with the data ingested! debug: {avg_start_idx > end_idx}, {end_idx >= n_timesteps}, {avg_start_idx < 0} ")        
-
-                    avg_slice = data_array[var_pos, avg_start_idx : end_idx + 1]
-                    if avg_slice.size > 0:
-                        if window==-1:
-                            data_results = np.nanmax(avg_slice)
-                        elif window==-2:
-                            data_results = np.nanmin(avg_slice)
-                        else:
-                            data_results = np.nanmean(avg_slice)
-                        results[var_pos, time_pos, window_pos] = data_results
-                    else:
-                        results[var_pos, time_pos, window_pos] = np.nan
-        return results
-
+    # USE_MMAP_CUBE: the workers read the series from an uncompressed memory-mapped copy of the
+    #   climate variables (see mmap_cube.py) instead of loading a latitude band each. The pages
+    #   are shared between the processes, so the chunks are planned without the band in memory.
+    USE_MMAP_CUBE = False
+    WORKER_CLIMATE_PATH = CLIMATE_PATH
+    if USE_MMAP_CUBE and "cell" not in climate_data.dims:
+        WORKER_CLIMATE_PATH = rf"{DATA_OUT}/Climate_shocks_v11_cube.npy"
+        if not is_mmap_cube(WORKER_CLIMATE_PATH) or os.path.getmtime(CLIMATE_PATH) > os.path.getmtime(WORKER_CLIMATE_PATH)\
+                or open_mmap_cube(WORKER_CLIMATE_PATH)[1] != ORDERED_CLIMATE_VARS:
+            print("Exporting climate data to memory-mapped cube...")
+            export_mmap_cube(climate_data, WORKER_CLIMATE_PATH)
+
+
+    # Periods and windows of the stats (quarterly, biannual, monthly and in-utero focus), and the
+    #   names of their columns, come from timeframes.json (see shock_tools.compile_timeframes).
+    #   The workers get all their periods fused into one table, computed in a single kernel call
+    TIMEFRAMES_SPEC = load_timeframes()
+    TIMEFRAME_TABLE = fuse_timeframes(compile_timeframes(TIMEFRAMES_SPEC, ORDERED_CLIMATE_VARS))
+
+    # DEATH_TRUNCATED: also store the stats with the periods truncated at the month of death of the
+    #   child, as a parallel set of "{column}_dt" columns. Children of the same point who died in the
+    #   same month share their row, and the rows of a point share its series in the kernel. The
+    #   output then has a row per (point_ID, death_month_index), -1 for the children alive.
+    DEATH_TRUNCATED = False
 
     ### Process dataframe ####
     # Drop nans in date columns
     df = df.dropna(subset=["v008", "chb_year", "chb_month"], how="any")
 
-    # Create Birth datetime object from year and month
-    df["day"] = 1
-    df["month"] = df["chb_month"].astype(int)
-    df["year"] = df["chb_year"].astype(int)
-    df["birth_date"] = pd.to_datetime(df[["year", "month", "day"]]).to_numpy()
-    df = df.drop(columns=["day", "month", "year"])
+    # Dates are integer month counters (year * 12 + month - 1, see grid_tools.month_counter),
+    #   so shifting and comparing them is integer arithmetic on whole columns
+    df["birth_month"] = df["chb_year"].to_numpy(dtype=np.int64) * 12 + df["chb_month"].to_numpy(dtype=np.int64) - 1
+    df["birth_date"] = month_dates(df["birth_month"])
 
-    # Create Death datetime object from year and month
-    deads = df["child_death_ind"].astype(bool)
-    
     # Maximum range of dates
-    df["from_date"] = df["birth_date"] + pd.DateOffset(
-        months=-9
-    )  # From in utero (9 months before birth)
-    df["to_date"] = df["birth_date"] + pd.DateOffset(
-        months=11+12*2
-    )  # To the third year of life
-    # df["to_date"] = df[["to_date", "death_date"]].min(axis=1)  # If the child died, compute stats until death
+    df["from_month"] = df["birth_month"] - 9  # From in utero (9 months before birth)
+    df["to_month"] = df["birth_month"] + 11 + 12 * 2  # To the third year of life
 
     # Filter children from_date greater than 1991 (we only have climate data from 1990)
-    df = df[df["from_date"] > "1991-01-01"]
+    df = df[df["from_month"] > 1991 * 12]
 
     # Filter children to_date smalle than 2021 (we only have climate data to 2020)
-    df = df[df["to_date"] < "2021-01-01"]
+    df = df[df["to_month"] < 2021 * 12]
     
 
-    # Date of interview
-    df["year"] = 1900 + (df["v008"] - 1) // 12
-    df["month"] = df["v008"] - 12 * (df["year"] - 1900)
-    df["day"] = 1
-    df["interview_date"] = pd.to_datetime(df[["year", "month", "day"]], dayfirst=False)
-    df["interview_year"] = df["year"]
-    df["interview_month"] = df["month"]
-    df = df.drop(columns=["year", "month", "day"])
+    # Date of interview (v008 is a century month code: months since 1900, starting at 1)
+    v008 = df["v008"].to_numpy(dtype=np.int64)
+    df["interview_year"] = 1900 + (v008 - 1) // 12
+    df["interview_month"] = v008 - 12 * (df["interview_year"] - 1900)
+    interview_month = 1900 * 12 + v008 - 1
 
     # Number of days from interview
-    df["days_from_interview"] = df["interview_date"] - df["birth_date"]
+    days_from_interview = (month_dates(interview_month) - df["birth_date"].to_numpy()) // np.timedelta64(1, "D")
 
     # excluir del análisis a aquellos niños que nacieron 12 meses alrededor de la fecha de la encuesta y no más allá de 10 y 15 años del momento de la encuesta.
-    df["last_15_years"] = (df["days_from_interview"] > np.timedelta64(30, "D")) & (
-        df["days_from_interview"] < np.timedelta64(15 * 365, "D")
-    )
-    df["last_10_years"] = (df["days_from_interview"] > np.timedelta64(30, "D")) & (
-        df["days_from_interview"] < np.timedelta64(10 * 365, "D")
-    )
+    df["last_15_years"] = (days_from_interview > 30) & (days_from_interview < 15 * 365)
+    df["last_10_years"] = (days_from_interview > 30) & (days_from_interview < 10 * 365)
     df["since_2003"] = df["interview_year"] >= 2003
     df = df[df["last_15_years"]]
+
+    # Month of death in the 45-month series (birth is month 9), -1 for the children alive
+    if DEATH_TRUNCATED:
+        deads = df["child_death_ind"].astype(bool)
+        df["death_month_index"] = np.where(deads, death_month_index(df["child_agedeath"]), -1).astype(np.int32)
        
-    df["lat_round"] = df["LATNUM"].apply(lambda x: round_to_nearest_quarter(x))
-    df["lon_round"] = df["LONGNUM"].apply(lambda x: round_to_nearest_quarter(x))
-    df = df.sort_values(["lat_round", "lon_round", "from_date"]) 
-    df = df.dropna(subset=["ID", "from_date", "to_date", "lat_round", "lon_round"])
+    # Integer positions of each child in the ERA5 grid (-1 if the coordinates are missing)
+    #   and month offset of from_month from the start of the climate data.
+    df["lat_idx"], df["lon_idx"] = climate_grid_index(climate_data, df["LATNUM"], df["LONGNUM"])
+    df["time_idx"] = df["from_month"] - month_counter(climate_data.indexes["time"][:1])[0]
+    df = df[(df["lat_idx"] >= 0) & (df["lon_idx"] >= 0)]
+    lat_origin, lat_step, _ = grid_axis(climate_data, "lat")
+    lon_origin, lon_step, n_lon = grid_axis(climate_data, "lon")
+    df["lat_round"] = grid_coords(df["lat_idx"], lat_origin, lat_step)
+    df["lon_round"] = grid_coords(df["lon_idx"], lon_origin, lon_step)
+    df = df.sort_values(["lat_idx", "lon_idx", "from_month"]) 
+    df = df.dropna(subset=["ID"])
     
-    # Store in variable
-    df["point_ID"] = (
-        df["lat_round"].astype(str) + "_" + 
-        df["lon_round"].astype(str) + "_" + 
-        df["from_date"].dt.strftime(r"%Y-%m-%d") + "_"  
-    )
+    # Store in variable: children in the same cell with the same from_month share their climate data
+    df["point_ID"] = point_key(cell_index(df["lat_idx"], df["lon_idx"], n_lon), df["from_month"])
     
     # count unique points
     print("Number of unique points:", df["point_ID"].nunique())
@@ -279,143 +175,102 @@ if __name__ == "__main__":
     #### Run process ####
     # Chunking implementation: load a large array from the nc to keep the slicing fast! 
 
-    ## Clean up old files ####
     output_dir = os.path.join(DATA_PROC, "DHS_Climate")
-    # for file in os.listdir(output_dir):
-    #     if file.startswith("births_climate_"):
-    #         os.remove(os.path.join(output_dir, file))
-    # print("Old intermediate files removed!")
-
-    # --- TUNABLE PARAMETER --- Larger means more ram is used
-    LAT_CHUNK_SIZE = 20
-    
-    # Get a sorted list of unique latitudes to iterate over
-    unique_lats = np.sort(df["lat_round"].unique())
-    lat_chunks = [unique_lats[i:i + LAT_CHUNK_SIZE] for i in range(0, len(unique_lats), LAT_CHUNK_SIZE)]
 
-    for i, lat_slice in enumerate(lat_chunks):
-        chunk_filename = os.path.join(output_dir, f"births_climate_{i}.parquet")
-        # if os.path.exists(chunk_filename):
-        #     continue
+    # --- TUNABLE PARAMETER --- RAM (in GB) used by all the workers together.
+    #   None uses 70% of the available RAM. Chunk size and number of workers are derived from it.
+    MEMORY_BUDGET_GB = None
+    MAX_WORKERS = None
 
-        print(f"\n--- Processing Latitude Chunk {i+1}/{len(lat_chunks)} (lats: {lat_slice[0]} to {lat_slice[-1]}) ---")
-        
-        # PRE-LOAD CHUNK INTO MEMORY
-        climate_chunk = climate_data.sel(lat=lat_slice).load()
-        df_subset = df[df["lat_round"].isin(lat_slice)]
-        
-        # Group by point ID, which includes time of death
-        grouped = df_subset.groupby("point_ID")
-
-        chunk_results = []
-        for point_id, group in tqdm(grouped, desc=f"Processing groups in chunk {i+1}"):
-            
-            # All children in this group have the same climate data needs.
-            # We only need to get the parameters from the first row.
-            first_row = group.iloc[0]
-            lat, lon = first_row['lat_round'], first_row['lon_round']
-            from_date, to_date = first_row['from_date'], first_row['to_date']
-            # death_idx = first_row['death_month_index']
-            
-            # 3. Select from the IN-MEMORY climate_chunk. This is very fast.
-            point_data = climate_chunk.sel(
-                time=slice(from_date, to_date),
-                lat=lat,
-                lon=lon,
-            )
-            data_np = point_data.to_array().values.astype(np.float32)
-
-            # A list to hold the results from each timeframe configuration
-            result_dict = {}
-
-            # Loop over each timeframe configuration (quarterly, biannual, etc.)
-            for timeframe_name, timeframe_dict in ALL_TIMEFRAMES.items():
-                                    
-                # 1. Dynamically create the time indices for the current configuration
-                time_indices_np = np.array(list(timeframe_dict.values()), dtype=np.int32)
-             
-                # 2. Query the column names for the current configuration
-                result_column_names = []
-                avg_windows = AVG_WINDOWS[timeframe_name]
-                result_column_names = COLUMN_NAMES[timeframe_name]
-
-                # 3. Compute the stats for this configuration
-                stats_np = _compute_stats(data_np, time_indices_np, avg_windows, -1) 
-                #   I assign -1 because the anchored method was not doing ok.
-                #   Comparing a 1-month avg vs a 3-month avg means we assign a higher
-                #   weight on dead children because the variance of 1-month is much higher
-                
-                # 4. Directly update the main dictionary. This is much faster
-                # than creating a Series and concatenating later.
-                stats_np_flat = stats_np.transpose(1, 0, 2).ravel()
-                result_dict.update(dict(zip(result_column_names, stats_np_flat)))
-
-            # Combine the results from all timeframe configurations into a single Series
-            result_dict['lat'] = lat
-            result_dict['lon'] = lon
-            result_dict['point_ID'] = point_id
-            chunk_results.append(result_dict)
-                       
-        # Save intermediate file for this chunk
-        if chunk_results:
-            climate_results_chunk = pd.DataFrame(chunk_results)
-            climate_results_chunk.to_parquet(chunk_filename)
-            print(f"Chunk {i+1} saved to {chunk_filename}")
-
-        # 4. FREE UP MEMORY before loading the next chunk
-        del climate_chunk, df_subset, grouped, chunk_results, climate_results_chunk
-        gc.collect()
-        # print("Memory freed for next chunk.")
+    # All children with the same point_ID have the same climate data needs,
+    #   so we only need the parameters from the first row of each point.
+    points = df.drop_duplicates("point_ID")[
+        ["point_ID", "lat_round", "lon_round", "lat_idx", "lon_idx", "time_idx"]
+    ]
+    # Children who died within their series, grouped by (point_ID, month of death)
+    death_groups = None
+    if DEATH_TRUNCATED:
+        death_groups = df.loc[df["death_month_index"] >= 0, ["point_ID", "lat_idx", "death_month_index"]]
+        death_groups = death_groups.drop_duplicates(["point_ID", "death_month_index"])
+        print("Number of death groups:", len(death_groups))
+
+    ## Only recompute the chunks invalidated since the last run ####
+    #   (new points in its latitude rows, new climate file or new timeframe configuration)
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    climate_version = climate_file_version(CLIMATE_PATH)
+    config = config_hash(ORDERED_CLIMATE_VARS, TIMEFRAMES_SPEC, DEATH_TRUNCATED)
+    manifest = load_manifest(manifest_path)
+    manifest["chunks"] = valid_manifest_chunks(manifest, points, output_dir, climate_version, config, death_groups)
+    save_manifest(manifest, manifest_path)
+    done_rows = [row for record in manifest["chunks"] for row in record["lat_rows"]]
+    print(f"{len(manifest['chunks'])} chunks already computed and up to date.")
+
+    n_columns = len(TIMEFRAME_TABLE["columns"]) * (2 if DEATH_TRUNCATED else 1)
+    row_costs = lat_row_costs(
+        climate_data, points["lat_idx"].value_counts(), n_columns, memory_mapped=WORKER_CLIMATE_PATH != CLIMATE_PATH
+    )
+    row_costs = row_costs.drop(done_rows)
+    if len(row_costs) > 0:
+        memory_budget = MEMORY_BUDGET_GB * 1e9 if MEMORY_BUDGET_GB is not None else None
+        lat_chunks, n_workers = plan_lat_chunks(row_costs, memory_budget, MAX_WORKERS)
+        print(f"Processing {len(lat_chunks)} latitude chunks with {n_workers} workers...")
+
+        tasks, records = [], []
+        for lat_slice in lat_chunks:
+            chunk_points = points[points["lat_idx"].isin(lat_slice)]
+            chunk_deaths = None if death_groups is None else death_groups[death_groups["lat_idx"].isin(lat_slice)]
+            record = chunk_record(lat_slice, chunk_points, climate_version, config, chunk_deaths)
+            records.append(record)
+            tasks.append(dict(
+                climate_path=WORKER_CLIMATE_PATH,
+                climate_variables=ORDERED_CLIMATE_VARS,
+                lat_rows=lat_slice,
+                points=chunk_points,
+                timeframe_table=TIMEFRAME_TABLE,
+                chunk_filename=os.path.join(output_dir, record["file"]),
+                death_groups=chunk_deaths,
+            ))
+
+        # Register each chunk as soon as it is saved, so an interrupted run can be resumed
+        def register_chunk(task_index, filename):
+            manifest["chunks"].append(records[task_index])
+            save_manifest(manifest, manifest_path)
+
+        run_lat_chunks(tasks, n_workers, on_chunk_done=register_chunk)
+        del tasks
+    del points, death_groups
+    gc.collect()
     
     print("\n--- All chunks processed. Consolidating results... ---")
 
-    # Recontruct the chuncked dataframe    
-    files = os.listdir(rf"{DATA_PROC}/DHS_Climate")
-    files = [f for f in files if f.startswith("births_climate_")]
-    data = []
-    for file in tqdm(files):
-        df_chunk = pd.read_parquet(rf"{DATA_PROC}/DHS_Climate/{file}")
-        data += [df_chunk]
-    df = pd.concat(data)
-    data = None
-    del data
-    df.to_parquet(f"{DATA_PROC}/DHS_Climate/births_climate.parquet")
-    print("File saved at", f"{DATA_PROC}/DHS_Climate/births_climate.parquet")
-    climate_cols = df.columns
-    df.to_parquet(rf"{DATA_PROC}/DHS_Climate_not_assigned.parquet")
-    gc.collect()
+    # Recontruct the chuncked dataframe, streaming the chunks without loading them all in memory
+    files = [os.path.join(output_dir, record["file"]) for record in manifest["chunks"]]
+    climate_path = os.path.join(output_dir, "births_climate.parquet")
+    consolidate_chunks(files, climate_path)
+    print("File saved at", climate_path)
+    # Same frame, kept for the scripts that read the not-assigned climate data
+    shutil.copyfile(climate_path, rf"{DATA_PROC}/DHS_Climate_not_assigned.parquet")
     
-    ####### Process data:
-    df = full_dhs.merge(df, on="point_ID", how="inner")
-    print("Number of observations merged with climate data:", df.shape[0])
-
-    ####### Export data:
-    df = df[
-        climate_cols.to_list()
-        + [
-            "ID",
-            "interview_year",
-            "interview_month",
-            "birth_date",
-            "last_15_years",
-            "last_10_years",
-            "since_2003",
-        ]
+    ####### Process data and export:
+    #   Only the merge key and the columns exported are kept from the DHS data
+    export_cols = [
+        "ID",
+        "interview_year",
+        "interview_month",
+        "birth_date",
+        "last_15_years",
+        "last_10_years",
+        "since_2003",
     ]
-
-    # Cast everything in float64 to float32
-    float64_cols = df.select_dtypes(include=["float64"]).columns
-    if len(float64_cols) > 0:
-        print(f"Converting float64 to float32: {float64_cols}")
-        df[float64_cols] = df[float64_cols].astype("float32")
-
-    # Drop nans in spi/temp values
-    all_shock_cols = [
-       col for sublist in COLUMN_NAMES.values() for col in sublist
-    ]
-    shock_cols = [col for col in all_shock_cols if col in df.columns]
-    # df = df.dropna(subset=shock_cols, how="any")
-    df.to_parquet(rf"{DATA_PROC}\ClimateShocks_assigned_v11_full.parquet")
+    merge_key = ["point_ID", "death_month_index"] if DEATH_TRUNCATED else ["point_ID"]
+    full_dhs = full_dhs[merge_key + export_cols]
+    gc.collect()
+    n_merged = merge_chunks_with_dhs(
+        climate_path, full_dhs, rf"{DATA_PROC}\ClimateShocks_assigned_v11_full.parquet", on=merge_key
+    )
+    print("Number of observations merged with climate data:", n_merged)
+    # Columns are climate_cols + export_cols, float64 columns are cast to float32.
+    #   NaNs in spi/temp values are kept (the dropna on the stats columns is disabled).
 
     # float16_cols = df.select_dtypes(include=["float16"]).columns
     # if len(float16_cols) > 0:
@@ -8,6 +8,9 @@ from tqdm import tqdm
 import pyarrow.feather as feather
 import pyarrow.parquet as pq
 
+from grid_tools import ERA5_RESOLUTION, to_grid_index, cell_index
+from shock_tools import load_timeframes, timeframe_periods, timeframe_stats
+
 # Stata globals → Python Path objects
 PROJECT = r"C:\Working Papers\Paper - Child mortality and Climate Shocks"
 OUTPUTS = rf"{PROJECT}\Outputs"
@@ -78,27 +81,13 @@ print(births.shape[0])
 # ---------- 3.  Climate-shock feature engineering ----------
 print("Creating variables...")
 climate_list  = ["absdifm_t", "stdm_t", "spi1", "hd35", "hd40", "fd", "id"]
-time_list = [
-    # TIMEFRAMES_QUARTERLY
-    "inutero_1m3m", "inutero_3m6m", "inutero_6m9m",
-    "born_1m3m"   , "born_3m6m"   , "born_6m9m", "born_9m12m", 
-    # TIMEFRAMES_BIANNUALY
-    "inutero", "born_1m6m", "born_6m12m", 
-    "born_12m18m", "born_18m24m", "born_24m30m", "born_30m36m",     
-    # TIMEFRAMES_IUFOCUS
-    "born_1m", "born_2m3m",
-    # TIMEFRAMES_MONTHLY
-    "inutero_1m","inutero_2m","inutero_3m",
-    "inutero_4m","inutero_5m","inutero_6m",
-    "inutero_7m","inutero_8m","inutero_9m",
-    "born_2m","born_3m","born_4m","born_5m","born_6m",
-]
-stats_list = [
-    "q_min", "q_max", "q_avg", 
-    "m_avg", 
-    "iu_max", "iu_min", "iu_avg", 
-    "b_max", "b_min", "b_avg", "b_w1", "b_w2", "b_w3", "b_w4", "b_w5", "b_w6", "b_w7", "b_w8", "b_w9"
-]
+# Periods and "{timeframe}_{stat}" suffixes of the columns computed in 02, in the "merge_order" of
+#   timeframes.json (the column order of the merged data). 02 computes no max/min windows (-1/-2),
+#   so the q_min, q_max, iu_min, iu_max, b_min and b_max columns are not created: add those windows
+#   to the spec to compute and merge them.
+timeframes_spec = load_timeframes()
+time_list = timeframe_periods(timeframes_spec)
+stats_list = timeframe_stats(timeframes_spec)
 
 # This will try all the combinations between stat and time_list and create the available vars
 newcols = {}
@@ -193,7 +182,6 @@ for ind in heterogeneity_indexes:
 births.loc[births["Vulnerability Index"]>=25.02, "high_vulnerability"] = 1
 births.loc[births["Vulnerability Index"]<25.02, "high_vulnerability"] = 0
 
-X|   
 # ---------- 4.  Child age-at-death dummies (per 1 000 births) ----------
 bins_labels = {
     "quarterly": {
@@ -231,25 +219,20 @@ for bin_name, data in bins_labels.items():
 # ---------- 5.  Location & household controls ----------
 print("Creating location and time fixed effects...")
 ## 0.25° (original), 0.5° and 1° aggregations
-# For 0.25°, we use the coordinates straight from the ERA5 cell where we extract climate data
-births["lat_climate_1"] = births["lat"]            # 0.1°
-births["lon_climate_1"] = births["lon"]
-
-# For 0.5° onwards, we group based on the DHS original coordinates (cell would work too...)
+# Cells are the integer positions of the DHS original coordinates in a regular grid of each resolution.
+#   For 0.25° this is the same ERA5 cell where we extract climate data in 02_assign_shocks_to_DHS.py
+#   Longitudes are not wrapped: as with rounding the coordinates, points at -180 and 180 are
+#   different cells (each row has n_lon + 1 positions, from -180 to 180).
 lat, lon = births["LATNUM"], births["LONGNUM"]
-
-births["lat_climate_2"] = np.round(lat * 2) / 2    # 0.5°
-births["lon_climate_2"] = np.round(lon * 2) / 2
-
-births["lat_climate_3"] = np.round(lat)            # 1°
-births["lon_climate_3"] = np.round(lon)
-
-# births["lat_climate_5"] = births["lat_climate_4"] - (births["lat_climate_4"] % 2)  # 2°
-# births["lon_climate_5"] = births["lon_climate_4"] - (births["lon_climate_4"] % 2)
-
-# Factorise to integer IDs
-for j in range(1, 4):
-    births[f"ID_cell{j}"] = births.groupby([f'lat_climate_{j}', f'lon_climate_{j}'], sort=False).ngroup()
+for j, step in enumerate([ERA5_RESOLUTION, 0.5, 1], start=1):
+    n_lon = int(360 / step)
+    lat_idx = to_grid_index(lat, -90, step)
+    lon_idx = to_grid_index(lon, -180, step)
+    cells = pd.Series(cell_index(lat_idx, lon_idx, n_lon + 1), index=births.index)
+    # Factorise to integer IDs (in order of appearance, as groupby(sort=False).ngroup() does).
+    #   Missing coordinates have a nan ID, not a shared cell
+    codes = pd.factorize(cells.where(cells >= 0), use_na_sentinel=True)[0]
+    births[f"ID_cell{j}"] = np.where(codes >= 0, codes, np.nan)
 
 # Country numeric code (Stata: encode code_iso3)
 births["ID_country"] = births.groupby("code_iso3", sort=False).ngroup()
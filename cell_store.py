@@ -0,0 +1,149 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from grid_tools import cell_index
+
+# Compact (cell, time) store of the climate series of the DHS cells.
+#   A folder with one raw float32 file per variable, where each cell is a contiguous row of
+#   n_time values, an index of the cells (cells.npz: cell ids sorted, their lat/lon positions and
+#   the time axis) and meta.json (variables, shape and the grid axes, see grid_tools.grid_attrs).
+#   The series of a point is then the n_months values starting at offset
+#   position * n_time + time_idx of each file, read through np.memmap without decoding anything.
+#   meta.json is written last, so a store without it is incomplete.
+
+CELL_STORE_META = "meta.json"
+CELL_STORE_INDEX = "cells.npz"
+CELL_STORE_DTYPE = np.float32
+# Cells converted at once when writing the store
+CELL_STORE_BLOCK = 1024
+
+
+def is_cell_store(path):
+    """Whether path is a complete store written by write_cell_store."""
+    return os.path.isfile(os.path.join(path, CELL_STORE_META))
+
+
+def write_cell_store(table, path, block=CELL_STORE_BLOCK):
+    """Writes a cells table (see cell_tools.cells_table) as a cell store, streaming blocks of cells.
+
+    Args:
+        table (xr.Dataset): (time, cell) table with "lat_idx"/"lon_idx" coordinates and the grid
+            attributes.
+        path (str): folder of the store, overwritten if it exists.
+        block (int): number of cells read from the table at once.
+    """
+    os.makedirs(path, exist_ok=True)
+    if is_cell_store(path):
+        os.remove(os.path.join(path, CELL_STORE_META))
+
+    n_cells = table.sizes["cell"]
+    variables = list(table.data_vars)
+    for var in variables:
+        with open(os.path.join(path, f"{var}.f32"), "wb") as file:
+            for start in range(0, n_cells, block):
+                rows = table[var].isel(cell=slice(start, start + block)).transpose("cell", "time")
+                rows.values.astype(CELL_STORE_DTYPE).tofile(file)
+
+    np.savez(
+        os.path.join(path, CELL_STORE_INDEX),
+        cell=table["cell"].values.astype(np.int64),
+        lat_idx=table["lat_idx"].values.astype(np.int64),
+        lon_idx=table["lon_idx"].values.astype(np.int64),
+        time=table["time"].values.astype("datetime64[ns]"),
+    )
+    meta = {
+        "variables": variables,
+        "n_cells": int(n_cells),
+        "n_time": int(table.sizes["time"]),
+        "dtype": np.dtype(CELL_STORE_DTYPE).str,
+        **table.attrs,
+    }
+    with open(os.path.join(path, CELL_STORE_META), "w") as file:
+        json.dump(meta, file, indent=2)
+
+
+def open_cell_store(path):
+    """Opens a cell store as read-only memory maps.
+
+    Returns:
+        dict: "meta" (contents of meta.json), the arrays of the index ("cell", "lat_idx",
+            "lon_idx" and "time") and "variables", a dict of (n_cells, n_time) np.memmap.
+    """
+    if not is_cell_store(path):
+        raise FileNotFoundError(f"{path} is not a complete cell store, write it with write_cell_store!")
+    with open(os.path.join(path, CELL_STORE_META)) as file:
+        meta = json.load(file)
+    with np.load(os.path.join(path, CELL_STORE_INDEX)) as index:
+        store = {name: index[name] for name in index.files}
+    store["meta"] = meta
+    shape = (meta["n_cells"], meta["n_time"])
+    store["variables"] = {
+        var: np.memmap(os.path.join(path, f"{var}.f32"), dtype=meta["dtype"], mode="r", shape=shape)
+        for var in meta["variables"]
+    }
+    return store
+
+
+def cell_store_dataset(store):
+    """The memory maps of a cell store as an (unloaded) xr.Dataset, with the coordinates of a cells table.
+
+    The "memory_mapped" attribute tells chunk_tools.lat_row_costs that nothing is loaded per chunk.
+    """
+    meta = store["meta"]
+    attrs = {key: value for key, value in meta.items() if key not in ["variables", "n_cells", "n_time", "dtype"]}
+    attrs["memory_mapped"] = 1
+    return xr.Dataset(
+        {var: (("cell", "time"), values) for var, values in store["variables"].items()},
+        coords={
+            "cell": store["cell"],
+            "lat_idx": ("cell", store["lat_idx"]),
+            "lon_idx": ("cell", store["lon_idx"]),
+            "time": pd.DatetimeIndex(store["time"]),
+        },
+        attrs=attrs,
+    )
+
+
+def cell_positions(cells, n_lon, lat_idx, lon_idx):
+    """Position in a sorted array of cell ids of the cell of each (lat_idx, lon_idx).
+
+    Raises:
+        ValueError: if a cell is missing (rebuild the table/store with the current DHS data).
+    """
+    wanted = cell_index(lat_idx, lon_idx, n_lon)
+    positions = np.minimum(np.searchsorted(cells, wanted), cells.size - 1)
+    missing = cells[positions] != wanted
+    if missing.any():
+        raise ValueError(f"{missing.sum()} points fall in cells missing from the cells table, rebuild it!")
+    return positions
+
+
+def cell_store_windows(store, variables, positions, time_idx, n_months):
+    """Reads the series of many points straight from the memory maps of a cell store.
+
+    Args:
+        store (dict): output of open_cell_store.
+        variables (list): variables to read, in the order of the output.
+        positions (np.ndarray): position of the cell of each point (see cell_positions).
+        time_idx (np.ndarray): position of the first month of each point in the time axis.
+        n_months (int): length of the series of each point.
+
+    Returns:
+        np.ndarray: float32 array of shape (n_points, n_vars, n_months), as shock_tools.gather_windows.
+    """
+    n_time = store["meta"]["n_time"]
+    positions = np.asarray(positions, dtype=np.intp)
+    time_idx = np.asarray(time_idx, dtype=np.intp)
+    if (time_idx < 0).any() or (time_idx + n_months > n_time).any():
+        raise ValueError("Some points require climate data outside the time range loaded!")
+
+    offsets = (positions * n_time + time_idx)[:, None] + np.arange(n_months)
+    windows = np.empty((positions.size, len(variables), n_months), dtype=np.float32)
+    for var_pos, var in enumerate(variables):
+        flat = store["variables"][var].reshape(-1)
+        windows[:, var_pos, :] = flat[offsets]
+    return windows
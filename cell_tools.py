@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from grid_tools import climate_grid_index, grid_attrs, grid_coords, regular_axis, cell_index
+from regrid_tools import point_weights, regrid_points
+from climate_store import is_zarr, output_encoding, STORE_CODEC
+from cell_store import cell_positions
+
+# Climate series only at the grid cells with DHS clusters.
+#   Stage 02 reads a few thousand cells of the global 0.25° grid, so instead of regridding and
+#   storing global cubes the climate data can be sampled at those cells into a compact
+#   (time, cell) table: ERA5 variables are read at the cells with pointwise indexing, and the
+#   CCKP variables are interpolated at the cell centers with sparse bilinear weights. The table
+#   keeps the grid axes as attributes, so DHS coordinates are indexed as with the full grid.
+
+# Cells per chunk of the table (the whole time axis is in every chunk)
+CELL_CHUNK = 1024
+
+
+def dhs_cells(grid, lat, lon):
+    """Unique cells of a regular grid that contain the DHS coordinates.
+
+    Args:
+        grid (xr.Dataset): gridded climate data (only its lat/lon coordinates are used).
+        lat, lon (array-like): coordinates of the DHS clusters, e.g. df["LATNUM"] and df["LONGNUM"].
+
+    Returns:
+        pd.DataFrame: "cell" (see grid_tools.cell_index), "lat_idx", "lon_idx", "lat" and "lon"
+            of each cell, sorted by cell.
+    """
+    lat_idx, lon_idx = climate_grid_index(grid, lat, lon)
+    lat_origin, lat_step, _ = regular_axis(grid["lat"])
+    lon_origin, lon_step, n_lon = regular_axis(grid["lon"])
+    cells = pd.DataFrame({"lat_idx": lat_idx, "lon_idx": lon_idx})
+    cells = cells[(cells["lat_idx"] >= 0) & (cells["lon_idx"] >= 0)].drop_duplicates()
+    cells["cell"] = cell_index(cells["lat_idx"], cells["lon_idx"], n_lon)
+    cells["lat"] = grid_coords(cells["lat_idx"], lat_origin, lat_step)
+    cells["lon"] = grid_coords(cells["lon_idx"], lon_origin, lon_step)
+    return cells.sort_values("cell")[["cell", "lat_idx", "lon_idx", "lat", "lon"]].reset_index(drop=True)
+
+
+def cell_coords(cells):
+    """Coordinates of the "cell" dimension of a cells table."""
+    return {
+        "cell": ("cell", cells["cell"].to_numpy(dtype=np.int64)),
+        "lat": ("cell", cells["lat"].to_numpy(dtype=np.float64)),
+        "lon": ("cell", cells["lon"].to_numpy(dtype=np.float64)),
+        "lat_idx": ("cell", cells["lat_idx"].to_numpy(dtype=np.int64)),
+        "lon_idx": ("cell", cells["lon_idx"].to_numpy(dtype=np.int64)),
+    }
+
+
+def sample_cells(ds, cells):
+    """Reads the series of the cells of the same grid as ds (pointwise indexing, lazy).
+
+    Returns:
+        xr.Dataset: variables of ds with a "cell" dimension instead of lat/lon.
+    """
+    sampled = ds.isel(
+        lat=xr.DataArray(cells["lat_idx"].to_numpy(), dims="cell"),
+        lon=xr.DataArray(cells["lon_idx"].to_numpy(), dims="cell"),
+    )
+    return sampled.drop_vars(["lat", "lon"]).assign_coords(cell_coords(cells))
+
+
+def interpolate_cells(ds, cells):
+    """Bilinear interpolation of ds (on any regular grid) at the cell centers (lazy).
+
+    Returns:
+        xr.Dataset: variables of ds with a "cell" dimension instead of lat/lon.
+    """
+    weights = point_weights(ds["lat"].values, ds["lon"].values, cells["lat"].to_numpy(), cells["lon"].to_numpy())
+    return regrid_points(ds, weights).assign_coords(cell_coords(cells))
+
+
+def cells_table(datasets, grid):
+    """Merges (time, cell) datasets into a cells table, with the axes of the grid as attributes.
+
+    Args:
+        datasets (list): outputs of sample_cells/interpolate_cells, all with the same cells.
+        grid (xr.Dataset): the grid the cells belong to.
+
+    Returns:
+        xr.Dataset: (time, cell) table. Timesteps missing in a dataset are nan.
+    """
+    table = xr.merge(datasets, join="outer", compat="override")
+    table = table.transpose("time", "cell", ...)
+    table.attrs = grid_attrs(grid)
+    return table
+
+
+def write_cells_table(table, path, codec=STORE_CODEC, cell_chunk=CELL_CHUNK):
+    """Writes a cells table (Zarr store if path ends in .zarr, otherwise NetCDF4), time-contiguous chunks."""
+    chunks = {"time": table.sizes["time"], "cell": min(cell_chunk, table.sizes["cell"])}
+    table = table.chunk(chunks)
+    for var in table.data_vars:
+        table[var].encoding = {}
+    encoding = output_encoding(table, path, codec=codec, chunks=chunks)
+    if is_zarr(path):
+        table.to_zarr(path, mode="w", encoding=encoding, consolidated=True)
+    else:
+        table.to_netcdf(path, encoding=encoding, engine="netcdf4")
+
+
+def table_cell_positions(table, lat_idx, lon_idx):
+    """Position in the table of the cell of each (lat_idx, lon_idx) (see cell_store.cell_positions)."""
+    return cell_positions(table["cell"].values, int(table.attrs["n_lon"]), lat_idx, lon_idx)
@@ -0,0 +1,456 @@
+import os
+import gc
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numba
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as pds
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+from shock_tools import N_MONTHS, gather_windows, compute_stats_table
+from climate_store import open_climate_store, store_version
+from cell_tools import table_cell_positions
+from cell_store import is_cell_store, open_cell_store, cell_positions, cell_store_windows
+from mmap_cube import is_mmap_cube, open_mmap_cube, mmap_cube_windows
+
+# Latitude-chunk scheduler for 02_assign_shocks_to_DHS.py.
+#   Each chunk loads a band of latitude rows of the climate data into RAM, so the chunk size
+#   and the number of chunks processed at the same time are derived from a memory budget
+#   instead of a hand-tuned number of latitudes.
+
+# Fraction of the available RAM used when no memory budget is given
+DEFAULT_MEMORY_FRACTION = 0.7
+
+# The manifest lists the chunk files of the current run and what they were computed from
+MANIFEST_FILENAME = "births_climate_manifest.json"
+
+
+def available_memory():
+    """Available RAM in bytes (psutil if installed, otherwise read from the OS)."""
+    try:
+        import psutil
+
+        return psutil.virtual_memory().available
+    except ImportError:
+        # POSIX only. Install psutil on Windows!
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def lat_row_costs(climate_data, points_per_lat, n_columns, memory_mapped=False):
+    """Estimated peak bytes used to process each latitude row.
+
+    Args:
+        climate_data (xr.Dataset): climate variables used in the assignment (a grid, a cells table or a cell store).
+        points_per_lat (pd.Series): number of unique point_IDs in each latitude row (index is the row).
+        n_columns (int): number of stats columns computed for each point.
+        memory_mapped (bool): whether the workers read the series from a memory-mapped copy of the
+            climate data (see mmap_cube.py), so no band is loaded.
+
+    Returns:
+        pd.Series: bytes per latitude row, same index as points_per_lat.
+    """
+    n_vars = len(climate_data.data_vars)
+    itemsize = max(climate_data[var].dtype.itemsize for var in climate_data.data_vars)
+    if memory_mapped or climate_data.attrs.get("memory_mapped"):
+        # Cube or cell store: the series are read from the memory maps, no band is loaded
+        cells_per_lat = 0
+    elif "cell" in climate_data.dims:
+        # Cells table: only the cells of the row are loaded
+        cells_per_lat = climate_data["lat_idx"].to_series().value_counts()
+        cells_per_lat = cells_per_lat.reindex(points_per_lat.index, fill_value=0)
+    else:
+        cells_per_lat = climate_data.sizes["lon"]
+    # The loaded band is copied once more when stacked with .to_array()
+    climate_bytes = 2 * n_vars * climate_data.sizes["time"] * cells_per_lat * itemsize
+    # Gathered series + stats matrix + the DataFrame built from it
+    point_bytes = n_vars * N_MONTHS * 4 + 2 * n_columns * 4
+    return climate_bytes + points_per_lat * point_bytes
+
+
+def plan_lat_chunks(row_costs, memory_budget=None, max_workers=None):
+    """Splits the latitude rows into chunks that fit the memory budget.
+
+    The number of workers is the largest one (up to the number of CPUs) for which the most
+    expensive latitude row still fits in each worker's share of the budget. Rows are then
+    packed in order into chunks of at most that share.
+
+    Args:
+        row_costs (pd.Series): bytes needed by each latitude row, indexed by row (see lat_row_costs).
+        memory_budget (float, optional): bytes available for all the workers. Defaults to
+            DEFAULT_MEMORY_FRACTION of the available RAM.
+        max_workers (int, optional): upper bound on the number of workers.
+
+    Returns:
+        tuple: list of arrays of latitude rows (one per chunk) and number of workers.
+    """
+    if memory_budget is None:
+        memory_budget = DEFAULT_MEMORY_FRACTION * available_memory()
+    row_costs = row_costs.sort_index()
+
+    n_workers = min(os.cpu_count() or 1, max_workers or np.inf, len(row_costs))
+    n_workers = int(max(1, min(n_workers, memory_budget // row_costs.max())))
+    # Make at least n_workers chunks when everything would fit in fewer, so no worker sits idle
+    worker_budget = min(memory_budget / n_workers, max(row_costs.sum() / n_workers, row_costs.max()))
+    if row_costs.max() > memory_budget / n_workers:
+        print(
+            f"Warning: a single latitude row needs {row_costs.max() / 1e9:.1f}GB, "
+            f"more than the memory budget of {memory_budget / 1e9:.1f}GB!"
+        )
+
+    lat_chunks, chunk, chunk_cost = [], [], 0
+    for row, cost in row_costs.items():
+        if chunk and chunk_cost + cost > worker_budget:
+            lat_chunks.append(np.array(chunk))
+            chunk, chunk_cost = [], 0
+        chunk.append(row)
+        chunk_cost += cost
+    if chunk:
+        lat_chunks.append(np.array(chunk))
+
+    n_workers = min(n_workers, len(lat_chunks))
+    return lat_chunks, n_workers
+
+
+def process_lat_chunk(
+    climate_path, climate_variables, lat_rows, points, timeframe_table, chunk_filename, death_groups=None, n_threads=None
+):
+    """Computes and saves the climate stats of all the points in a band of latitude rows.
+
+    Runs in a worker process, so it opens the climate data itself and returns only the filename.
+
+    Args:
+        climate_path (str): path to the climate dataset (a grid, a cells table, a cell store or a
+            memory-mapped .npy cube, see cell_tools.py, cell_store.py and mmap_cube.py).
+        climate_variables (list): climate variables to use, in the order of the columns.
+        lat_rows (np.ndarray): sorted latitude rows (integer positions) of the chunk.
+        points (pd.DataFrame): unique points of the chunk, with "point_ID", "lat_round", "lon_round",
+            "lat_idx", "lon_idx" and "time_idx" columns.
+        timeframe_table (dict): periods of all the timeframe configurations, fused into a single table
+            (see shock_tools.fuse_timeframes).
+        chunk_filename (str): parquet file where the results are stored.
+        death_groups (pd.DataFrame, optional): "point_ID" and "death_month_index" (see
+            shock_tools.death_month_index) of the children of the chunk who died within their series,
+            one row per (point, month of death). If given, the stats truncated at the month of death
+            are stored as a parallel set of "{column}_dt" columns, with a row per point and month of
+            death, plus the untruncated row of every point (death_month_index -1).
+        n_threads (int, optional): numba threads to use in this worker.
+
+    Returns:
+        str: chunk_filename, or None if the chunk has no points.
+    """
+    if n_threads is not None:
+        numba.set_num_threads(n_threads)
+
+    time_idx = points["time_idx"].to_numpy()
+    if is_cell_store(climate_path):
+        # Cell store: each series is read at its offset in the memory maps, nothing else is loaded
+        store = open_cell_store(climate_path)
+        positions = cell_positions(
+            store["cell"], int(store["meta"]["n_lon"]), points["lat_idx"].to_numpy(), points["lon_idx"].to_numpy()
+        )
+        windows = cell_store_windows(store, climate_variables, positions, time_idx, N_MONTHS)
+        del store
+    elif is_mmap_cube(climate_path):
+        # Memory-mapped cube: the pages are shared between the workers, no band is copied
+        cube, cube_variables = open_mmap_cube(climate_path)
+        windows = mmap_cube_windows(
+            cube, cube_variables, climate_variables,
+            points["lat_idx"].to_numpy(), points["lon_idx"].to_numpy(), time_idx, N_MONTHS,
+        )
+        del cube
+    else:
+        # PRE-LOAD CHUNK INTO MEMORY
+        #   With the canonical store (full time axis, small lat/lon tiles) only the tiles of these rows are read
+        with open_climate_store(climate_path) as climate_data:
+            if "cell" in climate_data.dims:
+                # Cells table: load only the cells of the points, as a (time, cell, 1) cube
+                positions = table_cell_positions(climate_data, points["lat_idx"].to_numpy(), points["lon_idx"].to_numpy())
+                chunk_cells, lat_idx = np.unique(positions, return_inverse=True)
+                lon_idx = np.zeros_like(lat_idx)
+                climate_chunk = climate_data[climate_variables].isel(cell=chunk_cells).load()
+                cube = climate_chunk.to_array().transpose("variable", "time", "cell").values[..., np.newaxis]
+            else:
+                climate_chunk = climate_data[climate_variables].isel(lat=lat_rows).load()
+                cube = climate_chunk.to_array().transpose("variable", "time", "lat", "lon").values
+                # Every point is already resolved to integer (lat, lon, time) positions in the global grid,
+                #   we only need to map the lat rows to their position in the chunk
+                lat_idx = np.searchsorted(lat_rows, points["lat_idx"].to_numpy())
+                lon_idx = points["lon_idx"].to_numpy()
+        del climate_chunk
+
+        # Gather the (n_points, n_vars, 45) series of all the points with fancy indexing
+        windows = gather_windows(cube, lat_idx, lon_idx, time_idx)
+        del cube
+
+    # Rows of the output: one per point with death_month_index -1, plus one per point and month of
+    #   death in the death-truncated mode, sorted by point so that each series is read once
+    n_points = len(points)
+    row_points = np.arange(n_points)
+    row_deaths = np.full(n_points, -1, dtype=np.int32)
+    if death_groups is not None:
+        row_points = np.concatenate([row_points, pd.Index(points["point_ID"]).get_indexer(death_groups["point_ID"])])
+        row_deaths = np.concatenate([row_deaths, death_groups["death_month_index"].to_numpy(dtype=np.int32)])
+        order = np.lexsort((row_deaths, row_points))
+        row_points, row_deaths = row_points[order], row_deaths[order]
+    row_offsets = np.searchsorted(row_points, np.arange(n_points + 1))
+
+    # Compute the stats of all the timeframe configurations (quarterly, biannual, etc.) over all the
+    #   rows in a single call, written straight into one (n_rows, n_columns) matrix.
+    #   The main columns use -1 as death_month_index because the anchored method was not doing ok.
+    #   Comparing a 1-month avg vs a 3-month avg means we assign a higher
+    #   weight on dead children because the variance of 1-month is much higher
+    chunk_results = compute_stats_table(
+        windows, timeframe_table["starts"], timeframe_table["ends"], timeframe_table["window_offsets"],
+        timeframe_table["windows"], row_offsets, row_deaths,
+    )
+    if death_groups is None:
+        climate_results_chunk = pd.DataFrame(chunk_results, columns=timeframe_table["columns"], copy=False)
+    else:
+        # The first row of each point is its untruncated one
+        climate_results_chunk = pd.concat([
+            pd.DataFrame(chunk_results[row_offsets[row_points]], columns=timeframe_table["columns"], copy=False),
+            pd.DataFrame(chunk_results, columns=[f"{col}_dt" for col in timeframe_table["columns"]], copy=False),
+        ], axis=1)
+
+    climate_results_chunk["lat"] = points["lat_round"].to_numpy()[row_points]
+    climate_results_chunk["lon"] = points["lon_round"].to_numpy()[row_points]
+    climate_results_chunk["point_ID"] = points["point_ID"].to_numpy()[row_points]
+    if death_groups is not None:
+        climate_results_chunk["death_month_index"] = row_deaths
+
+    # Save intermediate file for this chunk
+    if climate_results_chunk.empty:
+        return None
+    climate_results_chunk.to_parquet(chunk_filename)
+
+    # FREE UP MEMORY before the worker gets the next chunk
+    del windows, chunk_results, climate_results_chunk
+    gc.collect()
+    return chunk_filename
+
+
+def run_lat_chunks(tasks, n_workers, on_chunk_done=None):
+    """Runs process_lat_chunk over a list of tasks (dicts of kwargs) in a pool of n_workers processes.
+
+    Args:
+        tasks (list): kwargs of process_lat_chunk for each chunk.
+        n_workers (int): number of worker processes.
+        on_chunk_done (callable, optional): called as on_chunk_done(task_index, filename) as soon as
+            each chunk is saved, e.g. to register it in the manifest.
+
+    Returns:
+        list: filenames of the chunks saved.
+    """
+    # Share the CPUs between the workers, numba would use all of them in each process otherwise
+    n_threads = max(1, (os.cpu_count() or 1) // n_workers)
+    saved = []
+    if n_workers == 1:
+        for i, task in enumerate(tqdm(tasks, desc="Processing latitude chunks")):
+            filename = process_lat_chunk(**task)
+            saved.append(filename)
+            if on_chunk_done is not None and filename is not None:
+                on_chunk_done(i, filename)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {
+                executor.submit(process_lat_chunk, **task, n_threads=n_threads): i for i, task in enumerate(tasks)
+            }
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Processing latitude chunks"):
+                filename = future.result()
+                saved.append(filename)
+                if on_chunk_done is not None and filename is not None:
+                    on_chunk_done(futures[future], filename)
+    return [filename for filename in saved if filename is not None]
+
+
+#### Manifest ####
+# Chunks are only recomputed when what they depend on changes: the points in their latitude rows,
+#   the climate file or the timeframe configuration. Consolidation reads exactly the chunks listed
+#   in the manifest, so stale files from earlier runs are never picked up.
+
+def _sha1(*parts):
+    sha = hashlib.sha1()
+    for part in parts:
+        sha.update(part if isinstance(part, bytes) else str(part).encode())
+    return sha.hexdigest()
+
+
+def climate_file_version(path):
+    """Version of the climate file or Zarr store: name, size and modification time."""
+    return store_version(path)
+
+
+def config_hash(climate_variables, spec, death_truncated=False):
+    """Hash of the climate variables, timeframe spec (see shock_tools.load_timeframes) and mode used to compute the stats."""
+    config = {
+        "climate_variables": list(climate_variables),
+        "timeframes": {name: timeframe["periods"] for name, timeframe in spec["timeframes"].items()},
+        "avg_windows": {name: list(timeframe["windows"]) for name, timeframe in spec["timeframes"].items()},
+    }
+    if death_truncated:
+        config["death_truncated"] = True
+    return _sha1(json.dumps(config, sort_keys=True, default=int))
+
+
+def chunk_input_hash(lat_rows, points, death_groups=None):
+    """Hash of the latitude rows of a chunk, of the points (point_ID and grid positions) and of the death groups in them."""
+    points = points[["point_ID", "lat_idx", "lon_idx", "time_idx"]].sort_values("point_ID")
+    points_hash = pd.util.hash_pandas_object(points, index=False).to_numpy()
+    hashes = [np.asarray(lat_rows, dtype=np.int64).tobytes(), points_hash.tobytes()]
+    if death_groups is not None:
+        death_groups = death_groups[["point_ID", "death_month_index"]].sort_values(["point_ID", "death_month_index"])
+        hashes.append(pd.util.hash_pandas_object(death_groups, index=False).to_numpy().tobytes())
+    return _sha1(*hashes)
+
+
+def chunk_record(lat_rows, points, climate_version, config, death_groups=None):
+    """Manifest entry of a chunk. Its filename depends on everything the chunk is computed from."""
+    input_hash = chunk_input_hash(lat_rows, points, death_groups)
+    return {
+        "file": f"births_climate_{_sha1(input_hash, climate_version, config)[:16]}.parquet",
+        "lat_rows": np.asarray(lat_rows).tolist(),
+        "input_hash": input_hash,
+        "climate_version": climate_version,
+        "config_hash": config,
+        "n_points": int(len(points)),
+    }
+
+
+def load_manifest(path):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {"chunks": []}
+
+
+def save_manifest(manifest, path):
+    # Write to a temporary file first, so an interrupted run never leaves a broken manifest
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def valid_manifest_chunks(manifest, points, output_dir, climate_version, config, death_groups=None):
+    """Manifest entries that are still valid for the current points, climate file and configuration.
+
+    The files of the invalidated entries are removed.
+
+    Args:
+        manifest (dict): manifest loaded with load_manifest.
+        points (pd.DataFrame): unique points of the current run (see process_lat_chunk).
+        output_dir (str): folder of the chunk files.
+        climate_version (str): see climate_file_version.
+        config (str): see config_hash.
+        death_groups (pd.DataFrame, optional): death groups of the current run, with a "lat_idx"
+            column (see process_lat_chunk).
+
+    Returns:
+        list: valid manifest entries.
+    """
+    valid = []
+    for record in manifest["chunks"]:
+        filename = os.path.join(output_dir, record["file"])
+        is_valid = (
+            record["climate_version"] == climate_version
+            and record["config_hash"] == config
+            and os.path.exists(filename)
+            and record["input_hash"] == chunk_input_hash(
+                record["lat_rows"],
+                points[points["lat_idx"].isin(record["lat_rows"])],
+                None if death_groups is None else death_groups[death_groups["lat_idx"].isin(record["lat_rows"])],
+            )
+        )
+        if is_valid:
+            valid.append(record)
+        elif os.path.exists(filename):
+            os.remove(filename)
+    return valid
+
+
+#### Consolidation ####
+# Chunks are streamed as record batches, so at most one batch of the wide climate table is
+#   held in memory at any time instead of the whole concatenated frame.
+
+# Rows per record batch. Each row has a few hundred float32 columns.
+CONSOLIDATION_BATCH_ROWS = 50_000
+
+
+def consolidate_chunks(files, out_path, batch_rows=CONSOLIDATION_BATCH_ROWS):
+    """Concatenates the chunk files into a single parquet file, one record batch at a time.
+
+    Args:
+        files (list): paths of the chunk parquet files.
+        out_path (str): path of the consolidated parquet file.
+        batch_rows (int): rows per record batch.
+
+    Returns:
+        list: column names of the consolidated file.
+
+    Raises:
+        ValueError: if there are no chunk files (the manifest has no computed chunks).
+    """
+    if len(files) == 0:
+        raise ValueError("There are no chunk files to consolidate, the manifest has no computed chunks!")
+    dataset = pds.dataset(files, format="parquet")
+    with pq.ParquetWriter(out_path, dataset.schema) as writer:
+        for batch in dataset.to_batches(batch_size=batch_rows):
+            writer.write_batch(batch)
+    return dataset.schema.names
+
+
+def merge_chunks_with_dhs(climate_path, dhs, out_path, on="point_ID", batch_rows=CONSOLIDATION_BATCH_ROWS):
+    """Inner-merges the consolidated climate stats with the DHS births, one record batch at a time.
+
+    Every key lives in a single row of the climate file, so merging each batch separately
+    gives the same rows as merging the whole table. float64 columns are stored as float32.
+    If nothing merges, the file is still written, empty but with the columns of the merge.
+
+    Args:
+        climate_path (str): consolidated parquet file (see consolidate_chunks).
+        dhs (pd.DataFrame): births, with the merge key and the columns to keep.
+        out_path (str): path of the merged parquet file.
+        on (str or list): merge key, ["point_ID", "death_month_index"] in the death-truncated mode.
+        batch_rows (int): rows per record batch.
+
+    Returns:
+        int: number of observations merged with climate data.
+    """
+    dataset = pds.dataset(climate_path, format="parquet")
+    dhs = dhs.set_index(on)
+    n_merged = 0
+    writer = None
+    try:
+        for batch in dataset.to_batches(batch_size=batch_rows):
+            climate = batch.to_pandas()
+            df = climate.merge(dhs, left_on=on, right_index=True, how="inner")
+            if df.empty:
+                continue
+
+            table = _merged_table(df)
+            if writer is None:
+                writer = pq.ParquetWriter(out_path, table.schema)
+            writer.write_table(table.cast(writer.schema))
+            n_merged += len(df)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is None:
+        # No observation merged: write the empty frame, so that readers get the columns and no rows
+        climate = dataset.schema.empty_table().to_pandas()
+        df = climate.merge(dhs.iloc[:0], left_on=on, right_index=True, how="inner")
+        pq.write_table(_merged_table(df), out_path)
+    return n_merged
+
+
+def _merged_table(df):
+    """Arrow table of a merged frame, with everything in float64 cast to float32."""
+    float64_cols = df.select_dtypes(include=["float64"]).columns
+    df[float64_cols] = df[float64_cols].astype("float32")
+    return pa.Table.from_pandas(df, preserve_index=False)
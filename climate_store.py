@@ -0,0 +1,315 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from cell_store import is_cell_store, open_cell_store, cell_store_dataset
+
+# Storage of the climate cubes.
+#   Stage 02 reads each point's full series, one band of latitudes at a time, so the canonical
+#   store keeps the whole time axis in every chunk and splits lat/lon in small tiles: a lat-band
+#   read only decompresses the tiles of those rows. Zarr stores (.zarr) have consolidated metadata,
+#   so opening them is a single read. NetCDF4 files get the same chunk layout.
+
+# Tile size (in cells) of the lat/lon axes. Chunks are (time, STORE_LAT_TILE, STORE_LON_TILE).
+STORE_LAT_TILE = 8
+STORE_LON_TILE = 32
+
+# Compression.
+#   "zlib" is what the NetCDF outputs always used. It compresses well but is slow to decode.
+#   The blosc codecs split the bytes of each float (shuffle) before compressing, and lz4 decodes
+#   several times faster. Run benchmark_codecs on a sample of the data to compare them.
+#   NetCDF4 files need a netCDF4/HDF5 build with the zstd and blosc filters for anything but zlib,
+#   and some builds of the HDF5 blosc filter fail on chunks that don't compress: prefer zstd there.
+CODECS = ["zlib", "zstd", "blosc-lz4", "blosc-zstd", "none"]
+CODEC_LEVELS = {"zlib": 5, "zstd": 3, "blosc-lz4": 5, "blosc-zstd": 3, "none": 0}
+STORE_CODEC = "blosc-lz4"
+
+# Scale-offset packing to int16 (CF scale_factor/add_offset, unpacked by xarray on read).
+#   Values are clipped to a fixed range per variable, mapped to the 65535 int16 levels (-32768 is
+#   the missing value). The largest error is half the step, (max - min) / 65534 / 2:
+#     - spi*:               [-3.09, 3.09] -> 4.7e-5 SPI units (SPIs are already clipped there)
+#     - std_t, stdm_t:      [-15, 15]     -> 2.3e-4 standard deviations
+#     - absdif_t, absdifm_t: [-40, 40]    -> 6.1e-4 °C
+#   Variables not listed here are never packed.
+PACKING_RANGES = {
+    "spi": (-3.09, 3.09),
+    "std_t": (-15.0, 15.0),
+    "stdm_t": (-15.0, 15.0),
+    "absdif_t": (-40.0, 40.0),
+    "absdifm_t": (-40.0, 40.0),
+}
+PACKED_FILL_VALUE = np.int16(-32768)
+
+
+def is_zarr(path):
+    return os.path.normpath(path).endswith(".zarr")
+
+
+def store_chunks(ds, lat_tile=STORE_LAT_TILE, lon_tile=STORE_LON_TILE, time_chunk=None):
+    """Chunk sizes of the canonical layout: full time axis and small lat/lon tiles.
+
+    time_chunk sets a longer time chunk than the data, for stores that grow by appending (zarr
+    fills the chunk as timesteps are appended).
+    """
+    return {
+        "time": max(time_chunk or 0, ds.sizes["time"]),
+        "lat": min(lat_tile, ds.sizes["lat"]),
+        "lon": min(lon_tile, ds.sizes["lon"]),
+    }
+
+
+def packing_range(var):
+    """(min, max) used to pack a variable to int16, None if it's not packed."""
+    if var.startswith("spi") and var[3:].isdigit():
+        return PACKING_RANGES["spi"]
+    return PACKING_RANGES.get(var)
+
+
+def packing_encoding(var):
+    """int16 scale-offset encoding of a variable, None if it's not packed (see PACKING_RANGES)."""
+    value_range = packing_range(var)
+    if value_range is None:
+        return None
+    low, high = value_range
+    return {
+        "dtype": "int16",
+        "scale_factor": (high - low) / 65534,
+        "add_offset": (high + low) / 2,
+        "_FillValue": PACKED_FILL_VALUE,
+    }
+
+
+def clip_to_packing(ds):
+    """Clips the packed variables of ds to their packing range, so that they don't overflow int16."""
+    ds = ds.copy()
+    for var in ds.data_vars:
+        value_range = packing_range(var)
+        if value_range is not None:
+            ds[var] = ds[var].clip(*value_range)
+    return ds
+
+
+def codec_encoding(codec, zarr_store, level=None):
+    """Compression settings of a codec (see CODECS) for a Zarr store or a NetCDF4 file."""
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec: {codec}. Use one of {CODECS}.")
+    level = CODEC_LEVELS[codec] if level is None else level
+
+    if not zarr_store:
+        if codec == "none":
+            return {"zlib": False}
+        if codec == "zlib":
+            return {"zlib": True, "complevel": level, "shuffle": True}
+        if codec == "zstd":
+            return {"compression": "zstd", "complevel": level, "shuffle": True}
+        return {"compression": codec.replace("-", "_"), "complevel": level, "blosc_shuffle": 1}
+
+    import zarr
+
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        from zarr.codecs import BloscCodec, GzipCodec, ZstdCodec
+
+        compressors = {
+            "zlib": lambda: GzipCodec(level=level),
+            "zstd": lambda: ZstdCodec(level=level),
+            "blosc-lz4": lambda: BloscCodec(cname="lz4", clevel=level, shuffle="shuffle"),
+            "blosc-zstd": lambda: BloscCodec(cname="zstd", clevel=level, shuffle="shuffle"),
+        }
+        return {"compressors": [compressors[codec]()] if codec != "none" else None}
+
+    import numcodecs
+
+    compressors = {
+        "zlib": lambda: numcodecs.Zlib(level=level),
+        "zstd": lambda: numcodecs.Zstd(level=level),
+        "blosc-lz4": lambda: numcodecs.Blosc(cname="lz4", clevel=level, shuffle=numcodecs.Blosc.SHUFFLE),
+        "blosc-zstd": lambda: numcodecs.Blosc(cname="zstd", clevel=level, shuffle=numcodecs.Blosc.SHUFFLE),
+    }
+    return {"compressor": compressors[codec]() if codec != "none" else None}
+
+
+def output_encoding(ds, path, codec=STORE_CODEC, pack=False, chunks=None):
+    """Encoding of every variable of ds for a climate output (Zarr store or NetCDF4 file).
+
+    Args:
+        codec (str): compression, see CODECS.
+        pack (bool): pack the variables listed in PACKING_RANGES to int16. Clip them first with clip_to_packing.
+        chunks (dict, optional): chunk size of each dimension.
+    """
+    encoding = {}
+    for var in ds.data_vars:
+        var_encoding = codec_encoding(codec, is_zarr(path))
+        if pack and packing_encoding(var) is not None:
+            var_encoding.update(packing_encoding(var))
+        if chunks is not None:
+            var_chunks = tuple(chunks.get(dim, ds.sizes[dim]) for dim in ds[var].dims)
+            var_encoding["chunks" if is_zarr(path) else "chunksizes"] = var_chunks
+        encoding[var] = var_encoding
+    return encoding
+
+
+def export_climate_store(
+    ds, path, lat_tile=STORE_LAT_TILE, lon_tile=STORE_LON_TILE, time_chunk=None, codec=STORE_CODEC, pack=False
+):
+    """Writes a (time, lat, lon) climate dataset with the point-timeseries chunk layout.
+
+    Args:
+        ds (xr.Dataset): climate variables with "time", "lat" and "lon" dimensions.
+        path (str): output path. A ".zarr" path writes a Zarr store with consolidated metadata,
+            anything else a chunked NetCDF4 file.
+        lat_tile, lon_tile (int): chunk size of the lat/lon axes.
+        time_chunk (int, optional): chunk size of the time axis, if longer than the data (Zarr only).
+        codec (str): compression, see CODECS.
+        pack (bool): pack the SPI and anomaly variables to int16, see PACKING_RANGES.
+    """
+    chunks = store_chunks(ds, lat_tile, lon_tile, time_chunk if is_zarr(path) else None)
+    ds = ds.transpose("time", "lat", "lon", ...).chunk(store_chunks(ds, lat_tile, lon_tile))
+    if pack:
+        ds = clip_to_packing(ds)
+    for var in ds.data_vars:
+        # Drop the encoding inherited from the source file (its chunking, compression, etc.)
+        ds[var].encoding = {}
+    encoding = output_encoding(ds, path, codec=codec, pack=pack, chunks=chunks)
+
+    if is_zarr(path):
+        ds.to_zarr(path, mode="w", encoding=encoding, consolidated=True)
+    else:
+        ds.to_netcdf(path, encoding=encoding, engine="netcdf4")
+
+
+def open_climate_store(path, **kwargs):
+    """Opens a climate store written by export_climate_store (or any NetCDF file, or a cell store)."""
+    if is_cell_store(path):
+        return cell_store_dataset(open_cell_store(path))
+    if is_zarr(path):
+        return xr.open_zarr(path, consolidated=True, **kwargs)
+    return xr.open_dataset(path, **kwargs)
+
+
+def store_version(path):
+    """Name, size and modification time of a store, to detect when it was rewritten.
+
+    A Zarr store is a folder, so its size and time are those of its newest top-level entry.
+    """
+    if os.path.isdir(path):
+        entries = [os.stat(os.path.join(path, name)) for name in os.listdir(path)]
+        size = sum(entry.st_size for entry in entries)
+        mtime = max((entry.st_mtime_ns for entry in entries), default=os.stat(path).st_mtime_ns)
+    else:
+        stat = os.stat(path)
+        size, mtime = stat.st_size, stat.st_mtime_ns
+    return f"{os.path.basename(os.path.normpath(path))}:{size}:{mtime}"
+
+
+def store_last_time(path):
+    """Last timestep of a climate store, or None if it doesn't exist."""
+    if not os.path.exists(path):
+        return None
+    with open_climate_store(path) as ds:
+        return ds.indexes["time"][-1]
+
+
+def append_to_store(ds, path, lat_tile=STORE_LAT_TILE, lon_tile=STORE_LON_TILE, time_chunk=None, codec=STORE_CODEC, pack=False):
+    """Appends to a Zarr climate store the timesteps of ds after its last one.
+
+    The store is created with export_climate_store (with time_chunk, codec and pack) if it doesn't exist.
+
+    Returns:
+        int: number of timesteps appended.
+    """
+    if not is_zarr(path):
+        raise ValueError(f"Only Zarr stores can be appended to, got {path}")
+    last_time = store_last_time(path)
+    if last_time is not None:
+        ds = ds.sel(time=ds["time"] > last_time)
+    n_new = ds.sizes["time"]
+    if n_new == 0:
+        return 0
+    if last_time is None:
+        export_climate_store(ds, path, lat_tile, lon_tile, time_chunk, codec=codec, pack=pack)
+        return n_new
+
+    # New timesteps go in a single dask chunk, zarr splits them in the store's chunks. They are
+    #   written with the encoding of the store (codec and packing), packed variables are clipped.
+    chunks = store_chunks(ds, lat_tile, lon_tile)
+    ds = ds.transpose("time", "lat", "lon", ...).chunk(chunks)
+    with open_climate_store(path) as store:
+        if any(np.dtype(store[var].encoding.get("dtype", "f4")) == np.int16 for var in ds.data_vars if var in store):
+            ds = clip_to_packing(ds)
+    for var in ds.data_vars:
+        ds[var].encoding = {}
+    ds.to_zarr(path, mode="a", append_dim="time", consolidated=True)
+    return n_new
+
+
+def _store_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+    return os.path.getsize(path)
+
+
+def benchmark_codecs(ds, folder, codecs=CODECS, pack_options=(False, True), band_rows=STORE_LAT_TILE, n_bands=10, seed=0):
+    """Size against lat-band read throughput of each codec and packing option.
+
+    Every combination is written as a Zarr store in folder, then n_bands random bands of
+    band_rows latitudes (all longitudes and timesteps, as stage 02 reads them) are read back.
+
+    Args:
+        ds (xr.Dataset): sample of the climate data, e.g. a few degrees of latitude of the full cube.
+        folder (str): where the test stores are written (they are kept, delete them after).
+
+    Returns:
+        pd.DataFrame: codec, packed, size_mb, ratio (to the uncompressed float32 size), write_s,
+            read_mb_s (uncompressed MB per second) and max_error (largest absolute difference
+            against ds, from packing).
+    """
+    ds = ds.transpose("time", "lat", "lon", ...).astype(np.float32).load()
+    raw_mb = ds.nbytes / 1e6
+    rng = np.random.default_rng(seed)
+    starts = rng.integers(0, max(ds.sizes["lat"] - band_rows, 0) + 1, size=n_bands)
+
+    results = []
+    for codec in codecs:
+        for pack in pack_options:
+            path = os.path.join(folder, f"benchmark_{codec}{'_int16' if pack else ''}.zarr")
+            start_time = time.perf_counter()
+            export_climate_store(ds, path, codec=codec, pack=pack)
+            write_s = time.perf_counter() - start_time
+
+            read_mb = 0
+            start_time = time.perf_counter()
+            with open_climate_store(path, chunks=None) as store:
+                for start in starts:
+                    band = store.isel(lat=slice(start, start + band_rows)).load()
+                    read_mb += sum(band[var].size * 4 for var in band.data_vars) / 1e6
+            read_s = time.perf_counter() - start_time
+
+            with open_climate_store(path) as store:
+                max_error = max(float(np.nanmax(np.abs(store[var].values - ds[var].values))) for var in ds.data_vars)
+            size_mb = _store_size(path) / 1e6
+            results += [
+                {
+                    "codec": codec,
+                    "packed": pack,
+                    "size_mb": size_mb,
+                    "ratio": raw_mb / size_mb,
+                    "write_s": write_s,
+                    "read_mb_s": read_mb / read_s,
+                    "max_error": max_error,
+                }
+            ]
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    # Benchmark on a band of the climate data: python climate_store.py <climate file> <output folder> [lat_min lat_max]
+    import sys
+
+    climate_path, folder = sys.argv[1], sys.argv[2]
+    lat_min, lat_max = (float(x) for x in sys.argv[3:5]) if len(sys.argv) > 4 else (-10, 10)
+    with open_climate_store(climate_path) as climate_data:
+        sample = climate_data.sel(lat=slice(lat_min, lat_max))
+        print(benchmark_codecs(sample, folder).to_string(index=False))
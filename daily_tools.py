@@ -0,0 +1,332 @@
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from tqdm import tqdm
+
+from climate_store import STORE_LAT_TILE, open_climate_store, append_to_store, store_last_time
+from era5_ingest import INGEST_TIME_CHUNK
+
+# Monthly extreme-temperature indices from the daily ERA5 statistics (00b_query_ERA5_dialy.py).
+#   The CCKP counts (hd35, hd40, fd and id) come at 0.5° and have to be interpolated to the ERA5
+#   grid (01b). Computing them from the daily ERA5 maximum/minimum temperature puts them directly
+#   on the grid of the other climate variables. The daily cubes are ingested to Zarr stores (see
+#   era5_ingest.py) and reduced to months one year and one band of latitudes at a time, with
+#   accumulators allocated once and sized to a memory budget (see daily_indices):
+#   - Threshold indices count the days of each month above/below a fixed temperature.
+#   - Spell indices count the days of each month in runs of at least SPELL_MIN_DAYS days above
+#     (below) a calendar-day percentile of the calibration period, as the ETCCDI WSDI/CSDI. The
+#     length of the current run of each cell is carried from one day to the next (and from one
+#     year to the next), so the days of a spell are counted in the month where the spell reaches
+#     SPELL_MIN_DAYS days and then in the month of each further day. The runs at the start of the
+#     last year appended are saved next to the monthly store, so a rerun resumes the spells that
+#     cross into that year.
+
+# index: (daily variable, comparison, threshold in °C)
+THRESHOLD_INDICES = {
+    "hd35": ("tmax", ">", 35.0),
+    "hd40": ("tmax", ">", 40.0),
+    "fd": ("tmin", "<", 0.0),
+    "id": ("tmax", "<", 0.0),
+}
+# index: (daily variable, comparison, percentile of the calibration period)
+SPELL_INDICES = {
+    "wsdi": ("tmax", ">", 90),
+    "csdi": ("tmin", "<", 10),
+}
+SPELL_MIN_DAYS = 6
+# Days around each calendar day pooled to compute its percentiles (ETCCDI uses 5)
+PERCENTILE_WINDOW = 5
+# Latitude rows read at once when computing the percentiles
+PERCENTILE_BLOCK = 4
+# Daily statistics of 00b_query_ERA5_dialy.py used for each daily variable
+DAILY_STATISTICS = {"tmax": "daily_maximum", "tmin": "daily_minimum"}
+# Time chunk of the daily stores: one year per chunk, so reading a year touches one or two chunks
+DAILY_TIME_CHUNK = 366
+# Monthly outputs: day counts of the indices and monthly means of the daily variables
+DAILY_OUTPUTS = list(THRESHOLD_INDICES) + list(SPELL_INDICES) + list(DAILY_STATISTICS)
+# Bytes used by daily_indices (see daily_band_rows)
+DAILY_MEMORY_BUDGET = 4e9
+
+
+def noleap_day_of_year(times):
+    """Day of the year (0-364) of each date, with February 29 counted as February 28."""
+    times = pd.DatetimeIndex(times)
+    day = times.dayofyear.to_numpy() - 1
+    after_feb_28 = times.is_leap_year & (day >= 59)
+    return np.where(after_feb_28, day - 1, day)
+
+
+def _compare(values, comparison, threshold):
+    # Missing days never exceed a threshold
+    if comparison == ">":
+        return values > threshold
+    if comparison == "<":
+        return values < threshold
+    raise ValueError(f"Unknown comparison {comparison}, use '>' or '<'")
+
+
+def percentile_name(var, percentile):
+    return f"{var}_p{percentile}"
+
+
+def percentile_thresholds(daily, percentile, window=PERCENTILE_WINDOW, block=PERCENTILE_BLOCK):
+    """Percentile of each calendar day of a daily series, pooling the days within a window around it.
+
+    Args:
+        daily (xr.DataArray): (time, lat, lon) daily temperature over the calibration period.
+        percentile (float): percentile to compute, between 0 and 100.
+        window (int): number of calendar days pooled, centered on each day (odd).
+        block (int): number of latitude rows read at once.
+
+    Returns:
+        xr.DataArray: float32 (dayofyear, lat, lon) percentiles, dayofyear from 0 to 364.
+    """
+    daily = daily.transpose("time", "lat", "lon")
+    days = noleap_day_of_year(daily.indexes["time"])
+    half = window // 2
+    thresholds = np.empty((365,) + daily.shape[1:], dtype=np.float32)
+
+    for start in tqdm(range(0, daily.sizes["lat"], block), desc=f"Percentile {percentile}"):
+        rows = slice(start, start + block)
+        values = daily.isel(lat=rows).values
+        percentile_func = np.nanpercentile if np.isnan(values).any() else np.percentile
+        for day in range(365):
+            # Circular distance between calendar days
+            distance = np.abs((days - day + 182) % 365 - 182)
+            thresholds[day, rows] = percentile_func(values[distance <= half], percentile, axis=0)
+
+    return xr.DataArray(
+        thresholds,
+        dims=("dayofyear", "lat", "lon"),
+        coords={"dayofyear": np.arange(365), "lat": daily["lat"].values, "lon": daily["lon"].values},
+        name=percentile_name(daily.name, percentile),
+    )
+
+
+def load_spell_thresholds(daily, path, calibration=("1991", "2020")):
+    """Loads the cached percentiles of the spell indices in path, computing (and caching) them if missing.
+
+    Args:
+        daily (dict): daily (time, lat, lon) DataArrays of each daily variable, e.g. {"tmax": ..., "tmin": ...}.
+        path (str): NetCDF file where the percentiles are cached.
+        calibration (tuple): first and last year of the calibration period.
+    """
+    if os.path.exists(path):
+        return xr.open_dataset(path)
+    thresholds = xr.merge(
+        [
+            percentile_thresholds(daily[var].sel(time=slice(*calibration)).rename(var), percentile)
+            for var, _, percentile in SPELL_INDICES.values()
+        ]
+    )
+    thresholds.to_netcdf(path)
+    # Read back lazily, daily_indices only loads the percentiles of one band at a time
+    return xr.open_dataset(path)
+
+
+def spell_runs(shape):
+    """Initial state of the spell indices: the length of the current run of every cell."""
+    return {index: np.zeros(shape, dtype=np.int32) for index in SPELL_INDICES}
+
+
+def spell_runs_path(path):
+    """Path of the .npz file with the spell runs at the start of the last year of a monthly store."""
+    return os.path.splitext(path)[0] + "_spell_runs.npz"
+
+
+def save_spell_runs(runs, year, path):
+    """Saves the spell runs at the start of year (see spell_runs) to path, replacing it at once."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        np.savez(file, year=year, **runs)
+    os.replace(tmp_path, path)
+
+
+def load_spell_runs(path, year, shape):
+    """Spell runs at the start of year saved by save_spell_runs, or None if they weren't saved for that year and grid."""
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as saved:
+        if int(saved["year"]) != year or any(saved[index].shape != shape for index in SPELL_INDICES):
+            return None
+        return {index: saved[index].astype(np.int32) for index in SPELL_INDICES}
+
+
+def monthly_accumulators(n_months, shape):
+    """Preallocated float32 accumulators of the monthly reduction.
+
+    Returns:
+        dict: (n_months, ...) zeros for the day counts of every index, and the sums ("{var}_sum")
+            and valid days ("{var}_count") of every daily variable.
+    """
+    names = list(THRESHOLD_INDICES) + list(SPELL_INDICES)
+    names += [f"{var}_{total}" for var in DAILY_STATISTICS for total in ["sum", "count"]]
+    return {name: np.zeros((n_months,) + shape, dtype=np.float32) for name in names}
+
+
+def accumulate_days(accumulators, daily, months, days, thresholds, runs, min_days=SPELL_MIN_DAYS):
+    """Adds consecutive days to the monthly accumulators (in place).
+
+    Args:
+        accumulators (dict): see monthly_accumulators.
+        daily (dict): daily (n_days, ...) arrays of each daily variable, in time order.
+        months (np.ndarray): position of the month of each day in the accumulators.
+        days (np.ndarray): calendar day (see noleap_day_of_year) of each day.
+        thresholds (dict): (365, ...) percentile arrays, keyed by percentile_name.
+        runs (dict): current run length of each spell index (see spell_runs), updated in place.
+        min_days (int): minimum length of a spell.
+    """
+    starts = np.flatnonzero(np.r_[True, np.diff(months) != 0])
+    month_ids = months[starts]
+
+    for index, (var, comparison, threshold) in THRESHOLD_INDICES.items():
+        exceeds = _compare(daily[var], comparison, threshold)
+        accumulators[index][month_ids] += np.add.reduceat(exceeds, starts, axis=0, dtype=np.int32)
+
+    for var in DAILY_STATISTICS:
+        valid = np.isfinite(daily[var])
+        accumulators[f"{var}_sum"][month_ids] += np.add.reduceat(np.where(valid, daily[var], 0), starts, axis=0)
+        accumulators[f"{var}_count"][month_ids] += np.add.reduceat(valid, starts, axis=0, dtype=np.int32)
+
+    for index, (var, comparison, percentile) in SPELL_INDICES.items():
+        threshold = thresholds[percentile_name(var, percentile)]
+        count = accumulators[index]
+        run = runs[index]
+        for day in range(len(months)):
+            exceeds = _compare(daily[var][day], comparison, threshold[days[day]])
+            run[...] = np.where(exceeds, run + 1, 0)
+            # The first min_days days are counted when the run reaches them, then one day at a time
+            count[months[day]] += np.where(run == min_days, min_days, run > min_days)
+
+
+def finalize_months(accumulators, outputs):
+    """Writes the monthly outputs from the accumulators (in place).
+
+    Args:
+        accumulators (dict): see monthly_accumulators.
+        outputs (dict): (n_months, ...) float32 arrays of every name in DAILY_OUTPUTS: the day
+            counts of the indices (nan where their daily variable has no valid day in the month)
+            and the monthly means of the daily variables.
+    """
+    indices = {**THRESHOLD_INDICES, **SPELL_INDICES}
+    for index, (var, _, _) in indices.items():
+        outputs[index][...] = np.where(accumulators[f"{var}_count"] > 0, accumulators[index], np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for var in DAILY_STATISTICS:
+            outputs[var][...] = accumulators[f"{var}_sum"] / accumulators[f"{var}_count"]
+
+
+def daily_band_rows(n_lat, n_lon, memory_budget=DAILY_MEMORY_BUDGET, n_days=366):
+    """Latitude rows of the bands read by daily_indices, so that it stays within memory_budget bytes.
+
+    The monthly outputs of a year and the spell runs (and their copy at the start of the year)
+    are kept for the whole grid. Each latitude
+    row then needs its days of every daily variable (plus a float32 and a bool temporary of the
+    same size), its percentiles and its accumulators.
+    """
+    n_vars, n_spells = len(DAILY_STATISTICS), len(SPELL_INDICES)
+    n_accumulators = len(THRESHOLD_INDICES) + n_spells + 2 * n_vars
+    fixed_bytes = (12 * len(DAILY_OUTPUTS) + 2 * n_spells) * n_lat * n_lon * 4
+    row_bytes = n_lon * (4 * (n_vars + 1) * n_days + n_days + 4 * n_spells * 365 + 4 * 12 * n_accumulators)
+    rows = int((memory_budget - fixed_bytes) // row_bytes)
+    if rows < 1:
+        print(
+            f"Warning: the daily reduction needs at least {(fixed_bytes + row_bytes) / 1e9:.1f}GB, "
+            f"more than the memory budget of {memory_budget / 1e9:.1f}GB!"
+        )
+        rows = 1
+    # Bands of whole store tiles, so every tile is decompressed once per year
+    if rows >= STORE_LAT_TILE:
+        rows -= rows % STORE_LAT_TILE
+    return min(rows, n_lat)
+
+
+def daily_indices(daily, thresholds, path, memory_budget=DAILY_MEMORY_BUDGET, time_chunk=INGEST_TIME_CHUNK):
+    """Computes the monthly outputs from the daily stores, appending them to a Zarr store.
+
+    Years are reduced in order, each one band of latitudes at a time (see daily_band_rows) into
+    accumulators preallocated once, and its months are appended to the store when all the bands
+    are done. Years already in the store are skipped, but the last one is reduced again (and only
+    the months after the last one stored are appended), starting from the spell runs saved when it
+    was appended (see spell_runs_path). Without them, the years are reduced again from the first one
+    to rebuild the runs, and only the missing months are appended. A last month without all its
+    days is not appended, so a rerun with more days gives the same months as a single run.
+
+    Args:
+        daily (dict): daily (time, lat, lon) DataArrays of each daily variable, e.g. {"tmax": ..., "tmin": ...}.
+        thresholds (xr.Dataset): percentiles of the spell indices (see load_spell_thresholds).
+        path (str): monthly Zarr store, created if it doesn't exist.
+        memory_budget (float): bytes the reduction can use.
+        time_chunk (int): time chunk of the store when it's created.
+
+    Returns:
+        int: number of months appended.
+    """
+    # Only the days in all the daily variables (their downloads can be at different years)
+    daily = dict(zip(daily, xr.align(*daily.values(), join="inner")))
+    daily = {var: values.transpose("time", "lat", "lon") for var, values in daily.items()}
+    reference = next(iter(daily.values()))
+    times = reference.indexes["time"]
+    years = np.unique(times.year)
+    n_lat, n_lon = reference.shape[1:]
+    runs = spell_runs((n_lat, n_lon))
+    runs_path = spell_runs_path(path)
+    last_time = store_last_time(path)
+    if last_time is not None:
+        saved_runs = load_spell_runs(runs_path, last_time.year, (n_lat, n_lon))
+        if saved_runs is not None:
+            years = years[years >= last_time.year]
+            runs = saved_runs
+        else:
+            print(f"No spell runs saved for {last_time.year}, reducing the daily data again from {years[0]}...")
+
+    rows = daily_band_rows(n_lat, n_lon, memory_budget)
+    accumulators = monthly_accumulators(12, (rows, n_lon))
+    outputs = {name: np.empty((12, n_lat, n_lon), dtype=np.float32) for name in DAILY_OUTPUTS}
+
+    n_appended = 0
+    for year in tqdm(years, desc="Daily indices"):
+        steps = np.flatnonzero(times.year == year)
+        steps = slice(steps[0], steps[-1] + 1)
+        month_starts = times[steps].to_period("M").to_timestamp()
+        month_index, months = np.unique(month_starts, return_inverse=True)
+        n_months = len(month_index)
+        # Only whole months are appended, a month cut by the end of the daily data is appended by
+        #   the rerun that has all its days
+        n_whole = n_months if times[steps][-1].is_month_end else n_months - 1
+        days = noleap_day_of_year(times[steps])
+        year_runs = {index: run.copy() for index, run in runs.items()}
+
+        for start in range(0, n_lat, rows):
+            band = slice(start, start + rows)
+            values = {var: values.isel(time=steps, lat=band).values for var, values in daily.items()}
+            band_rows = next(iter(values.values())).shape[1]
+            band_accumulators = {name: accumulator[:n_months, :band_rows] for name, accumulator in accumulators.items()}
+            for accumulator in band_accumulators.values():
+                accumulator[...] = 0
+            band_thresholds = {
+                name: thresholds[name].isel(lat=band).transpose("dayofyear", "lat", "lon").values
+                for name in thresholds.data_vars
+            }
+            band_runs = {index: run[band] for index, run in runs.items()}
+            accumulate_days(band_accumulators, values, months, days, band_thresholds, band_runs)
+            finalize_months(band_accumulators, {name: output[:n_months, band] for name, output in outputs.items()})
+            del values, band_thresholds
+
+        monthly = xr.Dataset(
+            {name: (("time", "lat", "lon"), output[:n_whole]) for name, output in outputs.items()},
+            coords={"time": month_index[:n_whole], "lat": reference["lat"].values, "lon": reference["lon"].values},
+        )
+        n_appended += append_to_store(monthly, path, time_chunk=time_chunk)
+        save_spell_runs(year_runs, year, runs_path)
+    return n_appended
+
+
+def open_daily_stores(folder, prefix="ERA5"):
+    """Daily (time, lat, lon) temperature of each daily variable, from the stores {prefix}_{statistic}.zarr in folder."""
+    return {
+        var: open_climate_store(os.path.join(folder, f"{prefix}_{statistic}.zarr"))["t2m"].rename(var)
+        for var, statistic in DAILY_STATISTICS.items()
+    }
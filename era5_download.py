@@ -0,0 +1,285 @@
+import os
+import io
+import json
+import time
+import random
+import zipfile
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from tqdm import tqdm
+
+# Concurrent downloads from the Copernicus Climate Data Store (CDS).
+#   Every year (or year/variable) request is a task with a fixed target file. Tasks are queued in a
+#   bounded thread pool (the CDS queues requests server-side, so a few at a time is enough), failed
+#   requests are retried with exponential backoff, and every file is checked before being marked
+#   as done in a JSON state file. Reruns only queue what is not done.
+#   The client is pluggable: anything with a cdsapi-like .retrieve(dataset, request, target) method.
+#   MockCDSServer/MockCDSClient are a local stand-in to test the orchestrator without the CDS.
+
+MAX_WORKERS = 4
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 30
+MONTHS = [f"{month:02d}" for month in range(1, 13)]
+DAYS = [f"{day:02d}" for day in range(1, 32)]
+
+
+def cds_client():
+    """Default client: cdsapi reads the credentials from ~/.cdsapirc."""
+    import cdsapi
+
+    return cdsapi.Client()
+
+
+def year_tasks(dataset, request, years, folder, variables=None, prefix="data", extension="zip"):
+    """One download task per year, or per year and variable if variables are passed.
+
+    Args:
+        dataset (str): CDS dataset name.
+        request (dict): request template, "year" (and "variable") are filled for each task.
+        years (iterable): years to download.
+        folder (str): folder where the files are saved as {prefix}_{year}[_{variable}].{extension}.
+        variables (list, optional): download each variable of the request separately.
+
+    Returns:
+        list: tasks (dicts with key, dataset, request and target).
+    """
+    tasks = []
+    for year in years:
+        for variable in variables or [None]:
+            task_request = {**request, "year": [f"{year}"]}
+            key = f"{year}"
+            if variable is not None:
+                task_request["variable"] = [variable]
+                key = f"{year}_{variable}"
+            target = os.path.join(folder, f"{prefix}_{key}.{extension}")
+            tasks += [{"key": key, "dataset": dataset, "request": task_request, "target": target}]
+    return tasks
+
+
+def verify_download(path):
+    """Checks that a downloaded file is complete: a readable zip, NetCDF (classic or HDF5) or GRIB."""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return False
+    with open(path, "rb") as f:
+        magic = f.read(8)
+    if magic.startswith(b"PK"):
+        try:
+            with zipfile.ZipFile(path) as archive:
+                return len(archive.namelist()) > 0 and archive.testzip() is None
+        except zipfile.BadZipFile:
+            return False
+    return magic.startswith((b"CDF\x01", b"CDF\x02", b"\x89HDF\r\n\x1a\n", b"GRIB"))
+
+
+def load_state(path):
+    """Loads the download state ({task key: record}), empty if it doesn't exist yet."""
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_state(state, path):
+    """Writes the download state atomically (a killed run never leaves a half-written state)."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def retrieve_with_retries(client, task, max_retries=MAX_RETRIES, backoff=BACKOFF_SECONDS, sleep=time.sleep):
+    """Downloads a task, retrying with exponential backoff (and jitter) until the file checks out.
+
+    The file is downloaded to {target}.part and only moved to target once verified.
+
+    Returns:
+        int: number of attempts used.
+
+    Raises:
+        RuntimeError: if every attempt failed.
+    """
+    part_path = f"{task['target']}.part"
+    last_error = None
+    for attempt in range(1, max_retries + 1):
+        try:
+            client.retrieve(task["dataset"], task["request"], part_path)
+            if not verify_download(part_path):
+                raise IOError(f"Downloaded file for {task['key']} is corrupt or incomplete")
+            os.replace(part_path, task["target"])
+            return attempt
+        except Exception as error:
+            last_error = error
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            if attempt < max_retries:
+                sleep(backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+    raise RuntimeError(f"Download of {task['key']} failed after {max_retries} attempts: {last_error}")
+
+
+def download_all(
+    tasks,
+    state_path,
+    client_factory=cds_client,
+    max_workers=MAX_WORKERS,
+    max_retries=MAX_RETRIES,
+    backoff=BACKOFF_SECONDS,
+):
+    """Downloads every task not done yet with a bounded pool of concurrent requests.
+
+    Tasks are done if the state file says so and their file still checks out. Each worker thread
+    builds its own client once and reuses it for all its tasks.
+
+    Args:
+        tasks (list): output of year_tasks.
+        state_path (str): JSON file where the state of every task is kept.
+        client_factory (callable): returns a client with a .retrieve(dataset, request, target) method.
+        max_workers (int): number of requests at the same time.
+
+    Returns:
+        dict: the final state.
+    """
+    state = load_state(state_path)
+    pending = [
+        task
+        for task in tasks
+        if not (state.get(task["key"], {}).get("status") == "done" and verify_download(task["target"]))
+    ]
+    print(f"{len(tasks) - len(pending)} of {len(tasks)} files already downloaded")
+    if not pending:
+        return state
+
+    local = threading.local()
+    lock = threading.Lock()
+
+    def run(task):
+        if not hasattr(local, "client"):
+            local.client = client_factory()
+        try:
+            attempts = retrieve_with_retries(local.client, task, max_retries, backoff)
+            record = {"status": "done", "target": task["target"], "size": os.path.getsize(task["target"]), "attempts": attempts}
+        except RuntimeError as error:
+            record = {"status": "failed", "target": task["target"], "error": str(error)}
+        with lock:
+            state[task["key"]] = record
+            save_state(state, state_path)
+        return task["key"], record
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run, task) for task in pending]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            key, record = future.result()
+            if record["status"] == "done":
+                print(f"Se descargó {os.path.basename(record['target'])}")
+            else:
+                print(record["error"])
+
+    failed = [key for key, record in state.items() if record["status"] == "failed"]
+    if failed:
+        print(f"Failed downloads (rerun to retry): {failed}")
+    return state
+
+
+#### Local stand-in for the CDS ####
+
+
+def mock_archive(dataset, request):
+    """Small zip with a fake NetCDF member, as the CDS returns for NetCDF requests."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        payload = b"CDF\x01" + json.dumps({"dataset": dataset, "request": request}).encode()
+        archive.writestr("data_stream-moda.nc", payload)
+    return buffer.getvalue()
+
+
+class MockCDSServer:
+    """Local HTTP server answering POST /retrieve/{dataset} with a mock archive.
+
+    Args:
+        failures (int): the first `failures` requests of each (dataset, request) answer 503, to
+            exercise the retries.
+        corrupt (int): the next `corrupt` requests answer a truncated archive.
+        delay (float): seconds each request takes.
+
+    Example:
+        with MockCDSServer(failures=1) as server:
+            download_all(tasks, state_path, client_factory=lambda: MockCDSClient(server.url), backoff=0)
+    """
+
+    def __init__(self, failures=0, corrupt=0, delay=0.0):
+        self.failures = failures
+        self.corrupt = corrupt
+        self.delay = delay
+        self.requests = {}
+        lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                dataset = self.path.rsplit("/", 1)[-1]
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                key = json.dumps([dataset, request], sort_keys=True)
+                with lock:
+                    n = server.requests[key] = server.requests.get(key, 0) + 1
+                time.sleep(server.delay)
+                if n <= server.failures:
+                    self.send_error(503, "Service busy, try again later")
+                    return
+                body = mock_archive(dataset, request)
+                if n <= server.failures + server.corrupt:
+                    body = body[: len(body) // 2]
+                self.send_response(200)
+                self.send_header("Content-Type", "application/zip")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class MockCDSClient:
+    """cdsapi-like client for MockCDSServer."""
+
+    def __init__(self, url):
+        self.url = url
+
+    def retrieve(self, dataset, request, target):
+        data = json.dumps(request).encode()
+        http_request = urllib.request.Request(
+            f"{self.url}/retrieve/{dataset}", data=data, headers={"Content-Type": "application/json"}
+        )
+        with urllib.request.urlopen(http_request) as response, open(target, "wb") as f:
+            f.write(response.read())
+
+
+if __name__ == "__main__":
+    # Dry run against the local stand-in: every year fails once and comes corrupt once before succeeding
+    import tempfile
+
+    folder = tempfile.mkdtemp()
+    tasks = year_tasks(
+        "reanalysis-era5-single-levels-monthly-means",
+        {"product_type": "monthly_averaged_reanalysis", "variable": ["2m_temperature"], "month": MONTHS},
+        range(2000, 2010),
+        folder,
+    )
+    with MockCDSServer(failures=1, corrupt=1, delay=0.1) as server:
+        state = download_all(
+            tasks, os.path.join(folder, "state.json"), client_factory=lambda: MockCDSClient(server.url), backoff=0.01
+        )
+    assert all(record["status"] == "done" and record["attempts"] == 3 for record in state.values())
+    print(f"Mock download OK: {len(state)} files in {folder}")
@@ -0,0 +1,195 @@
+import os
+import re
+import shutil
+import zipfile
+import tempfile
+
+import numpy as np
+import xarray as xr
+
+from climate_store import append_to_store, store_last_time
+from grid_tools import reorder_lon_lat
+
+# Ingestion of the downloaded ERA5 archives (data_{year}.zip, see era5_download.py) into the
+#   processed store. Archives are read one year at a time, in year order: the NetCDF members are
+#   extracted to temporary files and opened lazily, then read in blocks of timesteps sized to a
+#   memory budget (a year of global daily data is several GB per variable). Each block is
+#   normalized (coordinate names, longitudes in -180-180, ascending latitudes, Celsius) and
+#   appended to the Zarr store before the next one is read. Timesteps already in the store are
+#   skipped, so an interrupted ingestion can be rerun.
+
+# New CDS files use valid_time/latitude/longitude, older ones time/latitude/longitude
+COORD_NAMES = {"valid_time": "time", "latitude": "lat", "longitude": "lon"}
+DROP_COORDS = ["number", "expver"]
+# Time chunk of the processed store: appended years fill it up to 60 years of monthly data
+INGEST_TIME_CHUNK = 12 * 60
+# Bytes used to ingest a block of timesteps (see ingest_block_steps)
+INGEST_MEMORY_BUDGET = 2e9
+# Copies of a block held at once: the values read, the normalized longitudes (a roll), the
+#   temperature in Celsius and the merged members
+INGEST_BUFFER_COPIES = 4
+COPY_BUFFER = 16 * 1024 * 1024
+
+
+def year_archives(folder, prefix="data"):
+    """(year, path) of the archives {prefix}_{year}.zip (or .nc) in folder, sorted by year."""
+    pattern = re.compile(rf"^{prefix}_(\d{{4}})\.(zip|nc)$")
+    archives = []
+    for name in os.listdir(folder):
+        match = pattern.match(name)
+        if match:
+            archives += [(int(match.group(1)), os.path.join(folder, name))]
+    return sorted(archives)
+
+
+def normalize_era5(ds):
+    """Normalizes a raw ERA5 dataset: time/lat/lon coordinates, lon in -180-180, sorted axes and t2m in Celsius."""
+    ds = ds.rename({name: new for name, new in COORD_NAMES.items() if name in ds.variables})
+    # ERA5T months come as a second experiment version: keep the first available value
+    if "expver" in ds.dims:
+        merged = ds.isel(expver=0, drop=True)
+        for i in range(1, ds.sizes["expver"]):
+            merged = merged.combine_first(ds.isel(expver=i, drop=True))
+        ds = merged
+    ds = ds.drop_vars([coord for coord in DROP_COORDS if coord in ds.variables])
+
+    ## Longitude is in range 0-360, with 0 at Greenwich. We need it in -180 to 180
+    #   (a roll of the lon axis), and latitudes ascending (a reversed slice)
+    ds = reorder_lon_lat(ds)
+
+    # Sorted and unique timesteps
+    _, unique = np.unique(ds["time"].values, return_index=True)
+    ds = ds.isel(time=unique)
+
+    ## Temperature is in Kelvin, we need it in Celsius
+    if "t2m" in ds:
+        ds["t2m"] = ds["t2m"] - 273.15
+    return ds
+
+
+def time_name(ds):
+    """Name of the time dimension of a raw ERA5 dataset (see COORD_NAMES)."""
+    return "valid_time" if "valid_time" in ds.dims else "time"
+
+
+def open_members(path, tmp_dir):
+    """Lazily opens every NetCDF member of an archive (or a plain NetCDF file).
+
+    Members are extracted to tmp_dir, and nothing is read until the datasets are indexed.
+
+    Returns:
+        tuple: the datasets and the paths of the extracted members (close the datasets before
+            deleting them).
+    """
+    if not zipfile.is_zipfile(path):
+        return [xr.open_dataset(path)], []
+
+    datasets, member_paths = [], []
+    with zipfile.ZipFile(path) as archive:
+        for member in archive.namelist():
+            if not member.endswith(".nc"):
+                continue
+            member_path = os.path.join(tmp_dir, os.path.basename(member))
+            with archive.open(member) as source, open(member_path, "wb") as target:
+                shutil.copyfileobj(source, target, COPY_BUFFER)
+            member_paths += [member_path]
+            datasets += [xr.open_dataset(member_path)]
+    if not datasets:
+        raise ValueError(f"No NetCDF files found in {path}")
+    return datasets, member_paths
+
+
+def ingest_block_steps(datasets, memory_budget=INGEST_MEMORY_BUDGET):
+    """Timesteps read at once by archive_blocks, so that ingesting a block stays within memory_budget bytes.
+
+    Each timestep of a block is held INGEST_BUFFER_COPIES times (see INGEST_BUFFER_COPIES).
+    """
+    step_bytes = sum(
+        ds[var].dtype.itemsize * ds[var].size // ds.sizes[time_name(ds)]
+        for ds in datasets
+        for var in ds.data_vars
+        if time_name(ds) in ds[var].dims
+    )
+    steps = int(memory_budget // (INGEST_BUFFER_COPIES * max(step_bytes, 1)))
+    if steps < 1:
+        print(
+            f"Warning: ingesting a timestep needs {INGEST_BUFFER_COPIES * step_bytes / 1e9:.1f}GB, "
+            f"more than the memory budget of {memory_budget / 1e9:.1f}GB!"
+        )
+    return max(steps, 1)
+
+
+def archive_blocks(path, tmp_dir, memory_budget=INGEST_MEMORY_BUDGET, after=None):
+    """Normalized datasets of an archive (see normalize_era5), in consecutive blocks of timesteps.
+
+    The members are opened lazily and only the timesteps of one block are loaded at a time, so
+    a year of global daily data never has to fit in memory (see ingest_block_steps). The
+    extracted members are deleted once every block has been read.
+
+    Args:
+        path (str): zip archive with NetCDF members, or a plain NetCDF file.
+        tmp_dir (str): folder where the members are extracted.
+        memory_budget (float): bytes a block can use.
+        after (pd.Timestamp, optional): only the timesteps after this one are read.
+
+    Yields:
+        xr.Dataset: the timesteps of a block, sorted and unique, of every member.
+    """
+    datasets, member_paths = open_members(path, tmp_dir)
+    try:
+        # Sorted unique timesteps of each member, and of all of them
+        member_times = []
+        for ds in datasets:
+            times = ds[time_name(ds)].values
+            _, unique = np.unique(times, return_index=True)
+            if after is not None:
+                unique = unique[times[unique] > np.datetime64(after)]
+            member_times += [(times, unique)]
+        all_times = np.unique(np.concatenate([times[unique] for times, unique in member_times]))
+
+        steps = ingest_block_steps(datasets, memory_budget)
+        for start in range(0, len(all_times), steps):
+            first, last = all_times[start], all_times[min(start + steps, len(all_times)) - 1]
+            blocks = []
+            for ds, (times, unique) in zip(datasets, member_times):
+                block = unique[(times[unique] >= first) & (times[unique] <= last)]
+                if block.size == 0:
+                    continue
+                # Sorted files (the usual case) are read with a slice instead of a list of steps
+                if block[-1] - block[0] + 1 == block.size:
+                    block = slice(block[0], block[-1] + 1)
+                blocks += [normalize_era5(ds.isel({time_name(ds): block}).load())]
+            # Members of the same year have different variables (e.g. instantaneous and accumulated ones)
+            yield xr.merge(blocks, compat="override", join="outer")
+    finally:
+        for ds in datasets:
+            ds.close()
+        for member_path in member_paths:
+            os.remove(member_path)
+
+
+def ingest_archives(folder, store_path, prefix="data", time_chunk=INGEST_TIME_CHUNK, memory_budget=INGEST_MEMORY_BUDGET):
+    """Appends the yearly ERA5 archives of folder to a Zarr store, in year order.
+
+    Args:
+        folder (str): folder with the {prefix}_{year}.zip archives.
+        store_path (str): processed Zarr store, created if it doesn't exist.
+        time_chunk (int): time chunk of the store when it's created.
+        memory_budget (float): bytes used to ingest a block of timesteps (see archive_blocks).
+
+    Returns:
+        int: number of timesteps appended.
+    """
+    n_appended = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for year, path in year_archives(folder, prefix):
+            last_time = store_last_time(store_path)
+            # Years already ingested are not even opened
+            if last_time is not None and year < last_time.year:
+                continue
+            n_new = 0
+            for ds in archive_blocks(path, tmp_dir, memory_budget, after=last_time):
+                n_new += append_to_store(ds, store_path, time_chunk=time_chunk)
+            n_appended += n_new
+            print(f"{os.path.basename(path)}: {n_new} timesteps appended")
+    return n_appended
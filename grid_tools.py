@@ -0,0 +1,187 @@
+import numpy as np
+import pandas as pd
+
+# Integer grid indexing for the regular lat/lon grids used in the project (ERA5 is 0.25°).
+#   Label-based .sel on float coordinates is slow and fragile for float equality, so DHS
+#   coordinates and dates are turned into integer row/column/month positions once, vectorized
+#   over the whole frame, and every later step works with those integers.
+
+ERA5_RESOLUTION = 0.25
+
+
+def regular_axis(coord):
+    """Returns the (origin, step, size) of an evenly spaced coordinate.
+
+    Args:
+        coord (array-like): 1-D coordinate values, e.g. climate_data["lat"].
+
+    Returns:
+        tuple: first value, spacing and number of values of the coordinate.
+    """
+    values = np.asarray(coord, dtype=np.float64)
+    if values.size < 2:
+        raise ValueError("A regular axis needs at least two values!")
+    step = (values[-1] - values[0]) / (values.size - 1)
+    if not np.allclose(np.diff(values), step, rtol=0, atol=abs(step) * 1e-3):
+        raise ValueError("Coordinate is not evenly spaced, integer indexing is not possible!")
+    return values[0], step, values.size
+
+
+def to_grid_index(values, origin, step, size=None, wrap=False):
+    """Turns coordinates into integer positions on a regular grid (nearest cell).
+
+    Rounding is done as round_to_nearest_quarter does for the 0.25° grid (half to even),
+    so that the cell assigned is the same as rounding the coordinate and selecting the label.
+
+    Args:
+        values (array-like): coordinates to index, e.g. df["LATNUM"].
+        origin (float): coordinate of the first cell of the grid.
+        step (float): spacing of the grid (negative if the axis is descending).
+        size (int, optional): number of cells of the axis. Positions outside of the axis are set to -1.
+        wrap (bool): wrap positions around the axis (for longitudes spanning the whole globe).
+
+    Returns:
+        np.ndarray: int64 positions, -1 where the coordinate is missing or outside the grid.
+
+    Example:
+        >>> to_grid_index([1.3, 1.62, -179.9, 180.0], -180, 0.25, 1440, wrap=True)
+        array([725, 726,   0,   0])
+    """
+    values = np.asarray(values, dtype=np.float64)
+    valid = np.isfinite(values)
+    idx = np.rint(np.where(valid, values, 0) / step) - np.rint(origin / step)
+    idx = idx.astype(np.int64)
+    if size is not None:
+        if wrap:
+            idx = idx % size
+        else:
+            valid &= (idx >= 0) & (idx < size)
+    return np.where(valid, idx, -1)
+
+
+def grid_coords(idx, origin, step):
+    """Inverse of to_grid_index: coordinate of the cell at each integer position."""
+    return origin + np.asarray(idx) * step
+
+
+def cell_index(lat_idx, lon_idx, n_lon):
+    """Unique integer id of each (lat, lon) cell, -1 where any of the positions is missing."""
+    lat_idx = np.asarray(lat_idx, dtype=np.int64)
+    lon_idx = np.asarray(lon_idx, dtype=np.int64)
+    return np.where((lat_idx >= 0) & (lon_idx >= 0), lat_idx * n_lon + lon_idx, -1)
+
+
+def month_counter(dates):
+    """Number of months since year 0 (year * 12 + month - 1) of each date."""
+    dates = pd.DatetimeIndex(dates)
+    return dates.year.to_numpy(dtype=np.int64) * 12 + dates.month.to_numpy(dtype=np.int64) - 1
+
+
+def month_offset(dates, time_origin):
+    """Position of each date's month in a monthly time axis starting at time_origin."""
+    return month_counter(dates) - month_counter([time_origin])[0]
+
+
+def month_dates(months):
+    """First day of each month counter (see month_counter), as datetime64[ns].
+
+    Example:
+        >>> month_dates([1991 * 12, 2020 * 12 + 11])
+        array(['1991-01-01T00:00:00.000000000', '2020-12-01T00:00:00.000000000'],
+              dtype='datetime64[ns]')
+    """
+    months = np.asarray(months, dtype=np.int64)
+    return (months - 1970 * 12).astype("datetime64[M]").astype("datetime64[ns]")
+
+
+# Month counters are below 12 * 10000 (year 10000), so cell * POINT_KEY_MONTHS + month is unique
+POINT_KEY_MONTHS = 12 * 10000
+
+
+def point_key(cell, months):
+    """Unique int64 key of each (cell, month counter) pair, e.g. a grid cell and the first month of a child's series."""
+    return np.asarray(cell, dtype=np.int64) * POINT_KEY_MONTHS + np.asarray(months, dtype=np.int64)
+
+
+def wrap_longitude(lon):
+    """Maps 0-360 longitudes to -180-180 (180 is kept as 180)."""
+    lon = np.asarray(lon)
+    return np.where(lon > 180, lon - 360, lon)
+
+
+def reorder_lon_lat(ds):
+    """Wraps longitudes to -180-180 and sorts lon and lat ascending with index operations.
+
+    On a 0-360 grid the wrapped longitudes are a rotation of a sorted axis, so sorting them is a
+    roll (two contiguous slices, chunk by chunk on dask arrays), and a descending latitude axis is a
+    reversed slice. Only axes that are neither fall back to a permutation with isel. Unlike
+    sortby, nothing is shuffled across chunks.
+
+    Args:
+        ds (xr.Dataset): data with "lat" and "lon" dimensions.
+
+    Returns:
+        xr.Dataset: same data with ascending lat and lon in -180-180.
+
+    Example:
+        >>> np.roll(wrap_longitude([0, 90, 180, 270]), -3)
+        array([-90,   0,  90, 180])
+    """
+    lon = wrap_longitude(ds["lon"].values)
+    ds = ds.assign_coords(lon=lon)
+    breaks = np.flatnonzero(np.diff(lon) < 0)
+    if breaks.size == 1 and lon[-1] < lon[0]:
+        ds = ds.roll(lon=-(breaks[0] + 1), roll_coords=True)
+    elif breaks.size > 0:
+        ds = ds.isel(lon=np.argsort(lon, kind="stable"))
+
+    lat = ds["lat"].values
+    if np.all(np.diff(lat) < 0):
+        ds = ds.isel(lat=slice(None, None, -1))
+    elif np.any(np.diff(lat) < 0):
+        ds = ds.isel(lat=np.argsort(lat, kind="stable"))
+    return ds
+
+
+def grid_axis(ds, name):
+    """(origin, step, size) of the "lat" or "lon" axis of a climate dataset.
+
+    Tables sampled at a few cells (see cell_tools.py) keep the axes of their grid as attributes
+    ({name}_origin, {name}_step and n_{name}), gridded datasets have them as coordinates.
+    """
+    if f"{name}_origin" in ds.attrs:
+        return ds.attrs[f"{name}_origin"], ds.attrs[f"{name}_step"], int(ds.attrs[f"n_{name}"])
+    return regular_axis(ds[name])
+
+
+def grid_attrs(ds):
+    """Attributes describing the lat/lon axes of a gridded dataset, read back by grid_axis."""
+    attrs = {}
+    for name in ["lat", "lon"]:
+        origin, step, size = regular_axis(ds[name])
+        attrs.update({f"{name}_origin": float(origin), f"{name}_step": float(step), f"n_{name}": int(size)})
+    return attrs
+
+
+def climate_grid_index(ds, lat, lon, dates=None):
+    """Integer (lat, lon, time) positions of points in a climate dataset with regular lat/lon axes.
+
+    Args:
+        ds (xr.Dataset): climate data with "lat", "lon" (or their grid attributes, see grid_axis)
+            and a monthly "time" coordinate.
+        lat, lon (array-like): coordinates of the points, e.g. df["LATNUM"] and df["LONGNUM"].
+        dates (array-like, optional): first month of each point, e.g. df["from_date"].
+
+    Returns:
+        tuple: lat_idx, lon_idx (and time_idx if dates are passed). Missing positions are -1.
+    """
+    lat_origin, lat_step, n_lat = grid_axis(ds, "lat")
+    lon_origin, lon_step, n_lon = grid_axis(ds, "lon")
+    # Only wrap longitudes if the grid covers the whole globe
+    wrap = np.isclose(abs(lon_step) * n_lon, 360)
+    lat_idx = to_grid_index(lat, lat_origin, lat_step, n_lat)
+    lon_idx = to_grid_index(lon, lon_origin, lon_step, n_lon, wrap=wrap)
+    if dates is None:
+        return lat_idx, lon_idx
+    time_idx = month_offset(dates, ds.indexes["time"][0])
+    return lat_idx, lon_idx, time_idx
@@ -0,0 +1,93 @@
+import os
+import json
+
+import numpy as np
+from tqdm import tqdm
+
+# Uncompressed, memory-mapped copy of the climate cube for the assignment workers.
+#   Loading a band of latitudes from a compressed store copies it into the RAM of every worker.
+#   The variables are instead written once to a single float32 .npy file, laid out as
+#   (lat, lon, variable, time) so that the series of a point is a contiguous run of values. The
+#   workers open it with mmap_mode="r": the pages are shared through the OS page cache and
+#   each chunk only touches the pages of its points' series.
+#   The variables of the cube are listed in a .json file next to it, written last.
+
+# Latitude rows converted at once when writing the cube
+MMAP_CUBE_BLOCK = 8
+
+
+def mmap_cube_meta_path(path):
+    """Path of the .json file with the variables of a cube."""
+    return os.path.splitext(path)[0] + ".json"
+
+
+def is_mmap_cube(path):
+    """Whether path is a complete cube written by export_mmap_cube."""
+    return path.endswith(".npy") and os.path.isfile(mmap_cube_meta_path(path))
+
+
+def export_mmap_cube(ds, path, block=MMAP_CUBE_BLOCK):
+    """Writes the variables of a (time, lat, lon) dataset as a (lat, lon, variable, time) float32 .npy file.
+
+    Args:
+        ds (xr.Dataset): climate variables, all with the same (time, lat, lon) dimensions.
+        path (str): .npy file, overwritten if it exists.
+        block (int): number of latitude rows read from ds at once.
+    """
+    meta_path = mmap_cube_meta_path(path)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    variables = list(ds.data_vars)
+    ds = ds.transpose("time", "lat", "lon")
+    shape = (ds.sizes["lat"], ds.sizes["lon"], len(variables), ds.sizes["time"])
+    cube = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=shape)
+    for start in tqdm(range(0, shape[0], block), desc="Memory-mapped cube"):
+        band = ds.isel(lat=slice(start, start + block)).to_array()
+        cube[start : start + block] = band.transpose("lat", "lon", "variable", "time").values
+    cube.flush()
+    del cube
+
+    with open(meta_path, "w") as file:
+        json.dump({"variables": variables}, file)
+
+
+def open_mmap_cube(path):
+    """Opens a cube written by export_mmap_cube.
+
+    Returns:
+        tuple: read-only (lat, lon, variable, time) np.memmap and the list of its variables.
+    """
+    with open(mmap_cube_meta_path(path)) as file:
+        variables = json.load(file)["variables"]
+    return np.load(path, mmap_mode="r"), variables
+
+
+def mmap_cube_windows(cube, cube_variables, variables, lat_idx, lon_idx, time_idx, n_months):
+    """Reads the series of many points from a memory-mapped cube.
+
+    Args:
+        cube (np.memmap): (lat, lon, variable, time) cube, see open_mmap_cube.
+        cube_variables (list): variables of the cube.
+        variables (list): variables to read, in the order of the output.
+        lat_idx, lon_idx (np.ndarray): integer position of each point in the lat/lon axes of the cube.
+        time_idx (np.ndarray): integer position of the first month of each point in the time axis.
+        n_months (int): length of the series of each point.
+
+    Returns:
+        np.ndarray: float32 array of shape (n_points, n_vars, n_months), as shock_tools.gather_windows.
+    """
+    lat_idx = np.asarray(lat_idx, dtype=np.intp)
+    lon_idx = np.asarray(lon_idx, dtype=np.intp)
+    time_idx = np.asarray(time_idx, dtype=np.intp)
+    var_idx = np.array([cube_variables.index(var) for var in variables], dtype=np.intp)
+
+    n_lat, n_lon, _, n_time = cube.shape
+    if (lat_idx < 0).any() or (lat_idx >= n_lat).any() or (lon_idx < 0).any() or (lon_idx >= n_lon).any():
+        raise ValueError("Some points fall outside the lat/lon grid of the climate data!")
+    if (time_idx < 0).any() or (time_idx + n_months > n_time).any():
+        raise ValueError("Some points require climate data outside the time range loaded!")
+
+    months = time_idx[:, None] + np.arange(n_months)
+    windows = cube[lat_idx[:, None, None], lon_idx[:, None, None], var_idx[None, :, None], months[:, None, :]]
+    return np.ascontiguousarray(windows, dtype=np.float32)
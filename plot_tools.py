@@ -3,7 +3,11 @@ import os
 import numpy as np
 import matplotlib.pyplot as plt
 
+from shock_tools import load_timeframes
+
 OUTPUTS = r"C:\Working Papers\Paper - Child Mortality and Climate Shocks\Outputs"
+# Periods of the stats computed in 02 (see timeframes.json)
+TIMEFRAMES_SPEC = load_timeframes()
 
 # --- Derived Configurations for Specific Plots ---
 SEMESTER_CONFIG = {
@@ -21,7 +25,7 @@ SEMESTER_CONFIG = {
 # -- Base Configuration for Quarterly analysis (7 periods) --
 QUARTERLY_CONFIG = {
     "canvas_size": (2, 4),
-    "time_frames": [None, "inutero_1m3m", "inutero_3m6m", "inutero_6m9m", "born_1m3m", "born_3m6m", "born_6m9m", "born_9m12m"],
+    "time_frames": [None] + list(TIMEFRAMES_SPEC["timeframes"]["q"]["periods"]),
     "title_labels": {
         "inutero_1m3m": "1st In-Utero Quarter", "inutero_3m6m": "2nd In-Utero Quarter", "inutero_6m9m": "3rd In-Utero Quarter",
         "born_1m3m": "1st Born Quarter", "born_3m6m": "2nd Born Quarter", "born_6m9m": "3rd Born Quarter", "born_9m12m": "4th Born Quarter",
@@ -57,7 +61,7 @@ SPLINE_CONFIG["legend_pos"] = {"loc": 'lower center', "bbox_to_anchor": (-1.35,
 # Window comparison plots have a different layout and number of subplots
 WINDOWS_CONFIG = {
     "canvas_size": (2, 3),
-    "time_frames": ["inutero_1m3m", "inutero_3m6m", "inutero_6m9m", "born_1m3m", "born_3m6m", "born_6m9m"],
+    "time_frames": list(TIMEFRAMES_SPEC["timeframes"]["q"]["periods"])[:6],
     "title_labels": {
         "inutero_1m3m": "1st In-Utero Quarter", "inutero_3m6m": "2nd In-Utero Quarter", "inutero_6m9m": "3rd In-Utero Quarter",
         "born_1m3m": "1st Born Quarter", "born_3m6m": "2nd Born Quarter", "born_6m9m": "3rd Born Quarter",
@@ -0,0 +1,249 @@
+import os
+
+import numpy as np
+import xarray as xr
+from scipy import sparse
+
+# Regridding between regular lat/lon grids (e.g. CCKP 0.5° -> ERA5 0.25°) with cached sparse weights.
+#   Bilinear interpolation on a regular grid is separable: regridding a (lat, lon) field X is
+#   Wlat @ X @ Wlon.T, where Wlat and Wlon are sparse matrices with (at most) two weights per
+#   row. The weights only depend on the grids, so they are computed once, saved to an .npz file and
+#   applied to every variable and time step (streamed in blocks of time).
+#   Targets outside the source grid are nan, as with xarray's .interp(method="linear"). A
+#   missing source value makes every target that uses it (with a non-zero weight) missing.
+
+
+def _neighbours(source, target):
+    """Source positions around each target and their linear weights (and whether the target is inside the source range)."""
+    source = np.asarray(source, dtype=np.float64)
+    target = np.asarray(target, dtype=np.float64)
+    order = np.argsort(source, kind="stable")
+    ordered = source[order]
+
+    inside = (target >= ordered[0]) & (target <= ordered[-1])
+    upper = np.clip(np.searchsorted(ordered, target, side="right"), 1, source.size - 1)
+    lower = upper - 1
+    fraction = (target - ordered[lower]) / (ordered[upper] - ordered[lower])
+    return order[lower], order[upper], 1 - fraction, fraction, inside
+
+
+def linear_weights(source, target):
+    """Sparse (n_target, n_source) matrix of linear interpolation weights along one axis.
+
+    Args:
+        source (array-like): source coordinates, ascending or descending.
+        target (array-like): target coordinates.
+
+    Returns:
+        scipy.sparse.csr_matrix: interpolation weights. Rows of targets outside the source range are empty.
+
+    Example:
+        >>> linear_weights([0.0, 1.0, 2.0], [0.5, 2.0, 3.0]).toarray()
+        array([[0.5, 0.5, 0. ],
+               [0. , 0. , 1. ],
+               [0. , 0. , 0. ]])
+    """
+    lower, upper, w_lower, w_upper, inside = _neighbours(source, target)
+    rows = np.flatnonzero(inside)
+    weights = sparse.csr_matrix(
+        (
+            np.concatenate([w_lower[rows], w_upper[rows]]),
+            (np.concatenate([rows, rows]), np.concatenate([lower[rows], upper[rows]])),
+        ),
+        shape=(len(target), len(source)),
+    )
+    # Exact matches leave a zero weight, drop it so that a missing neighbour doesn't propagate
+    weights.eliminate_zeros()
+    return weights
+
+
+def bilinear_weights(source_lat, source_lon, target_lat, target_lon):
+    """Separable bilinear weights between two regular grids.
+
+    Returns:
+        dict: "lat" and "lon" sparse weight matrices, and the coordinates of both grids.
+    """
+    return {
+        "lat": linear_weights(source_lat, target_lat),
+        "lon": linear_weights(source_lon, target_lon),
+        "source_lat": np.asarray(source_lat, dtype=np.float64),
+        "source_lon": np.asarray(source_lon, dtype=np.float64),
+        "target_lat": np.asarray(target_lat, dtype=np.float64),
+        "target_lon": np.asarray(target_lon, dtype=np.float64),
+    }
+
+
+def save_weights(weights, path):
+    """Saves bilinear_weights to an .npz file."""
+    arrays = {}
+    for axis in ["lat", "lon"]:
+        matrix = weights[axis].tocsr()
+        arrays.update(
+            {
+                f"{axis}_data": matrix.data,
+                f"{axis}_indices": matrix.indices,
+                f"{axis}_indptr": matrix.indptr,
+                f"{axis}_shape": np.array(matrix.shape),
+            }
+        )
+    for coord in ["source_lat", "source_lon", "target_lat", "target_lon"]:
+        arrays[coord] = weights[coord]
+    np.savez(path, **arrays)
+
+
+def load_weights(path):
+    """Loads weights saved with save_weights."""
+    with np.load(path) as arrays:
+        weights = {
+            axis: sparse.csr_matrix(
+                (arrays[f"{axis}_data"], arrays[f"{axis}_indices"], arrays[f"{axis}_indptr"]),
+                shape=tuple(arrays[f"{axis}_shape"]),
+            )
+            for axis in ["lat", "lon"]
+        }
+        for coord in ["source_lat", "source_lon", "target_lat", "target_lon"]:
+            weights[coord] = arrays[coord]
+    return weights
+
+
+def regrid_weights(source, target, path=None):
+    """Bilinear weights from the grid of source to the grid of target, cached in path.
+
+    The cached weights are reused only if they were computed for the same grids.
+
+    Args:
+        source, target (xr.Dataset or xr.DataArray): data with "lat" and "lon" coordinates.
+        path (str, optional): .npz file where the weights are cached.
+    """
+    coords = {
+        "source_lat": source["lat"].values,
+        "source_lon": source["lon"].values,
+        "target_lat": target["lat"].values,
+        "target_lon": target["lon"].values,
+    }
+    if path is not None and os.path.exists(path):
+        weights = load_weights(path)
+        if all(np.array_equal(weights[name], values) for name, values in coords.items()):
+            return weights
+        print(f"Cached weights in {path} are for other grids, recomputing...")
+    weights = bilinear_weights(*coords.values())
+    if path is not None:
+        save_weights(weights, path)
+    return weights
+
+
+def apply_weights(values, weights):
+    """Regrids a (..., lat, lon) array with the weights: Wlat @ X @ Wlon.T for every leading index.
+
+    Returns:
+        np.ndarray: float32 array of shape (..., n_target_lat, n_target_lon).
+    """
+    w_lat, w_lon = weights["lat"], weights["lon"]
+    values = np.asarray(values, dtype=np.float64)
+    leading = values.shape[:-2]
+    n_lat, n_lon = values.shape[-2:]
+    n_steps = int(np.prod(leading))
+
+    # (steps, lat, lon) -> (lat, steps * lon), regrid lat -> (target lat, steps, lon)
+    stacked = values.reshape(n_steps, n_lat, n_lon).transpose(1, 0, 2).reshape(n_lat, n_steps * n_lon)
+    stacked = (w_lat @ stacked).reshape(-1, n_lon)
+    # (target lat * steps, lon) -> regrid lon -> (target lat, steps, target lon)
+    stacked = (w_lon @ stacked.T).T.reshape(w_lat.shape[0], n_steps, w_lon.shape[0])
+    regridded = stacked.transpose(1, 0, 2).reshape(leading + (w_lat.shape[0], w_lon.shape[0]))
+
+    # Targets outside the source grid
+    outside = (w_lat.getnnz(axis=1) == 0)[:, None] | (w_lon.getnnz(axis=1) == 0)[None, :]
+    regridded[..., outside] = np.nan
+    return regridded.astype(np.float32)
+
+
+def regrid(ds, weights):
+    """Regrids every variable of a dataset (or a DataArray) to the target grid of the weights.
+
+    Lazy: with dask-backed data each block of time steps is regridded when it's computed, so
+    writing the output streams through the data. lat and lon must be a single chunk.
+
+    Returns:
+        xr.Dataset or xr.DataArray: same variables on the target grid.
+    """
+    regridded = xr.apply_ufunc(
+        apply_weights,
+        ds,
+        kwargs={"weights": weights},
+        input_core_dims=[["lat", "lon"]],
+        output_core_dims=[["target_lat", "target_lon"]],
+        dask="parallelized",
+        output_dtypes=[np.float32],
+        dask_gufunc_kwargs={
+            "output_sizes": {"target_lat": weights["target_lat"].size, "target_lon": weights["target_lon"].size}
+        },
+    )
+    regridded = regridded.rename(target_lat="lat", target_lon="lon")
+    return regridded.assign_coords(lat=weights["target_lat"], lon=weights["target_lon"])
+
+
+#### Point sampling ####
+# When only a few target cells are needed (e.g. the cells with DHS clusters), each one is the
+#   weighted sum of (at most) the 4 source cells around it: a sparse (n_points, n_lat * n_lon)
+#   matrix applied to the flattened fields.
+
+
+def point_weights(source_lat, source_lon, lat, lon):
+    """Sparse (n_points, n_lat * n_lon) bilinear weights of points on a regular source grid.
+
+    Args:
+        source_lat, source_lon (array-like): coordinates of the source grid.
+        lat, lon (array-like): coordinates of the points.
+
+    Returns:
+        scipy.sparse.csr_matrix: weights over the flattened (lat, lon) source grid. Rows of points
+            outside the grid are empty.
+    """
+    n_lon = len(source_lon)
+    lat_lower, lat_upper, lat_w_lower, lat_w_upper, lat_inside = _neighbours(source_lat, lat)
+    lon_lower, lon_upper, lon_w_lower, lon_w_upper, lon_inside = _neighbours(source_lon, lon)
+    rows = np.flatnonzero(lat_inside & lon_inside)
+
+    columns, data = [], []
+    for lat_idx, lat_w in [(lat_lower, lat_w_lower), (lat_upper, lat_w_upper)]:
+        for lon_idx, lon_w in [(lon_lower, lon_w_lower), (lon_upper, lon_w_upper)]:
+            columns += [lat_idx[rows] * n_lon + lon_idx[rows]]
+            data += [lat_w[rows] * lon_w[rows]]
+    weights = sparse.csr_matrix(
+        (np.concatenate(data), (np.tile(rows, 4), np.concatenate(columns))),
+        shape=(len(lat), len(source_lat) * n_lon),
+    )
+    weights.eliminate_zeros()
+    return weights
+
+
+def apply_point_weights(values, weights):
+    """Samples a (..., lat, lon) array at the points of the weights.
+
+    Returns:
+        np.ndarray: float32 array of shape (..., n_points).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    leading = values.shape[:-2]
+    flat = values.reshape(-1, values.shape[-2] * values.shape[-1])
+    sampled = (weights @ flat.T).T
+    sampled[:, weights.getnnz(axis=1) == 0] = np.nan
+    return sampled.reshape(leading + (weights.shape[0],)).astype(np.float32)
+
+
+def regrid_points(ds, weights, dim="cell"):
+    """Samples every variable of a dataset at the points of the weights (lazy, see regrid).
+
+    Returns:
+        xr.Dataset or xr.DataArray: same variables with a `dim` dimension instead of lat/lon.
+    """
+    return xr.apply_ufunc(
+        apply_point_weights,
+        ds,
+        kwargs={"weights": weights},
+        input_core_dims=[["lat", "lon"]],
+        output_core_dims=[[dim]],
+        dask="parallelized",
+        output_dtypes=[np.float32],
+        dask_gufunc_kwargs={"output_sizes": {dim: weights.shape[0]}},
+    )
@@ -0,0 +1,350 @@
+import os
+import json
+
+import numpy as np
+from numba import njit, prange
+
+# Stats are computed over each child's 45-month climate series (9 months in utero + 36 months born).
+#   Instead of rescanning every slice with np.nanmean/np.nanmax/np.nanmin for every variable,
+#   period and window, we build NaN-aware cumulative sums/counts and sparse tables for min/max
+#   once per series. Every window average, max or min then costs O(1).
+
+
+@njit(cache=True)
+def _nan_max(a, b):
+    if np.isnan(a):
+        return b
+    if np.isnan(b):
+        return a
+    return a if a >= b else b
+
+
+@njit(cache=True)
+def _nan_min(a, b):
+    if np.isnan(a):
+        return b
+    if np.isnan(b):
+        return a
+    return a if a <= b else b
+
+
+@njit(cache=True)
+def _n_levels(n_timesteps):
+    """Number of levels of the sparse table needed to cover a series of n_timesteps."""
+    n_levels = 1
+    while (1 << n_levels) <= n_timesteps:
+        n_levels += 1
+    return n_levels
+
+
+@njit(cache=True)
+def _prefix_tables(data_array):
+    """Builds the prefix tables of a (n_vars, n_timesteps) series.
+
+    Returns:
+        csum (n_vars, n_timesteps + 1): cumulative sum of the non-nan values (float64).
+        ccount (n_vars, n_timesteps + 1): cumulative count of the non-nan values.
+        smax, smin (n_levels, n_vars, n_timesteps): sparse tables, where smax[k, v, t] is the
+            nanmax of data_array[v, t : t + 2**k].
+    """
+    n_vars, n_timesteps = data_array.shape
+    n_levels = _n_levels(n_timesteps)
+
+    csum = np.zeros((n_vars, n_timesteps + 1), dtype=np.float64)
+    ccount = np.zeros((n_vars, n_timesteps + 1), dtype=np.int32)
+    smax = np.full((n_levels, n_vars, n_timesteps), np.nan, dtype=np.float32)
+    smin = np.full((n_levels, n_vars, n_timesteps), np.nan, dtype=np.float32)
+
+    for var_pos in range(n_vars):
+        for t in range(n_timesteps):
+            value = data_array[var_pos, t]
+            if np.isnan(value):
+                csum[var_pos, t + 1] = csum[var_pos, t]
+                ccount[var_pos, t + 1] = ccount[var_pos, t]
+            else:
+                csum[var_pos, t + 1] = csum[var_pos, t] + value
+                ccount[var_pos, t + 1] = ccount[var_pos, t] + 1
+            smax[0, var_pos, t] = value
+            smin[0, var_pos, t] = value
+
+    for level in range(1, n_levels):
+        half = 1 << (level - 1)
+        for var_pos in range(n_vars):
+            for t in range(n_timesteps - (1 << level) + 1):
+                smax[level, var_pos, t] = _nan_max(smax[level - 1, var_pos, t], smax[level - 1, var_pos, t + half])
+                smin[level, var_pos, t] = _nan_min(smin[level - 1, var_pos, t], smin[level - 1, var_pos, t + half])
+
+    return csum, ccount, smax, smin
+
+
+@njit(cache=True)
+def _window_stat(csum, ccount, smax, smin, var_pos, start_idx, end_idx, window):
+    """Stat of data_array[var_pos, start_idx : end_idx + 1] from the prefix tables.
+
+    window == -1 is the max, window == -2 the min, anything else the mean.
+    """
+    if window == -1 or window == -2:
+        length = end_idx - start_idx + 1
+        level = 0
+        while (2 << level) <= length:
+            level += 1
+        right = end_idx - (1 << level) + 1
+        if window == -1:
+            return _nan_max(smax[level, var_pos, start_idx], smax[level, var_pos, right])
+        return _nan_min(smin[level, var_pos, start_idx], smin[level, var_pos, right])
+
+    count = ccount[var_pos, end_idx + 1] - ccount[var_pos, start_idx]
+    if count == 0:
+        return np.nan
+    return (csum[var_pos, end_idx + 1] - csum[var_pos, start_idx]) / count
+
+
+@njit(cache=True)
+def _period_stats(csum, ccount, smax, smin, start_idx, end_idx, window_sizes, death_month_index, row, col):
+    """Writes the stats of a period for every variable and window to row[col:], from the prefix tables.
+
+    Returns:
+        int: position in row after the stats of the period.
+    """
+    n_vars = csum.shape[0]
+    n_windows = len(window_sizes)
+    n_timesteps = smax.shape[2]
+    if death_month_index != -1:
+        # Case 1: Death happened BEFORE this period even started.
+        # The entire period has irrelevant data, assign nan.
+        if death_month_index < start_idx:
+            row[col : col + n_vars * n_windows] = np.nan
+            return col + n_vars * n_windows
+
+        # Case 2: Death happened during or after this period.
+        # We must truncate the period's end to the death month.
+        end_idx = min(end_idx, death_month_index)
+
+    for window_pos in range(n_windows):
+        window = window_sizes[window_pos]
+
+        if (window == 0) | (window == -1) | (window == -2):
+            # Window 0 is unbounded, -1 is max, -2 is min
+            avg_start_idx = start_idx
+        elif window > 0:
+            # Average the previous {windows} months
+            avg_start_idx = end_idx - window + 1
+        else:
+            raise ValueError("windows has to be 0 or positive!!")
+
+        if avg_start_idx > end_idx or end_idx >= n_timesteps or avg_start_idx < 0:
+            #   avg_start_idx > end_idx: This should never happen but is a safety check
+            #   end_idx >= n_timesteps: This could happen if the data ingested is shorter that what is expected!
+            #   avg_start_idx < 0 is an error: requiring a window larger than loaded data
+            raise ValueError("There is some issue with the data ingested!")
+
+        for var_pos in range(n_vars):
+            row[col + var_pos * n_windows + window_pos] = _window_stat(
+                csum, ccount, smax, smin, var_pos, avg_start_idx, end_idx, window
+            )
+    return col + n_vars * n_windows
+
+
+# Every child is assigned the same 45-month series: 9 months in utero + 36 months born.
+N_MONTHS = 45
+N_MONTHS_IN_UTERO = 9
+
+
+def gather_windows(cube, lat_idx, lon_idx, time_idx, n_months=N_MONTHS):
+    """Gathers the climate series of many points at once with fancy indexing.
+
+    Args:
+        cube (np.ndarray): climate array of shape (n_vars, n_time, n_lat, n_lon).
+        lat_idx, lon_idx (np.ndarray): integer position of each point in the lat/lon axes of the cube.
+        time_idx (np.ndarray): integer position of the first month of each point in the time axis.
+        n_months (int): length of the series of each point.
+
+    Returns:
+        np.ndarray: float32 array of shape (n_points, n_vars, n_months).
+    """
+    lat_idx = np.asarray(lat_idx, dtype=np.intp)
+    lon_idx = np.asarray(lon_idx, dtype=np.intp)
+    time_idx = np.asarray(time_idx, dtype=np.intp)
+
+    n_time, n_lat, n_lon = cube.shape[1:]
+    if (lat_idx < 0).any() or (lat_idx >= n_lat).any() or (lon_idx < 0).any() or (lon_idx >= n_lon).any():
+        raise ValueError("Some points fall outside the lat/lon grid of the climate data!")
+    if (time_idx < 0).any() or (time_idx + n_months > n_time).any():
+        raise ValueError("Some points require climate data outside the time range loaded!")
+
+    months = time_idx[:, None] + np.arange(n_months)
+    windows = cube[:, months, lat_idx[:, None], lon_idx[:, None]]  # (n_vars, n_points, n_months)
+    return np.ascontiguousarray(windows.transpose(1, 0, 2), dtype=np.float32)
+
+
+@njit(parallel=True, cache=True)
+def compute_stats_table(windows, starts, ends, window_offsets, window_sizes, row_offsets, death_month_indices):
+    """Computes every period of a fused timeframe table (see fuse_timeframes) over a block of series.
+
+    The prefix tables of each series are built once and shared by all the periods and by all the
+    rows of the series, and every stat is written straight into its row of the output matrix: one
+    call per block of points. A series has one row per month of death its periods are truncated at:
+    a period that starts after the death is nan and any other ends at the month of death at the
+    latest. Children of the same point who died in different months share the work.
+
+    Args:
+        windows (np.ndarray): float32 array of shape (n_points, n_vars, n_timesteps).
+        starts, ends (np.ndarray): 0-based index of the first and last month of each period of the table.
+        window_offsets (np.ndarray): the windows of period p are window_sizes[window_offsets[p]:window_offsets[p + 1]].
+        window_sizes (np.ndarray): windows of all the periods, concatenated. 0 averages the full period,
+            -1 is the max of the period, -2 the min of the period and a positive value averages the
+            previous {window} months.
+        row_offsets (np.ndarray): the rows of point i are rows row_offsets[i]:row_offsets[i + 1] of the output.
+        death_month_indices (np.ndarray): month of death of each row (-1 to not truncate the periods).
+
+    Returns:
+        np.ndarray: float32 array of shape (n_rows, n_columns), ordered as the columns of the table.
+    """
+    n_points, n_vars = windows.shape[0], windows.shape[1]
+    n_periods = len(ends)
+    n_columns = 0
+    for time_pos in range(n_periods):
+        n_columns += n_vars * (window_offsets[time_pos + 1] - window_offsets[time_pos])
+    results = np.empty((row_offsets[n_points], n_columns), dtype=np.float32)
+
+    for point_pos in prange(n_points):
+        csum, ccount, smax, smin = _prefix_tables(windows[point_pos])
+        for row_pos in range(row_offsets[point_pos], row_offsets[point_pos + 1]):
+            col = 0
+            for time_pos in range(n_periods):
+                period_windows = window_sizes[window_offsets[time_pos] : window_offsets[time_pos + 1]]
+                col = _period_stats(
+                    csum, ccount, smax, smin, starts[time_pos], ends[time_pos], period_windows,
+                    death_month_indices[row_pos], results[row_pos], col,
+                )
+    return results
+
+
+def death_month_index(age_at_death, n_months=N_MONTHS):
+    """Month of death in the series of each child (birth is month N_MONTHS_IN_UTERO).
+
+    Args:
+        age_at_death (array-like): age at death in months, NaN for the children alive.
+
+    Returns:
+        np.ndarray: int32 index of the month of death, -1 for the children alive or who died after
+            the last month of the series, whose periods are not truncated.
+    """
+    death_month = N_MONTHS_IN_UTERO + np.asarray(age_at_death, dtype=np.float64)
+    return np.where(death_month < n_months, death_month, -1).astype(np.int32)
+
+
+#### Timeframes ####
+# The periods and windows of the stats are declared once in timeframes.json: for each timeframe
+#   (e.g. "q" for quarters), its periods as the index of their last month in the 45-month series
+#   (the period starts the month after the previous one ends) or as [first, last] months, and its
+#   windows (see compute_stats_table). compile_timeframes turns it into the start/end arrays the kernels
+#   take and the names of the columns they fill. Adding an exposure window is a change in the file.
+#   Its "merge_order" sets the order of the periods and timeframes in the columns of stage 03.
+
+TIMEFRAMES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "timeframes.json")
+
+
+def load_timeframes(path=TIMEFRAMES_PATH):
+    """Reads the timeframe spec (see timeframes.json)."""
+    with open(path) as file:
+        return json.load(file)
+
+
+def window_stat(window):
+    """Name of the stat of a window in the column names: avg, max, min or w{window}."""
+    return {0: "avg", -1: "max", -2: "min"}.get(int(window), f"w{window}")
+
+
+def merge_ordered(names, order):
+    """names in the order of the list order, followed by the ones it doesn't list (in their own order).
+
+    Raises:
+        ValueError: if order lists a name that is not in names.
+    """
+    unknown = [name for name in order if name not in names]
+    if unknown:
+        raise ValueError(f"The merge order of timeframes.json lists {unknown}, which are not in the timeframes")
+    return list(order) + [name for name in names if name not in order]
+
+
+def timeframe_stats(spec):
+    """Suffixes "{timeframe}_{stat}" of the columns of every timeframe and window, e.g. "q_avg" or "b_w3".
+
+    Timeframes follow the "merge_order" of the spec, if any.
+    """
+    names = merge_ordered(list(spec["timeframes"]), spec.get("merge_order", {}).get("timeframes", []))
+    return [f"{name}_{window_stat(window)}" for name in names for window in spec["timeframes"][name]["windows"]]
+
+
+def timeframe_periods(spec):
+    """Names of the periods of every timeframe, without repetitions, in the "merge_order" of the spec or of appearance."""
+    periods = list(dict.fromkeys(period for timeframe in spec["timeframes"].values() for period in timeframe["periods"]))
+    return merge_ordered(periods, spec.get("merge_order", {}).get("periods", []))
+
+
+def compile_timeframes(spec, climate_variables):
+    """Compiles the timeframe spec into the start/end/window arrays of each timeframe and the names of its columns.
+
+    Args:
+        spec (dict): timeframe spec, see load_timeframes.
+        climate_variables (list): climate variables, in the order of the series.
+
+    Returns:
+        dict: for each timeframe, a dict with int32 "starts", "ends" and "windows" arrays and
+            its "columns" ("{var}_{period}_{timeframe}_{stat}", ordered by period, variable and
+            window as the kernel fills them).
+
+    Raises:
+        ValueError: if a period is outside the series or ends before it starts.
+    """
+    n_months = spec.get("n_months", N_MONTHS)
+    compiled = {}
+    for name, timeframe in spec["timeframes"].items():
+        starts, ends = [], []
+        for period in timeframe["periods"].values():
+            if isinstance(period, list):
+                start, end = period
+            else:
+                start, end = (ends[-1] + 1 if ends else 0), period
+            if not 0 <= start <= end < n_months:
+                raise ValueError(f"Invalid period {period} in timeframe {name}, months go from 0 to {n_months - 1}")
+            starts.append(start)
+            ends.append(end)
+        windows = np.array(timeframe["windows"], dtype=np.int32)
+        compiled[name] = {
+            "starts": np.array(starts, dtype=np.int32),
+            "ends": np.array(ends, dtype=np.int32),
+            "windows": windows,
+            "columns": [
+                f"{var}_{period}_{name}_{window_stat(window)}"
+                for period in timeframe["periods"]
+                for var in climate_variables
+                for window in windows
+            ],
+        }
+    return compiled
+
+
+def fuse_timeframes(compiled):
+    """Concatenates compiled timeframes (see compile_timeframes) into a single period table for compute_stats_table.
+
+    Returns:
+        dict: int32 "starts" and "ends" of every period, "window_offsets" (n_periods + 1) into the
+            concatenated "windows", and all the "columns" in the order compute_stats_table fills them.
+    """
+    starts, ends, windows, window_offsets, columns = [], [], [], [0], []
+    for timeframe in compiled.values():
+        for start, end in zip(timeframe["starts"], timeframe["ends"]):
+            starts.append(start)
+            ends.append(end)
+            windows.extend(timeframe["windows"])
+            window_offsets.append(len(windows))
+        columns.extend(timeframe["columns"])
+    return {
+        "starts": np.array(starts, dtype=np.int32),
+        "ends": np.array(ends, dtype=np.int32),
+        "window_offsets": np.array(window_offsets, dtype=np.int32),
+        "windows": np.array(windows, dtype=np.int32),
+        "columns": columns,
+    }
@@ -0,0 +1,341 @@
+import numpy as np
+import xarray as xr
+from scipy import special
+from climate_indices import compute
+
+# SPI for several scales in a single pass over each point's precipitation series.
+#   The rolling sums of every scale come from one cumulative sum of the series, and the gamma
+#   distributions of every scale are fitted in the same call, so the precipitation cube is read
+#   and stacked once instead of once per scale.
+
+SPI_SCALES = [1, 3, 6, 9, 12, 24, 48]
+
+# Same bounds used by climate_indices to clip the fitted values
+SPI_MIN, SPI_MAX = -3.09, 3.09
+
+
+def rolling_sums(precip, scales):
+    """Rolling sums of a series for several scales from a single cumulative sum.
+
+    Same as climate_indices.compute.sum_to_scale: the first (scale - 1) values are nan, and so is
+    any sum whose window contains a missing value.
+
+    Args:
+        precip (np.ndarray): array with time as the first axis, (time,) or (time, points).
+        scales (list): number of time steps of each rolling sum.
+
+    Returns:
+        np.ndarray: float64 array of shape (n_scales, *precip.shape).
+
+    Example:
+        >>> rolling_sums(np.array([3., 4, 6, 2, 1, 3, 5, 8, 5]), [3])[0]
+        array([nan, nan, 13., 12.,  9.,  6.,  9., 16., 18.])
+    """
+    precip = np.asarray(precip, dtype=np.float64)
+    missing = np.isnan(precip)
+    zeros = np.zeros((1,) + precip.shape[1:])
+    csum = np.concatenate([zeros, np.cumsum(np.where(missing, 0, precip), axis=0)])
+    cmissing = np.concatenate([zeros, np.cumsum(missing, axis=0)])
+
+    sums = np.full((len(scales),) + precip.shape, np.nan)
+    for i, scale in enumerate(scales):
+        window_sums = csum[scale:] - csum[:-scale]
+        window_missing = cmissing[scale:] - cmissing[:-scale]
+        sums[i, scale - 1 :] = np.where(window_missing > 0, np.nan, window_sums)
+    return sums
+
+
+def compute_spi_multiscale(
+    precip_series, scales, data_start_year, calibration_year_initial, calibration_year_final, periodicity
+):
+    """SPI of a single precipitation series for several scales, fitted to a gamma distribution.
+
+    Equivalent to calling climate_indices.indices.spi once per scale, but the series is clipped
+    and accumulated only once.
+
+    Returns:
+        np.ndarray: float32 array of shape (n_scales, time).
+    """
+    # Ensure the array is writable. Negative values are set to zero, as in climate_indices
+    precip = np.clip(np.array(precip_series, dtype=np.float64), 0, None)
+    n_times = precip.size
+    spis = np.full((len(scales), n_times), np.nan, dtype=np.float32)
+    if np.all(np.isnan(precip)):
+        return spis
+
+    sums = rolling_sums(precip, scales)
+    for i in range(len(scales)):
+        fitted = compute.transform_fitted_gamma(
+            sums[i],
+            data_start_year,
+            calibration_year_initial,
+            calibration_year_final,
+            periodicity,
+        )
+        spis[i] = np.clip(fitted, SPI_MIN, SPI_MAX).flatten()[:n_times]
+    return spis
+
+
+#### Native engine ####
+# Gamma fits per calendar month vectorized over a whole (time, point) block with NumPy/SciPy,
+#   instead of calling climate_indices one point at a time. Follows climate_indices:
+#   - Negative precipitation is set to zero and zeros are left out of the gamma fit.
+#   - The probability of zero is the share of zeros in the non-missing calibration values.
+#   - SPI = Φ⁻¹(p0 + (1 - p0) * G(x)), where G is the fitted gamma CDF, clipped to [-3.09, 3.09].
+#   - A zero is Φ⁻¹(p0) even if no gamma could be fitted. A calendar month with only zeros in the
+#     calibration period takes p0 = 0, so its zeros are clipped to -3.09 (extreme drought).
+#   - Less than 2 positive calibration values fit no gamma, and the positive values are nan.
+
+
+def _to_years(values, n_years):
+    """(time, points) -> (n_years, 12, points), padding the last year with nan."""
+    n_times, n_points = values.shape
+    padded = np.full((n_years * 12, n_points), np.nan)
+    padded[:n_times] = values
+    return padded.reshape(n_years, 12, n_points)
+
+
+def calibration_rows(data_start_year, n_years, calibration_year_initial, calibration_year_final):
+    """Years (rows) used to fit the distributions. The full record if it doesn't cover the calibration period."""
+    data_end_year = data_start_year + n_years - 1
+    if calibration_year_initial < data_start_year or calibration_year_final > data_end_year:
+        return slice(0, n_years)
+    return slice(calibration_year_initial - data_start_year, calibration_year_final - data_start_year + 1)
+
+
+def fit_gamma_block(calibration, method="mle"):
+    """Fits a gamma distribution to each calendar month and point.
+
+    Args:
+        calibration (np.ndarray): calibration values of shape (n_years, 12, n_points).
+        method (str): "mle" uses Thom's (1958) approximation of the maximum likelihood estimates,
+            as climate_indices does. "lmoments" uses Hosking's (1990) L-moment estimates.
+
+    Returns:
+        dict: "alpha" (shape), "beta" (scale) and "prob_zero" arrays of shape (12, n_points).
+    """
+    calibration = np.asarray(calibration, dtype=np.float64)
+    n_valid = np.sum(~np.isnan(calibration), axis=0)
+    n_zeros = np.sum(calibration == 0, axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        prob_zero = np.where(n_valid > 0, n_zeros / n_valid, np.nan)
+
+        # Zeros are left out of the fit
+        positive = np.where(calibration > 0, calibration, np.nan)
+        n_positive = np.sum(~np.isnan(positive), axis=0)
+        means = np.nansum(positive, axis=0) / n_positive
+
+        if method == "mle":
+            mean_logs = np.nansum(np.log(positive), axis=0) / n_positive
+            a = np.log(means) - mean_logs
+            alphas = (1 + np.sqrt(1 + 4 * a / 3)) / (4 * a)
+        elif method == "lmoments":
+            # Sample L-moments from the probability weighted moments (nans are sorted last)
+            ordered = np.sort(positive, axis=0)
+            ranks = np.arange(ordered.shape[0]).reshape(-1, *([1] * (ordered.ndim - 1)))
+            b1 = np.nansum(ranks / (n_positive - 1) * ordered, axis=0) / n_positive
+            l2 = 2 * b1 - means
+            t = l2 / means
+            # Rational approximation of the shape from the L-CV (Hosking, 1990)
+            z = np.where(t < 0.5, np.pi * t**2, 1 - t)
+            alphas = np.where(
+                t < 0.5,
+                (1 - 0.3080 * z) / (z - 0.05812 * z**2 + 0.01765 * z**3),
+                (0.7213 * z - 0.5947 * z**2) / (1 - 2.1817 * z + 1.2113 * z**2),
+            )
+        else:
+            raise ValueError(f"Unknown gamma fitting method: {method}. Use 'mle' or 'lmoments'.")
+        betas = means / alphas
+
+    # A single positive value gives an infinite shape in climate_indices, whose CDF is nan
+    invalid = ~np.isfinite(alphas) | ~np.isfinite(betas) | (alphas <= 0) | (n_positive < 2)
+    alphas = np.where(invalid, np.nan, alphas)
+    betas = np.where(invalid, np.nan, betas)
+    return {"alpha": alphas, "beta": betas, "prob_zero": prob_zero}
+
+
+def transform_gamma_block(values, params):
+    """Transforms (n_years, 12, n_points) values to SPI with the fitted gamma parameters."""
+    alphas, betas, prob_zero = params["alpha"], params["beta"], params["prob_zero"]
+    # A step with only zeros has no distribution fitted, its zeros are taken as the driest values
+    prob_zero = np.where(prob_zero >= 1, 0, prob_zero)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Zeros only have the probability of zero, whether a gamma was fitted or not
+        gamma_probabilities = np.where(values > 0, special.gammainc(alphas, np.where(values > 0, values, 0) / betas), 0)
+        probabilities = prob_zero + (1 - prob_zero) * gamma_probabilities
+        probabilities = np.where(np.isnan(values), np.nan, probabilities)
+        return np.clip(special.ndtri(probabilities), SPI_MIN, SPI_MAX)
+
+
+def spi_block(precip, scales, data_start_year, calibration_year_initial, calibration_year_final, method="mle"):
+    """SPI for several scales over a whole (time, point) block of monthly precipitation.
+
+    Args:
+        precip (np.ndarray): monthly precipitation of shape (time, n_points), starting in January of data_start_year.
+        scales (list): SPI scales, in months.
+        data_start_year (int): first year of the data.
+        calibration_year_initial, calibration_year_final (int): years used to fit the distributions.
+        method (str): gamma fitting method, see fit_gamma_block.
+
+    Returns:
+        np.ndarray: float32 array of shape (n_scales, time, n_points).
+    """
+    precip = np.clip(np.asarray(precip, dtype=np.float64), 0, None)
+    n_times, n_points = precip.shape
+    n_years = -(-n_times // 12)
+    rows = calibration_rows(data_start_year, n_years, calibration_year_initial, calibration_year_final)
+
+    spis = np.full((len(scales), n_times, n_points), np.nan, dtype=np.float32)
+    sums = rolling_sums(precip, scales)
+    for i in range(len(scales)):
+        values = _to_years(sums[i], n_years)
+        params = fit_gamma_block(values[rows], method=method)
+        spis[i] = transform_gamma_block(values, params).reshape(n_years * 12, n_points)[:n_times]
+    return spis
+
+
+#### Incremental updates ####
+# The gamma parameters only depend on the calibration period, so once fitted they are kept and the
+#   SPI of newly appended months is computed from the last (max scale - 1) months before them.
+
+SPI_PARAMS = ["alpha", "beta", "prob_zero"]
+
+
+def fit_spi_block(precip, scales, data_start_year, calibration_year_initial, calibration_year_final, method="mle"):
+    """Gamma parameters of every scale for a (time, point) block, as fitted by spi_block.
+
+    Returns:
+        dict: "alpha", "beta" and "prob_zero" arrays of shape (n_scales, 12, n_points).
+    """
+    precip = np.clip(np.asarray(precip, dtype=np.float64), 0, None)
+    n_years = -(-precip.shape[0] // 12)
+    rows = calibration_rows(data_start_year, n_years, calibration_year_initial, calibration_year_final)
+
+    sums = rolling_sums(precip, scales)
+    params = [fit_gamma_block(_to_years(sums[i], n_years)[rows], method=method) for i in range(len(scales))]
+    return {key: np.stack([scale_params[key] for scale_params in params]) for key in SPI_PARAMS}
+
+
+def spi_tail_block(precip, months, scales, params, n_new):
+    """SPI of the last n_new steps of a (time, point) block with already fitted parameters.
+
+    Args:
+        precip (np.ndarray): monthly precipitation of shape (time, n_points). Must include the
+            (max(scales) - 1) steps before the new ones.
+        months (np.ndarray): calendar month (1-12) of each step.
+        params (dict): output of fit_spi_block.
+        n_new (int): number of steps to compute, counted from the end.
+
+    Returns:
+        np.ndarray: float32 array of shape (n_scales, n_new, n_points).
+    """
+    precip = np.clip(np.asarray(precip, dtype=np.float64), 0, None)
+    sums = rolling_sums(precip, scales)[:, -n_new:]
+    months = np.ravel(months)[-n_new:] - 1
+
+    spis = np.full((len(scales), n_new, precip.shape[1]), np.nan, dtype=np.float32)
+    for i in range(len(scales)):
+        step_params = {key: params[key][i][months] for key in SPI_PARAMS}
+        spis[i] = transform_gamma_block(sums[i], step_params)
+    return spis
+
+
+def spi_params(da_precip, scales, data_start_year, calibration_year_initial, calibration_year_final, method="mle"):
+    """Fitted gamma parameters of every scale for every point of a (time, point) DataArray.
+
+    Returns:
+        xr.Dataset: alpha, beta and prob_zero, with dimensions (point, scale, month).
+    """
+    params = xr.apply_ufunc(
+        lambda x: tuple(
+            values.transpose(2, 0, 1)
+            for values in fit_spi_block(
+                x.T, scales, data_start_year, calibration_year_initial, calibration_year_final, method
+            ).values()
+        ),
+        da_precip,
+        input_core_dims=[["time"]],
+        output_core_dims=[["scale", "month"]] * len(SPI_PARAMS),
+        output_dtypes=[np.float64] * len(SPI_PARAMS),
+        dask="parallelized",
+        dask_gufunc_kwargs={"output_sizes": {"scale": len(scales), "month": 12}},
+    )
+    params = xr.Dataset(dict(zip(SPI_PARAMS, params)))
+    return params.assign_coords(scale=scales, month=np.arange(1, 13))
+
+
+def spi_tail(da_precip, params, n_new):
+    """SPI of the last n_new months of a (time, point) DataArray with the parameters from spi_params.
+
+    da_precip must include the (max scale - 1) months before the new ones.
+
+    Returns:
+        xr.Dataset: one spi{scale} variable per scale, with the last n_new months of da_precip.
+    """
+    scales = [int(scale) for scale in params["scale"].values]
+    da_spis = xr.apply_ufunc(
+        lambda x, months, *values: spi_tail_block(
+            x.T, months, scales, {key: v.transpose(1, 2, 0) for key, v in zip(SPI_PARAMS, values)}, n_new
+        ).transpose(2, 0, 1),
+        da_precip,
+        da_precip["time"].dt.month,
+        *[params[key] for key in SPI_PARAMS],
+        input_core_dims=[["time"], ["time"]] + [["scale", "month"]] * len(SPI_PARAMS),
+        output_core_dims=[["scale", "new_time"]],
+        output_dtypes=[np.float32],
+        dask="parallelized",
+        dask_gufunc_kwargs={"output_sizes": {"new_time": n_new}},
+    )
+    da_spis = da_spis.rename(new_time="time").assign_coords(time=da_precip["time"].values[-n_new:])
+    return xr.Dataset({f"spi{scale}": da_spis.isel(scale=i, drop=True) for i, scale in enumerate(scales)})
+
+
+def spi_multiscale(
+    da_precip, scales, data_start_year, calibration_year_initial, calibration_year_final, periodicity, engine="native"
+):
+    """Computes the SPI of every scale for every point of a (time, point) precipitation DataArray.
+
+    Args:
+        engine (str): "native" fits whole blocks of points at once (monthly data only), "climate_indices"
+            calls compute_spi_multiscale on each point.
+
+    Returns:
+        xr.Dataset: one spi{scale} variable per scale, with the dimensions of da_precip.
+    """
+    if engine == "native":
+        if periodicity is not compute.Periodicity.monthly:
+            raise ValueError("The native SPI engine only supports monthly data!")
+        # apply_ufunc moves the core dim last: (point, time) -> (scale, time, point) -> (point, scale, time)
+        da_spis = xr.apply_ufunc(
+            lambda x: spi_block(
+                x.T, scales, data_start_year, calibration_year_initial, calibration_year_final
+            ).transpose(2, 0, 1),
+            da_precip,
+            input_core_dims=[["time"]],
+            output_core_dims=[["scale", "time"]],
+            output_dtypes=[np.float32],
+            dask="parallelized",
+            dask_gufunc_kwargs={"output_sizes": {"scale": len(scales)}},
+        )
+    elif engine == "climate_indices":
+        da_spis = xr.apply_ufunc(
+            compute_spi_multiscale,
+            da_precip,
+            kwargs=dict(
+                scales=scales,
+                data_start_year=data_start_year,
+                calibration_year_initial=calibration_year_initial,
+                calibration_year_final=calibration_year_final,
+                periodicity=periodicity,
+            ),
+            input_core_dims=[["time"]],
+            output_core_dims=[["scale", "time"]],
+            output_dtypes=[np.float32],
+            vectorize=True,
+            dask="parallelized",
+            dask_gufunc_kwargs={"output_sizes": {"scale": len(scales)}},
+        )
+    else:
+        raise ValueError(f"Unknown SPI engine: {engine}. Use 'native' or 'climate_indices'.")
+    return xr.Dataset({f"spi{scale}": da_spis.isel(scale=i, drop=True) for i, scale in enumerate(scales)})
+
@@ -0,0 +1,118 @@
+import os
+
+import numpy as np
+import xarray as xr
+from tqdm import tqdm
+
+# Temperature anomalies.
+#   The four anomaly products (std_t, absdif_t, stdm_t and absdifm_t) all come from the same
+#   calibration climatology: the mean/std of t2m over the calibration period, for the whole year
+#   and for each calendar month. The climatology is accumulated in one pass over the cube and
+#   cached to disk. All the anomalies are then derived together in a second pass.
+
+# Latitude rows read at once when accumulating the climatology
+CLIMATOLOGY_BLOCK = 32
+ANOMALY_VARIABLES = ["std_t", "absdif_t", "stdm_t", "absdifm_t"]
+
+
+def compute_climatology(t2m, block=CLIMATOLOGY_BLOCK):
+    """Annual and monthly mean/std of a monthly temperature series, in a single pass over the cube.
+
+    The cube is read in bands of latitudes with the full time axis (the layout of the climate
+    stores). Counts, sums and sums of squares are accumulated per calendar month (in float64), so
+    the annual statistics come from the same accumulators. Std has ddof=0, as xarray's .std().
+
+    Args:
+        t2m (xr.DataArray): (time, lat, lon) temperature over the calibration period. Better if
+            not dask-backed, bands of `block` latitudes are read with .isel.
+        block (int): number of latitude rows read at once.
+
+    Returns:
+        xr.Dataset: mean and std (lat, lon), mean_m and std_m (month, lat, lon).
+    """
+    t2m = t2m.transpose("time", "lat", "lon")
+    months = t2m["time"].dt.month.values - 1
+    shape = (12,) + t2m.shape[1:]
+    count = np.zeros(shape, dtype=np.int64)
+    total = np.zeros(shape, dtype=np.float64)
+    total_sq = np.zeros(shape, dtype=np.float64)
+
+    for start in tqdm(range(0, t2m.sizes["lat"], block), desc="Climatology"):
+        rows = slice(start, start + block)
+        values = t2m.isel(lat=rows).values.astype(np.float64)
+        valid = np.isfinite(values)
+        values = np.where(valid, values, 0)
+        for month in range(12):
+            steps = months == month
+            count[month, rows] = valid[steps].sum(axis=0)
+            total[month, rows] = values[steps].sum(axis=0)
+            total_sq[month, rows] = (values[steps] ** 2).sum(axis=0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_m = total / count
+        std_m = np.sqrt(np.maximum(total_sq / count - mean_m**2, 0))
+        n = count.sum(axis=0)
+        mean = total.sum(axis=0) / n
+        std = np.sqrt(np.maximum(total_sq.sum(axis=0) / n - mean**2, 0))
+
+    coords = {"lat": t2m["lat"].values, "lon": t2m["lon"].values}
+    return xr.Dataset(
+        {
+            "mean": (("lat", "lon"), mean.astype(np.float32)),
+            "std": (("lat", "lon"), std.astype(np.float32)),
+            "mean_m": (("month", "lat", "lon"), mean_m.astype(np.float32)),
+            "std_m": (("month", "lat", "lon"), std_m.astype(np.float32)),
+        },
+        coords={"month": np.arange(1, 13), **coords},
+    )
+
+
+def load_climatology(t2m, path):
+    """Loads the cached climatology in path, computing (and caching) it from t2m if missing."""
+    if os.path.exists(path):
+        return xr.load_dataset(path)
+    climatology = compute_climatology(t2m)
+    climatology.to_netcdf(path)
+    return climatology
+
+
+def _anomalies_block(values, months, mean, std, mean_m, std_m):
+    # Blocks come as (..., time) and (..., month), months is the calendar month of each timestep
+    months = np.ravel(months) - 1
+    absdif = values - mean[..., None]
+    absdifm = values - mean_m[..., months]
+    std_t = absdif / std[..., None]
+    stdm = absdifm / std_m[..., months]
+    return tuple(out.astype(np.float32) for out in (std_t, absdif, stdm, absdifm))
+
+
+def temperature_anomalies(t2m, climatology):
+    """All the temperature anomalies of t2m against a climatology, as one lazy dataset.
+
+    Every anomaly is computed from the same block of t2m, so writing the dataset reads the
+    temperature cube once.
+
+    Args:
+        t2m (xr.DataArray): (time, lat, lon) temperature, dask-backed with the time axis in one chunk.
+        climatology (xr.Dataset): output of compute_climatology.
+
+    Returns:
+        xr.Dataset: std_t ((t - mean) / std), absdif_t (t - mean), stdm_t and absdifm_t (same, with
+            the climatology of the calendar month), with the calendar "month" of each timestep as a
+            coordinate, as groupby("time.month") anomalies have.
+    """
+    anomalies = xr.apply_ufunc(
+        _anomalies_block,
+        t2m,
+        t2m["time"].dt.month,
+        climatology["mean"],
+        climatology["std"],
+        climatology["mean_m"],
+        climatology["std_m"],
+        input_core_dims=[["time"], ["time"], [], [], ["month"], ["month"]],
+        output_core_dims=[["time"]] * len(ANOMALY_VARIABLES),
+        dask="parallelized",
+        output_dtypes=[np.float32] * len(ANOMALY_VARIABLES),
+    )
+    anomalies = xr.Dataset(dict(zip(ANOMALY_VARIABLES, anomalies))).assign_coords(month=t2m["time"].dt.month)
+    return anomalies.transpose("time", "lat", "lon")
@@ -0,0 +1,103 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from climate_store import open_climate_store
+from daily_tools import daily_indices, percentile_name, spell_runs_path, load_spell_runs
+
+# Resuming the monthly reduction of daily_indices gives the same months as a single run, on a small
+#   synthetic grid with warm spells that cross the year boundaries.
+
+TIMES = pd.date_range("2000-01-01", "2002-12-31", freq="D")
+LAT = np.array([-0.25, 0.0, 0.25])
+LON = np.array([10.0, 10.25])
+# Percentiles of the spells, constant in every calendar day and cell
+TMAX_P90, TMIN_P10 = 30.0, -10.0
+# (first day, last day) of the warm spells, in every cell
+WARM_SPELLS = [
+    ("2000-12-27", "2001-01-04"),  # 9 days across the first year boundary
+    ("2001-03-29", "2001-04-03"),  # 6 days across a month boundary
+    ("2001-12-29", "2002-02-10"),  # a long spell across the second year boundary
+    ("2002-06-01", "2002-06-05"),  # 5 days, too short to count
+]
+
+
+def synthetic_daily(end=None):
+    rng = np.random.default_rng(0)
+    tmax = 20 + rng.normal(size=(len(TIMES), len(LAT), len(LON)))
+    for first, last in WARM_SPELLS:
+        tmax[(TIMES >= first) & (TIMES <= last)] = 35.0
+    tmin = tmax - 10
+    coords = {"time": TIMES, "lat": LAT, "lon": LON}
+    daily = {
+        "tmax": xr.DataArray(tmax.astype(np.float32), dims=("time", "lat", "lon"), coords=coords, name="tmax"),
+        "tmin": xr.DataArray(tmin.astype(np.float32), dims=("time", "lat", "lon"), coords=coords, name="tmin"),
+    }
+    if end is not None:
+        daily = {var: values.sel(time=slice(None, end)) for var, values in daily.items()}
+    return daily
+
+
+def synthetic_thresholds():
+    shape = (365, len(LAT), len(LON))
+    coords = {"dayofyear": np.arange(365), "lat": LAT, "lon": LON}
+    return xr.Dataset(
+        {
+            percentile_name("tmax", 90): (("dayofyear", "lat", "lon"), np.full(shape, TMAX_P90, dtype=np.float32)),
+            percentile_name("tmin", 10): (("dayofyear", "lat", "lon"), np.full(shape, TMIN_P10, dtype=np.float32)),
+        },
+        coords=coords,
+    )
+
+
+def monthly(path):
+    with open_climate_store(path) as ds:
+        return ds.load()
+
+
+@pytest.fixture(scope="module")
+def single_run(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("single") / "indices.zarr")
+    daily_indices(synthetic_daily(), synthetic_thresholds(), path)
+    return monthly(path)
+
+
+def test_spells_across_year_boundaries(single_run):
+    wsdi = single_run["wsdi"].isel(lat=0, lon=0).to_series()
+    wsdi.index = wsdi.index.strftime("%Y-%m")
+    assert wsdi["2000-12"] == 0 and wsdi["2001-01"] == 9
+    assert wsdi["2001-03"] == 0 and wsdi["2001-04"] == 6
+    assert wsdi["2001-12"] == 0 and wsdi["2002-01"] == 31 + 3 and wsdi["2002-02"] == 10
+    assert wsdi["2002-06"] == 0
+
+
+# Ends of the first run: at the end of a year, in the middle of a spell across a year boundary, in
+#   the middle of a month and in a year after a spell across its start
+@pytest.mark.parametrize("end", ["2000-12-31", "2001-01-02", "2001-01-31", "2001-04-01", "2001-12-31", "2002-01-31"])
+@pytest.mark.parametrize("saved_runs", [True, False])
+def test_resume_matches_single_run(tmp_path, single_run, end, saved_runs):
+    path = str(tmp_path / "indices.zarr")
+    daily_indices(synthetic_daily(end), synthetic_thresholds(), path)
+    if not saved_runs:
+        # Without the saved runs the daily data is reduced again from the first year
+        os.remove(spell_runs_path(path))
+    daily_indices(synthetic_daily(), synthetic_thresholds(), path)
+    xr.testing.assert_identical(monthly(path), single_run)
+
+
+def test_saved_runs_are_the_runs_at_the_start_of_the_year(tmp_path):
+    path = str(tmp_path / "indices.zarr")
+    daily_indices(synthetic_daily("2002-01-31"), synthetic_thresholds(), path)
+    runs = load_spell_runs(spell_runs_path(path), 2002, (len(LAT), len(LON)))
+    # The spell started on 29 December
+    assert np.all(runs["wsdi"] == 3) and np.all(runs["csdi"] == 0)
+    assert load_spell_runs(spell_runs_path(path), 2001, (len(LAT), len(LON))) is None
+
+
+def test_month_cut_by_the_end_of_the_data_is_not_appended(tmp_path):
+    path = str(tmp_path / "indices.zarr")
+    daily_indices(synthetic_daily("2001-04-01"), synthetic_thresholds(), path)
+    assert monthly(path).indexes["time"][-1] == pd.Timestamp("2001-03-01")
@@ -0,0 +1,76 @@
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from climate_store import open_climate_store
+from era5_ingest import INGEST_BUFFER_COPIES, normalize_era5, ingest_block_steps, open_members, ingest_archives
+
+# Ingesting the archives in blocks of timesteps gives the same store as normalizing each year at
+#   once, on small synthetic archives laid out as the CDS ones (0-360 longitudes, descending
+#   latitudes, Kelvin, one member per variable).
+
+LAT = np.array([0.5, 0.25, 0.0, -0.25])
+LON = np.array([0.0, 90.0, 180.0, 270.0])
+
+
+def raw_member(var, times, seed):
+    rng = np.random.default_rng(seed)
+    values = rng.normal(size=(len(times), len(LAT), len(LON))).astype(np.float32)
+    if var == "t2m":
+        values += 290
+    coords = {"valid_time": times, "latitude": LAT, "longitude": LON, "number": 0}
+    return xr.Dataset({var: (("valid_time", "latitude", "longitude"), values)}, coords=coords)
+
+
+def write_archives(folder, years):
+    """data_{year}.zip archives with a t2m and a tp member, and the raw members of every year."""
+    members = {}
+    for year in years:
+        times = pd.date_range(f"{year}-01-01", f"{year}-12-31", freq="D")
+        members[year] = [raw_member("t2m", times, year), raw_member("tp", times, year + 1)]
+        with zipfile.ZipFile(folder / f"data_{year}.zip", "w") as archive:
+            for ds, name in zip(members[year], ["instant", "accum"]):
+                path = folder / f"{name}.nc"
+                ds.to_netcdf(path)
+                archive.write(path, f"data_stream-oper_stepType-{name}.nc")
+                path.unlink()
+    return members
+
+
+# Bytes of a timestep of both members, read INGEST_BUFFER_COPIES times
+STEP_BYTES = INGEST_BUFFER_COPIES * 2 * len(LAT) * len(LON) * 4
+
+
+# Blocks of 100 days (the last one of each year is cut at the end of its archive) and whole years
+@pytest.mark.parametrize("memory_budget", [100 * STEP_BYTES, 1e9])
+def test_blocks_match_whole_years(tmp_path, memory_budget):
+    members = write_archives(tmp_path, [2000, 2001])
+    store = str(tmp_path / "store.zarr")
+    n_new = ingest_archives(str(tmp_path), store, time_chunk=366, memory_budget=memory_budget)
+
+    expected = xr.concat(
+        [xr.merge([normalize_era5(ds) for ds in year_members], compat="override", join="outer") for year_members in members.values()],
+        dim="time",
+    )
+    assert n_new == expected.sizes["time"]
+    with open_climate_store(store) as ds:
+        xr.testing.assert_allclose(ds.load(), expected)
+
+
+def test_rerun_appends_nothing(tmp_path):
+    write_archives(tmp_path, [2000])
+    store = str(tmp_path / "store.zarr")
+    ingest_archives(str(tmp_path), store, memory_budget=100 * STEP_BYTES)
+    assert ingest_archives(str(tmp_path), store, memory_budget=100 * STEP_BYTES) == 0
+
+
+def test_block_steps_follow_the_budget(tmp_path):
+    write_archives(tmp_path, [2000])
+    datasets, _ = open_members(tmp_path / "data_2000.zip", tmp_path)
+    assert ingest_block_steps(datasets, memory_budget=10.5 * STEP_BYTES) == 10
+    assert ingest_block_steps(datasets, memory_budget=1) == 1
+    for ds in datasets:
+        ds.close()
@@ -0,0 +1,100 @@
+import warnings
+
+import numpy as np
+import pytest
+import xarray as xr
+from climate_indices import compute
+
+from spi_tools import spi_block, spi_multiscale, compute_spi_multiscale
+
+# The native SPI engine against climate_indices, on a small synthetic cube of monthly precipitation.
+
+SCALES = [1, 3, 6, 12]
+DATA_START_YEAR = 1990
+N_YEARS = 30
+# Largest absolute difference allowed, in SPI units
+TOLERANCE = 1e-3
+
+
+def edge_cases(precip):
+    """Dry edge cases of the gamma fit, built from a (time,) precipitation series.
+
+    Returns:
+        np.ndarray: (time, 4) array with an all-zero series, the series with every July dry, with
+            every July dry but one, and with every July dry but two.
+    """
+    dry_july = precip.copy()
+    dry_july[6::12] = 0
+    single_wet_july = dry_july.copy()
+    single_wet_july[6 + 12 * (N_YEARS // 2)] = precip.max()
+    two_wet_julys = single_wet_july.copy()
+    two_wet_julys[6 + 12 * (N_YEARS // 3)] = precip.mean()
+    return np.stack([np.zeros_like(precip), dry_july, single_wet_july, two_wet_julys], axis=-1)
+
+
+def synthetic_precip(n_points=6, seed=0):
+    """(time, point) gamma precipitation with missing values, a month dry in the first years and the edge cases."""
+    rng = np.random.default_rng(seed)
+    precip = rng.gamma(2, 30, size=(12 * N_YEARS, n_points))
+    precip[100:104, 0] = np.nan
+    precip[:36:12, 1] = 0
+    precip[rng.random(precip.shape) < 0.02] = 0
+    return np.concatenate([precip, edge_cases(precip[:, 2])], axis=1)
+
+
+def reference_spi(precip, calibration):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return np.stack(
+            [
+                compute_spi_multiscale(precip[:, j], SCALES, DATA_START_YEAR, *calibration, compute.Periodicity.monthly)
+                for j in range(precip.shape[1])
+            ],
+            axis=-1,
+        )
+
+
+# Calibration within the record, and not covered by it (the full record is used)
+CALIBRATIONS = [(1991, 2010), (1981, 2010)]
+
+
+@pytest.mark.parametrize("calibration", CALIBRATIONS)
+def test_native_engine_matches_climate_indices(calibration):
+    precip = synthetic_precip()
+    native = spi_block(precip, SCALES, DATA_START_YEAR, *calibration)
+    reference = reference_spi(precip, calibration)
+    np.testing.assert_array_equal(np.isnan(native), np.isnan(reference))
+    np.testing.assert_allclose(native, reference, atol=TOLERANCE, equal_nan=True)
+
+
+@pytest.mark.parametrize("calibration", CALIBRATIONS)
+def test_dry_edge_cases(calibration):
+    precip = edge_cases(synthetic_precip()[:, 2])
+    native = spi_block(precip, [1], DATA_START_YEAR, *calibration)[0]
+    reference = reference_spi(precip, calibration)[0]
+    np.testing.assert_allclose(native, reference, atol=TOLERANCE, equal_nan=True)
+
+    # All zero: every month is the driest value
+    assert np.all(native[:, 0] == np.float32(-3.09))
+    # Every July dry: p0 = 1, the Julys are the driest value
+    assert np.all(native[6::12, 1] == np.float32(-3.09))
+    # A single wet July fits no gamma: its zeros have the probability of zero and the wet one is nan
+    julys = native[6::12, 2]
+    assert np.isnan(julys[N_YEARS // 2])
+    assert np.all(np.isfinite(np.delete(julys, N_YEARS // 2)))
+    # Two wet Julys fit a gamma
+    assert np.all(np.isfinite(native[6::12, 3]))
+
+
+def test_spi_multiscale_engines_agree():
+    precip = synthetic_precip(n_points=4)
+    da_precip = xr.DataArray(precip, dims=("time", "point")).chunk({"point": 3})
+    calibration = CALIBRATIONS[0]
+    spis = {
+        engine: spi_multiscale(
+            da_precip, SCALES, DATA_START_YEAR, *calibration, compute.Periodicity.monthly, engine=engine
+        ).compute()
+        for engine in ["native", "climate_indices"]
+    }
+    for scale in SCALES:
+        xr.testing.assert_allclose(spis["native"][f"spi{scale}"], spis["climate_indices"][f"spi{scale}"], atol=TOLERANCE)